@@ -0,0 +1,585 @@
+"""Benchmark optimization of WikiPathways SVGs
+
+The corpus is built from the optimized SVGs in `data/`, by restoring markup
+that optimization removes (pan-zoom controls, metadata, long color and marker
+IDs, wrapping tspans), plus synthetic large diagrams that tile the largest
+pathways.  Building is deterministic, and the corpus is kept in
+`--corpus-dir` so later runs reuse it.
+
+Two benchmarks run, each in a fresh process so peak RSS is its own:
+
+  custom: `custom_lossless_optimize_svg` then `custom_lossy_optimize_svg`, on
+          scoured SVG
+  full: `WikiPathwaysCache.optimize_svgs`, on raw SVG files
+
+Each reports throughput, per-file latency percentiles, peak RSS and
+compression ratio.  With a stored baseline, this exits with an error if any
+measure regresses beyond a threshold.
+
+The corpus and baseline live in `tmp/`, which git ignores, as they're
+generated and the baseline's timings only hold for the machine that measured
+them.  To make or refresh a baseline, e.g. on a new machine or after an
+intended change in performance, run with `--save-baseline`.
+
+Startup is also measured, as the time to import `wikipathways` in a fresh
+interpreter, and its RSS after: alone, as `fetch` and `serve.py` do, and with
+what optimizing loads, as `optimize` and its worker processes do.  This exits
+with an error if either exceeds its budget in `startup_budgets`.
+
+Examples:
+
+python3 src/benchmark.py --save-baseline
+python3 src/benchmark.py --limit 200 --workers 4
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import glob
+import json
+import multiprocessing
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+from lxml import etree
+
+import wikipathways
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Code that starts up a fresh interpreter, by what it loads
+startup_code = {
+    "import": "import wikipathways",
+    "optimize": (
+        "import wikipathways; wikipathways.import_scour(); " +
+        "wikipathways.compact_numbers('0.5')"
+    ),
+}
+
+# Most milliseconds and megabytes of RSS each startup may take
+startup_budgets = {
+    "import": (150, 35),
+    "optimize": (300, 50),
+}
+
+# Measures compared against the baseline, all of which are worse when higher
+compared_measures = [
+    "seconds", "latency_p95_s", "peak_rss_mb", "compression_ratio"
+]
+
+def expand_color(match):
+    """Expand a 3-digit hex color to 6 digits, e.g. #0c0 -> #00cc00
+    """
+    return "#" + "".join(c * 2 for c in match.group(1))
+
+def expand_marker_id(match):
+    """Expand an optimized marker ID, e.g. mea0c0 -> markerendarrow00cc00white
+    """
+    prefix, color, background = match.groups()
+    if prefix[:3] in marker_prefixes:
+        prefix = marker_prefixes[prefix[:3]] + prefix[3:]
+    color = color_hexes.get(color, color or "000")
+    if len(color) == 3:
+        color = "".join(c * 2 for c in color)
+    return prefix + color + (background or "white")
+
+def expand_color_name(match):
+    """Expand a color keyword from `condense_colors`, e.g. brown -> #a52a2a
+    """
+    return match.group(1) + "#" + color_hexes[match.group(2)]
+
+# Marker ID prefixes, by what `marker_id_rules` shorten them to
+marker_prefixes = {"mea": "markerendarrow", "mem": "markerendmim"}
+
+# Hexadecimal colors by the keywords that optimizing abbreviates them to
+color_hexes = {
+    name: hex_color
+    for hex_color, name in wikipathways.get_color_names().items()
+    if name in (
+        wikipathways.shorten_color(hex_color),
+        wikipathways.shorten_color(hex_color, prefix="")
+    )
+}
+color_names_pattern = "|".join(sorted(color_hexes, key=len, reverse=True))
+
+def make_raw_svg(svg, pwid):
+    """Approximate raw SVG markup for an optimized WikiPathways SVG
+
+    This restores what `custom_lossless_optimize_svg` needs to find, and what
+    its passes and rewrites remove, so optimizing it does comparable work.
+    """
+    # Drop CSS for defaults, which optimizing adds again
+    svg = re.sub(r"<style>[^<]*</style>", "", svg, count=1)
+    # Scour removes empty groups, so give icon definitions a symbol if need be
+    symbol = '<symbol id="Rectangle"><rect width="1" height="1"/></symbol>'
+    icon_defs = f'<g id="icon-defs">{symbol}</g>'
+    svg = svg.replace('<g id="icon-defs"/>', icon_defs)
+    if 'id="icon-defs"' not in svg:
+        svg = svg.replace("<defs>", "<defs>" + icon_defs, 1)
+    svg = svg.replace('id="icon-defs"', f'id="{wikipathways.icons_id}"')
+
+    marker_color = f"({color_names_pattern}|[0-9a-f]{{6}}|[0-9a-f]{{3}})"
+    svg = re.sub(
+        rf"\b(mea){marker_color}?([0-9a-f]{{6}})?\b", expand_marker_id, svg
+    )
+    svg = re.sub(
+        rf"\b(mem[a-z]+?|marker[a-z]+?){marker_color}([0-9a-f]{{6}})?\b",
+        expand_marker_id,
+        svg
+    )
+    svg = re.sub(
+        rf'((?:fill|stroke|color)(?::|="))({color_names_pattern})\b',
+        expand_color_name,
+        svg
+    )
+    svg = re.sub(r"#([0-9a-f]{3})(?![0-9a-f])", expand_color, svg)
+
+    tspan = r'<tspan font-size="12px">\2</tspan>'
+    svg = re.sub(
+        r"<text ([^>]*)>([^<]+)</text>",
+        r'<text \1 xml:space="preserve">' + tspan + "</text>",
+        svg
+    )
+    svg = svg.replace(
+        'class="Edge"',
+        'class="Interaction Edge SBO_0000170" typeof="Interaction"'
+    )
+
+    controls = (
+        '<g class="svg-pan-zoom-control"><path d="m0 0h10v10h-10z"/></g>' +
+        '<style id="svg-pan-zoom-controls-styles">' +
+        '.svg-pan-zoom-control { cursor: pointer; }</style>' +
+        f'<text id="{pwid}-text"><tspan>{pwid.lower()}</tspan></text>'
+    )
+    svg = re.sub(r"(<svg [^>]*>)", r"\1" + controls, svg, count=1)
+    return svg
+
+def make_large_svg(svg, pwid, copies):
+    """Make a large raw SVG by tiling copies of a pathway's diagram
+
+    Copies get suffixed IDs, with references among them updated to match.
+    """
+    svg = re.sub(r"^\s*<\?xml[^>]*\?>\s*", "", svg)
+    tree = etree.fromstring(svg)
+    pathway = tree.xpath(
+        "//svg:g[@id=$pwid]", pwid=pwid,
+        namespaces={"svg": "http://www.w3.org/2000/svg"}
+    )[0]
+
+    for i in range(1, copies):
+        pathway_copy = copy.deepcopy(pathway)
+        ids = [e.get("id") for e in pathway_copy.iter() if e.get("id")]
+        ids_pattern = "|".join(re.escape(id) for id in ids)
+        reference = re.compile(r"#(" + ids_pattern + r")(?![\w-])")
+        for element in pathway_copy.iter(etree.Element):
+            for name, value in element.items():
+                if name == "id":
+                    element.set(name, f"{value}-{i}")
+                elif "#" in value and ids:
+                    element.set(name, reference.sub(rf"#\1-{i}", value))
+        pathway_copy.set("transform", f"translate({i * 2000},0)")
+        pathway.addnext(pathway_copy)
+
+    svg = etree.tostring(tree).decode("utf-8")
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + svg
+
+def quietly(function, *args):
+    """Call a function, discarding what it and any processes it starts print
+    """
+    sys.stdout.flush()
+    stdout_fd = os.dup(1)
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+        try:
+            return function(*args)
+        finally:
+            sys.stdout.flush()
+            os.dup2(stdout_fd, 1)
+            os.close(stdout_fd)
+
+def build_corpus(data_dir, corpus_dir, limit, large, copies):
+    """Write raw and scoured SVGs for the corpus, reusing any already built
+
+    Returns pathway IDs in the corpus.
+    """
+    raw_dir = corpus_dir + "raw/"
+    scoured_dir = corpus_dir + "scoured/"
+    os.makedirs(raw_dir, exist_ok=True)
+    os.makedirs(scoured_dir, exist_ok=True)
+
+    # Pathway SVGs, not e.g. a sprite sheet of their shared symbols, nor
+    # their level-of-detail variants
+    data_paths = sorted(
+        path for path in glob.glob(data_dir + "WP*.svg")
+        if wikipathways.pathway_svg_name_regex.fullmatch(
+            os.path.basename(path)
+        )
+    )
+    if limit:
+        data_paths = data_paths[:limit]
+    largest_paths = sorted(data_paths, key=os.path.getsize)[::-1][:large]
+
+    svgs = []
+    for path in data_paths:
+        pwid = wikipathways.get_pwid(path)
+        svgs.append((pwid, path, None))
+    for path in largest_paths:
+        source_pwid = wikipathways.get_pwid(path)
+        # A synthetic pathway ID, e.g. WP2658 -> WP2658000000, which `get_pwid`
+        # still recognizes
+        svgs.append((source_pwid + "000000", path, source_pwid))
+
+    pwids = []
+    for pwid, path, source_pwid in svgs:
+        raw_path = raw_dir + pwid + ".svg"
+        scoured_path = scoured_dir + pwid + ".svg"
+        pwids.append(pwid)
+        if os.path.exists(raw_path) and os.path.exists(scoured_path):
+            continue
+        print(f"Building corpus SVG: {raw_path}")
+
+        with open(path) as f:
+            svg = make_raw_svg(f.read(), pwid)
+        if source_pwid:
+            svg = make_large_svg(svg, source_pwid, copies)
+
+        scoured_svg = wikipathways.scour_svg(svg)
+        wikipathways.write_atomically(scoured_path, scoured_svg)
+        wikipathways.write_atomically(raw_path, svg)
+
+    return pwids
+
+def get_peak_rss_mb():
+    """Get peak RSS of this process or any of its finished children, in MB
+    """
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    return peak_rss / 1024 # ru_maxrss is in KiB on Linux
+
+def summarize(latencies, seconds, input_bytes, output_bytes):
+    """Get measures for a benchmark from its per-file latencies and sizes
+    """
+    get_percentile = wikipathways.get_percentile
+    return {
+        "files": len(latencies),
+        "seconds": round(seconds, 3),
+        "files_per_s": round(len(latencies) / seconds, 2),
+        "mb_per_s": round(input_bytes / 1e6 / seconds, 3),
+        "latency_p50_s": round(get_percentile(latencies, 50), 4),
+        "latency_p95_s": round(get_percentile(latencies, 95), 4),
+        "latency_p99_s": round(get_percentile(latencies, 99), 4),
+        "latency_max_s": round(max(latencies), 4),
+        "peak_rss_mb": round(get_peak_rss_mb(), 1),
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes,
+        "compression_ratio": round(output_bytes / input_bytes, 5),
+    }
+
+def benchmark_custom(corpus_dir, pwids):
+    """Time lossless then lossy optimization of each scoured SVG
+    """
+    latencies = []
+    input_bytes = 0
+    output_bytes = 0
+    for pwid in pwids:
+        with open(corpus_dir + "scoured/" + pwid + ".svg") as f:
+            svg = f.read()
+        start = perf_counter()
+        optimized_svg = wikipathways.custom_lossless_optimize_svg(svg, pwid)
+        optimized_svg = wikipathways.custom_lossy_optimize_svg(optimized_svg)
+        latencies.append(perf_counter() - start)
+        input_bytes += len(svg.encode("utf-8"))
+        output_bytes += len(optimized_svg.encode("utf-8"))
+
+    return summarize(latencies, sum(latencies), input_bytes, output_bytes)
+
+def benchmark_full(corpus_dir, pwids, workers):
+    """Time `optimize_svgs` over the raw SVGs, from Scour to written files
+
+    Per-file latency is the sum of stage times in the cache's profile.
+    """
+    raw_dir = corpus_dir + "raw/"
+    with tempfile.TemporaryDirectory(dir=corpus_dir) as tmp_dir:
+        # Link only the chosen pathways, so `limit` applies
+        input_dir = tmp_dir + "/raw/"
+        os.makedirs(input_dir)
+        for pwid in pwids:
+            os.link(raw_dir + pwid + ".svg", input_dir + pwid + ".svg")
+
+        output_dir = tmp_dir + "/optimized/"
+        profile_path = tmp_dir + "/profile.jsonl"
+        cache = wikipathways.WikiPathwaysCache(
+            output_dir, workers=workers, profile_path=profile_path
+        )
+
+        start = perf_counter()
+        errors_by_pwid = quietly(cache.optimize_svgs, input_dir)
+        seconds = perf_counter() - start
+
+        failed = sorted(p for p, error in errors_by_pwid.items() if error)
+        if failed:
+            raise Exception("Failed to optimize: " + ",".join(failed))
+
+        latencies_by_pwid = {}
+        for stage in cache.stages:
+            pwid = stage["pwid"]
+            latency = latencies_by_pwid.get(pwid, 0) + stage["wall_s"]
+            latencies_by_pwid[pwid] = latency
+
+        input_bytes = 0
+        output_bytes = 0
+        for pwid in pwids:
+            input_bytes += os.path.getsize(input_dir + pwid + ".svg")
+            output_bytes += os.path.getsize(output_dir + pwid + ".svg")
+
+    latencies = list(latencies_by_pwid.values())
+    return summarize(latencies, seconds, input_bytes, output_bytes)
+
+def measure_startup(code, runs=5):
+    """Time running code in a fresh interpreter, and get its RSS after
+
+    Time is the median over `runs`, and leaves out the interpreter's own
+    startup, which this module can't speed up.  RSS is read from /proc, as
+    a process's peak RSS on Linux starts from its parent's, i.e. this one's.
+    """
+    script = (
+        "import re, sys, time\n" +
+        "start = time.perf_counter()\n" +
+        f"sys.path.insert(0, {src_dir!r})\n" +
+        code + "\n" +
+        "seconds = time.perf_counter() - start\n" +
+        "status = open('/proc/self/status').read()\n" +
+        "print(seconds, re.search(r'VmRSS:\\s*(\\d+)', status).group(1))\n"
+    )
+    times = []
+    rss_kb = 0
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", script], capture_output=True, text=True,
+            check=True
+        ).stdout
+        seconds, run_rss_kb = output.split()
+        times.append(float(seconds))
+        rss_kb = max(rss_kb, int(run_rss_kb))
+    return {
+        "startup_ms": round(wikipathways.get_percentile(times, 50) * 1000, 1),
+        "rss_mb": round(rss_kb / 1024, 1),
+    }
+
+def find_over_budget(startups):
+    """List startup measures over their budget in `startup_budgets`
+    """
+    over_budget = []
+    for name, measures in startups.items():
+        budget_ms, budget_mb = startup_budgets[name]
+        if measures["startup_ms"] > budget_ms:
+            over_budget.append(
+                f"{name} startup_ms: {measures['startup_ms']} vs. budget " +
+                f"{budget_ms}"
+            )
+        if measures["rss_mb"] > budget_mb:
+            over_budget.append(
+                f"{name} rss_mb: {measures['rss_mb']} vs. budget {budget_mb}"
+            )
+    return over_budget
+
+def run_in_fresh_process(function, *args):
+    """Run a function in a new process, so its peak RSS is measured alone
+
+    On Linux a new process's peak RSS starts from its parent's RSS when it
+    started, so the parent should stay small.
+    """
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(function, *args).result()
+
+def find_regressions(results, baseline, threshold, size_threshold):
+    """List measures worse than the baseline by more than a threshold
+
+    Compression ratios are deterministic, so they get a tighter threshold.
+    """
+    regressions = []
+    for name in results:
+        if name not in baseline:
+            continue
+        for measure in compared_measures:
+            value = results[name][measure]
+            baseline_value = baseline[name][measure]
+            allowed = threshold
+            if measure == "compression_ratio":
+                allowed = size_threshold
+            if value > baseline_value * (1 + allowed):
+                change = (value / baseline_value - 1) * 100
+                regressions.append(
+                    f"{name} {measure}: {value} vs. baseline " +
+                    f"{baseline_value} ({change:+.1f}%)"
+                )
+    return regressions
+
+def print_results(results):
+    """Print benchmark measures as a table
+    """
+    names = list(results)
+    print(f'{"measure":<20}' + "".join(f"{name:>16}" for name in names))
+    for measure in results[names[0]]:
+        row = f"{measure:<20}"
+        for name in names:
+            row += f"{results[name][measure]:>16}"
+        print(row)
+
+# Command-line handler
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--data-dir",
+        help=(
+            "Directory of optimized SVGs to build the corpus from.  " +
+            "(default: %(default)s)"
+        ),
+        default="data/"
+    )
+    parser.add_argument(
+        "--corpus-dir",
+        help=(
+            "Directory to build the corpus in.  (default: %(default)s)"
+        ),
+        default="tmp/benchmark/"
+    )
+    parser.add_argument(
+        "--limit",
+        help=(
+            "Use only the first N pathways in the data directory, e.g. " +
+            "for a quick run.  (default: all)"
+        ),
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        "--large",
+        help=(
+            "Number of synthetic large diagrams.  (default: %(default)s)"
+        ),
+        type=int,
+        default=3
+    )
+    parser.add_argument(
+        "--copies",
+        help=(
+            "Copies of a pathway tiled in each synthetic large diagram.  " +
+            "(default: %(default)s)"
+        ),
+        type=int,
+        default=5
+    )
+    parser.add_argument(
+        "--workers",
+        help=(
+            "Number of processes for the full benchmark.  " +
+            "(default: %(default)s)"
+        ),
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--skip-full",
+        help=(
+            "Run only the custom benchmark, which skips slow Scour"
+        ),
+        action="store_true"
+    )
+    parser.add_argument(
+        "--baseline",
+        help="Baseline results to compare against.  " +
+            "(default: CORPUS_DIR/baseline.json)"
+    )
+    parser.add_argument(
+        "--save-baseline",
+        help=(
+            "Store these results as the baseline, rather than comparing"
+        ),
+        action="store_true"
+    )
+    parser.add_argument(
+        "--threshold",
+        help=(
+            "Fraction by which time and memory may exceed the baseline.  " +
+            "(default: %(default)s)"
+        ),
+        type=float,
+        default=0.1
+    )
+    parser.add_argument(
+        "--size-threshold",
+        help=(
+            "Fraction by which compression ratio may exceed the baseline.  " +
+            "(default: %(default)s)"
+        ),
+        type=float,
+        default=0.001
+    )
+    args = parser.parse_args()
+    corpus_dir = os.path.join(args.corpus_dir, "")
+    data_dir = os.path.join(args.data_dir, "")
+    baseline_path = args.baseline or corpus_dir + "baseline.json"
+
+    startups = {
+        name: measure_startup(code) for name, code in startup_code.items()
+    }
+    print_results(startups)
+    over_budget = find_over_budget(startups)
+
+    pwids = run_in_fresh_process(
+        build_corpus, data_dir, corpus_dir, args.limit, args.large, args.copies
+    )
+    print(f"Corpus: {len(pwids)} SVGs in {corpus_dir}")
+
+    results = {}
+    results["custom"] = run_in_fresh_process(
+        benchmark_custom, corpus_dir, pwids
+    )
+    if not args.skip_full:
+        results["full"] = run_in_fresh_process(
+            benchmark_full, corpus_dir, pwids, args.workers
+        )
+    print_results(results)
+
+    failures = []
+    if args.save_baseline:
+        with open(baseline_path, "w") as f:
+            f.write(json.dumps(results, indent=2) + "\n")
+        print(f"Saved baseline to {baseline_path}")
+    elif os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(
+            results, baseline, args.threshold, args.size_threshold
+        )
+        if regressions:
+            print("Regressions beyond threshold:")
+            for regression in regressions:
+                print("  " + regression)
+            failures += regressions
+        else:
+            print(f"No regressions beyond threshold vs. {baseline_path}")
+    else:
+        print(f"No baseline at {baseline_path}; add one with --save-baseline")
+
+    if over_budget:
+        print("Startup over budget:")
+        for measure in over_budget:
+            print("  " + measure)
+        failures += over_budget
+    else:
+        print("Startup within budget")
+    if failures:
+        sys.exit(1)
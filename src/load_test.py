@@ -0,0 +1,202 @@
+"""Load-test a server of WikiPathways SVGs on localhost
+
+Starts a server of the SVGs in `--data-dir` on a free local port, either
+`serve.py` or, to compare against, a generic static file server.  Then
+client processes each request pathway SVGs over a kept-alive connection for
+`--seconds`, choosing pathways by a Zipf-like distribution so some are hot,
+as in real traffic.  Reports requests per second and latency percentiles.
+
+Examples:
+
+python3 src/load_test.py
+python3 src/load_test.py --server static --clients 8
+"""
+
+import argparse
+import glob
+import http.client
+from multiprocessing import Pool
+import os
+import random
+import socket
+import subprocess
+import sys
+from time import perf_counter, sleep
+
+import wikipathways
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+def get_free_port():
+    """Get a port on localhost that nothing is listening on
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(server, data_dir, port, cache_mb):
+    """Start a server of `data_dir` in a subprocess, and wait until it's up
+    """
+    if server == "serve":
+        command = [
+            sys.executable, os.path.join(src_dir, "serve.py"),
+            "--data-dir", data_dir, "--port", str(port),
+            "--cache-mb", str(cache_mb)
+        ]
+    else:
+        command = [
+            sys.executable, "-m", "http.server", str(port),
+            "--bind", "127.0.0.1", "--directory", data_dir
+        ]
+    process = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except ConnectionRefusedError:
+            sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"Server didn't start on port {port}")
+
+def run_client(port, pwids, weights, seconds, accept_encoding, seed):
+    """Request SVGs until time is up, and get latencies and bytes received
+    """
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {}
+    latencies = []
+    num_bytes = 0
+    num_errors = 0
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        pwid = rng.choices(pwids, weights)[0]
+        start = perf_counter()
+        connection.request("GET", f"/{pwid}.svg", headers=headers)
+        response = connection.getresponse()
+        content = response.read()
+        latencies.append(perf_counter() - start)
+        if response.status != 200:
+            num_errors += 1
+        num_bytes += len(content)
+    connection.close()
+    return latencies, num_bytes, num_errors
+
+def load_test(
+    data_dir, server="serve", clients=4, seconds=10, pathways=None,
+    accept_encoding="gzip, br", cache_mb=256
+):
+    """Run a load test, and print its results
+    """
+    # Pathways' SVGs, once each, and not e.g. the sprite sheet
+    pwids = sorted(
+        wikipathways.get_pwid(path)
+        for path in glob.glob(data_dir + "WP*.svg")
+        if wikipathways.pathway_svg_name_regex.fullmatch(
+            os.path.basename(path)
+        )
+    )
+    if pathways:
+        pwids = random.Random(0).sample(pwids, min(pathways, len(pwids)))
+    weights = [1 / rank for rank in range(1, len(pwids) + 1)]
+
+    port = get_free_port()
+    process = start_server(server, data_dir, port, cache_mb)
+    try:
+        args = [
+            (port, pwids, weights, seconds, accept_encoding, seed)
+            for seed in range(clients)
+        ]
+        with Pool(clients) as pool:
+            results = pool.starmap(run_client, args)
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies = [latency for result in results for latency in result[0]]
+    num_bytes = sum(result[1] for result in results)
+    num_errors = sum(result[2] for result in results)
+    p50, p99 = [
+        wikipathways.get_percentile(latencies, percent) * 1000
+        for percent in [50, 99]
+    ]
+    print(
+        f"{server}: {len(latencies)} requests for {len(pwids)} pathways " +
+        f"from {clients} clients in {seconds} s, {num_errors} errors"
+    )
+    print(
+        f"{len(latencies) / seconds:.0f} req/s, " +
+        f"{num_bytes / seconds / 2**20:.1f} MB/s, " +
+        f"p50 {p50:.2f} ms, p99 {p99:.2f} ms"
+    )
+
+# Command-line handler
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--data-dir",
+        help=(
+            "Directory of optimized SVGs.  (default: %(default)s)"
+        ),
+        default="data/"
+    )
+    parser.add_argument(
+        "--server",
+        help=(
+            "Server to test: serve.py, or Python's static file server.  " +
+            "(default: %(default)s)"
+        ),
+        choices=["serve", "static"],
+        default="serve"
+    )
+    parser.add_argument(
+        "--clients",
+        help=(
+            "Number of client processes.  (default: %(default)s)"
+        ),
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        "--seconds",
+        help=(
+            "How long to send requests for.  (default: %(default)s)"
+        ),
+        type=float,
+        default=10
+    )
+    parser.add_argument(
+        "--pathways",
+        help=(
+            "Request only this many pathways, sampled from the data " +
+            "directory.  (default: all)"
+        ),
+        type=int
+    )
+    parser.add_argument(
+        "--accept-encoding",
+        help=(
+            "Accept-Encoding header to send, or '' for none.  " +
+            "(default: %(default)s)"
+        ),
+        default="gzip, br"
+    )
+    parser.add_argument(
+        "--cache-mb",
+        help=(
+            "Cache size for serve.py.  (default: %(default)s)"
+        ),
+        type=float,
+        default=256
+    )
+    args = parser.parse_args()
+    data_dir = os.path.join(args.data_dir, "")
+
+    load_test(
+        data_dir, args.server, args.clients, args.seconds, args.pathways,
+        args.accept_encoding, args.cache_mb
+    )
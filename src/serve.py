@@ -0,0 +1,438 @@
+"""Serve optimized WikiPathways SVGs by pathway ID, from memory
+
+Requests like `/WP554.svg` (or `/WP554`) are answered from a size-bounded,
+least-recently-used cache of each pathway's SVG and its precompressed
+variants, so hot pathways aren't statted and read from disk every time.
+Xref sidecars, e.g. `/WP554.xrefs.json`, are served the same way, for
+clients to fetch when a user interacts with a diagram, as are
+level-of-detail variants, e.g. `/WP554.lod200.svg` for thumbnails, and the
+sprite sheet of icon symbols that SVGs optimized with `--sprite` refer to,
+`/sprite.svg`.
+
+Responses have strong ETags from the SHA-256 of the file, with a suffix for
+each encoding, and `If-None-Match` gets 304 Not Modified.  `Accept-Encoding`
+is negotiated against the sidecars that `wikipathways.py` writes: Brotli
+(`.br`), gzip (`.gz`), and, for clients that send a matching
+`Available-Dictionary`, dictionary-compressed Zstandard (`.dcz`) from
+`shared_dictionary.py`.  Its dictionary is served at `/svgs.dict`, with
+`Use-As-Dictionary` so clients keep it for pathways' SVGs, and SVGs with a
+`.dcz` variant link to it, so clients know to fetch it.
+
+Cached pathways, and the sprite sheet, are dropped when `optimize_svgs`
+rewrites them, as noted in the manifest in the data directory, which is
+checked at most once per `--check-interval`.
+
+Examples:
+
+python3 src/serve.py
+python3 src/serve.py --port 8080 --cache-mb 512
+"""
+
+import argparse
+import base64
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import re
+import threading
+from time import monotonic
+
+from shared_dictionary import dcz_header_size, dcz_magic, dictionary_name
+import wikipathways
+
+# Pathways' files, e.g. /WP554.svg, and the sprite sheet, /sprite.svg, by
+# the name of their entry in the manifest then their suffix
+path_regex = re.compile(
+    r"^/(WP[0-9]+|" + re.escape(wikipathways.sprite_manifest_key) + r")" +
+    r"(\.svg|\.xrefs\.json|\.lod[0-9]+\.svg)?$"
+)
+
+# Content types by file extension
+content_types = {
+    ".svg": "image/svg+xml",
+    ".json": "application/json",
+    ".dict": "application/octet-stream",
+}
+
+# Pattern of URLs the shared dictionary compresses, for `Use-As-Dictionary`
+dictionary_match = "/WP*.svg"
+
+# Seconds clients may keep the shared dictionary.  Servers only send dcz
+# for the dictionary a client has, by hash, so a stale one is never misused.
+dictionary_max_age = 24 * 60 * 60
+
+# Encodings of precompressed variants, most preferred first, and the suffix
+# of their sidecar files
+encoding_suffixes = OrderedDict([
+    ("dcz", ".dcz"),
+    ("br", ".br"),
+    ("gzip", ".gz"),
+])
+
+def parse_accept_encoding(header):
+    """Get quality values by content coding from an Accept-Encoding header
+    """
+    qualities = {}
+    for item in (header or "").split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities
+
+def choose_encoding(accept_encoding, encodings):
+    """Choose the best of the available encodings for a client
+
+    Ties in quality go to the smallest variant, i.e. the first in
+    `encoding_suffixes`.  Uncompressed ("identity") is the fallback.
+    """
+    qualities = parse_accept_encoding(accept_encoding)
+    best, best_quality = "identity", 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def get_dictionary_hash(header):
+    """Get the SHA-256 from an Available-Dictionary header, e.g. ":pZGm...=:"
+    """
+    if not header:
+        return None
+    try:
+        return base64.b64decode(header.strip().strip(":"), validate=True)
+    except ValueError:
+        return None
+
+def get_pwid(name):
+    """Get the pathway ID in a file name, e.g. "WP554" for "WP554.svg", or
+    the key of another file's manifest entry, e.g. "sprite" for "sprite.svg"
+    """
+    return name.split(".")[0]
+
+def matches_etag(if_none_match, etag):
+    """Whether an If-None-Match header matches an ETag, weakly compared
+    """
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+class CachedSvg():
+    """An optimized SVG or xref sidecar, and its current precompressed
+    variants
+    """
+
+    def __init__(self, sha256, variants, manifest_entry):
+        self.sha256 = sha256
+        self.variants = variants
+        self.manifest_entry = manifest_entry
+        self.size = sum(len(content) for content in variants.values())
+
+    def get_etag(self, encoding):
+        """Get the strong ETag of the variant with an encoding
+        """
+        if encoding == "identity":
+            return f'"{self.sha256}"'
+        return f'"{self.sha256}.{encoding_suffixes[encoding][1:]}"'
+
+class SvgCache():
+    """A least-recently-used cache of `CachedSvg`s from a data directory, by
+    file name, bounded by total bytes
+    """
+
+    def __init__(self, data_dir, max_bytes, check_interval=1.0):
+        self.data_dir = data_dir
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self.manifest_path = data_dir + "manifest.json"
+        self.manifest = {}
+        self.manifest_mtime = None
+        self.checked_at = None
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def check_manifest(self):
+        """Reload the manifest if it changed, and drop cached pathways whose
+        entries in it changed
+
+        Entries change when a pathway's SVG is re-optimized, or when its
+        sidecars are remade.  Called with the lock held.
+        """
+        now = monotonic()
+        if (
+            self.checked_at is not None and
+            now - self.checked_at < self.check_interval
+        ):
+            return
+        self.checked_at = now
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.manifest_mtime:
+            return
+
+        manifest = {}
+        if mtime is not None:
+            # Written atomically, so never read half-written
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        self.manifest, self.manifest_mtime = manifest, mtime
+        for name, entry in list(self.entries.items()):
+            if manifest.get(get_pwid(name)) != entry.manifest_entry:
+                self.evict(name)
+
+    def evict(self, name):
+        """Drop a file from the cache.  Called with the lock held.
+        """
+        entry = self.entries.pop(name)
+        self.size -= entry.size
+
+    def load(self, name, manifest_entry):
+        """Read a pathway's file and its current sidecars, or None if missing
+
+        Sidecars of an SVG are current if the manifest says they compress
+        it.  Otherwise, e.g. for a directory of SVGs from elsewhere, they're
+        current if not older than the file.  Xref sidecars, LOD variants and
+        dictionary-compressed variants aren't noted in the manifest, so are
+        always checked by age.
+        """
+        file_path = self.data_dir + name
+        try:
+            with open(file_path, "rb") as f:
+                content = f.read()
+            mtime = os.stat(file_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        sha256 = wikipathways.get_hash(content)
+
+        variants = {"identity": content}
+        for encoding, suffix in encoding_suffixes.items():
+            path = file_path + suffix
+            if not os.path.exists(path):
+                continue
+            if (
+                encoding != "dcz" and manifest_entry is not None and
+                manifest_entry.get("output_sha256") == sha256
+            ):
+                is_current = manifest_entry.get("compressed_sha256") == sha256
+            else:
+                is_current = os.stat(path).st_mtime_ns >= mtime
+            if is_current:
+                with open(path, "rb") as f:
+                    variants[encoding] = f.read()
+        return CachedSvg(sha256, variants, manifest_entry)
+
+    def get(self, name):
+        """Get a `CachedSvg` for a file name, e.g. "WP554.svg", from memory
+        if cached, or None
+
+        Files larger than the whole cache are loaded but not kept.
+        """
+        pwid = get_pwid(name)
+        with self.lock:
+            self.check_manifest()
+            entry = self.entries.get(name)
+            if entry is not None:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            manifest_entry = self.manifest.get(pwid)
+
+        # Read outside the lock, so hits aren't held up by the disk
+        entry = self.load(name, manifest_entry)
+        if entry is None or entry.size > self.max_bytes:
+            return entry
+
+        with self.lock:
+            if name in self.entries:
+                self.evict(name)
+            if self.manifest.get(pwid) != manifest_entry:
+                # Manifest changed while loading, so this may be stale
+                return entry
+            self.entries[name] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                self.evict(next(iter(self.entries)))
+        return entry
+
+class SvgRequestHandler(BaseHTTPRequestHandler):
+    """Handle GET and HEAD requests for pathway files from `server.cache`
+    """
+
+    # Keep connections alive between requests, and don't let the body wait
+    # on an acknowledgement of the headers
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def respond(self, send_body):
+        path = self.path.split("?")[0]
+        match = path_regex.match(path)
+        name = None
+        if match:
+            name = match.group(1) + (match.group(2) or ".svg")
+        elif path == "/" + dictionary_name:
+            name = dictionary_name
+        entry = name and self.server.cache.get(name)
+        if not entry:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        encodings = [
+            encoding for encoding in entry.variants if encoding != "identity"
+        ]
+        if "dcz" in encodings:
+            dictionary_hash = get_dictionary_hash(
+                self.headers.get("Available-Dictionary")
+            )
+            dcz = entry.variants["dcz"]
+            if dictionary_hash != dcz[len(dcz_magic):dcz_header_size]:
+                encodings.remove("dcz")
+        encoding = choose_encoding(
+            self.headers.get("Accept-Encoding"), encodings
+        )
+        etag = entry.get_etag(encoding)
+
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match and matches_etag(if_none_match, etag):
+            self.send_response(304)
+            self.send_common_headers(name, entry, etag)
+            self.end_headers()
+            return
+
+        content = entry.variants[encoding]
+        self.send_response(200)
+        self.send_common_headers(name, entry, etag)
+        extension = name[name.rindex("."):]
+        self.send_header("Content-Type", content_types[extension])
+        self.send_header("Content-Length", str(len(content)))
+        if encoding != "identity":
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(content)
+
+    def send_common_headers(self, name, entry, etag):
+        self.send_header("ETag", etag)
+        self.send_header("Vary", "Accept-Encoding, Available-Dictionary")
+        if name == dictionary_name:
+            self.send_header(
+                "Use-As-Dictionary", f'match="{dictionary_match}"'
+            )
+            self.send_header(
+                "Cache-Control", f"max-age={dictionary_max_age}"
+            )
+            return
+        self.send_header("Cache-Control", "no-cache")
+        if "dcz" in entry.variants:
+            self.send_header(
+                "Link", f'</{dictionary_name}>; rel="compression-dictionary"'
+            )
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def make_server(
+    data_dir="data/", host="127.0.0.1", port=8000, cache_bytes=256 * 2**20,
+    check_interval=1.0, verbose=False
+):
+    """Make a threaded HTTP server for the SVGs in `data_dir`
+    """
+    server = ThreadingHTTPServer((host, port), SvgRequestHandler)
+    server.daemon_threads = True
+    server.cache = SvgCache(data_dir, cache_bytes, check_interval)
+    server.verbose = verbose
+    return server
+
+# Command-line handler
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--data-dir",
+        help=(
+            "Directory of optimized SVGs.  (default: %(default)s)"
+        ),
+        default="data/"
+    )
+    parser.add_argument(
+        "--host",
+        help=(
+            "Address to listen on.  (default: %(default)s)"
+        ),
+        default="127.0.0.1"
+    )
+    parser.add_argument(
+        "--port",
+        help=(
+            "Port to listen on.  (default: %(default)s)"
+        ),
+        type=int,
+        default=8000
+    )
+    parser.add_argument(
+        "--cache-mb",
+        help=(
+            "Most megabytes of SVGs and variants to keep in memory.  " +
+            "(default: %(default)s)"
+        ),
+        type=float,
+        default=256
+    )
+    parser.add_argument(
+        "--check-interval",
+        help=(
+            "Most seconds between checks of the manifest for re-optimized " +
+            "pathways.  (default: %(default)s)"
+        ),
+        type=float,
+        default=1.0
+    )
+    parser.add_argument(
+        "--verbose",
+        help=(
+            "Log each request"
+        ),
+        action="store_true"
+    )
+    args = parser.parse_args()
+    data_dir = os.path.join(args.data_dir, "")
+    cache_bytes = int(args.cache_mb * 2**20)
+
+    server = make_server(
+        data_dir, args.host, args.port, cache_bytes, args.check_interval,
+        args.verbose
+    )
+    print(f"Serving {data_dir} at http://{args.host}:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,252 @@
+"""Compress WikiPathways SVGs with a dictionary trained on the corpus
+
+Optimized SVGs share much markup: the CSS for defaults, marker and icon
+definitions, and common classes and attributes.  Compressing each file alone
+can't exploit that, which costs most for small diagrams.  This trains a
+Zstandard dictionary on the pathways' SVGs in a data directory, and writes
+a dictionary-compressed variant beside each.  Level-of-detail variants and
+the sprite sheet are left out, as they're unlike pathways' SVGs.
+
+Variants use the Dictionary-Compressed Zstandard ("dcz") format of HTTP
+Compression Dictionary Transport (RFC 9842): a 40-byte header with the
+SHA-256 of the dictionary, then a Zstandard frame.  A server can send them
+as-is with `Content-Encoding: dcz` to clients that have the dictionary, and
+`decompress_svg` checks that it has the right dictionary.  Clients get the
+dictionary in the data directory from `serve.py`, at `/svgs.dict`.
+
+Examples:
+
+python3 src/shared_dictionary.py train
+python3 src/shared_dictionary.py compress
+python3 src/shared_dictionary.py measure
+"""
+
+import argparse
+import glob
+import gzip
+import hashlib
+import os
+
+import brotli
+import zstandard
+
+import wikipathways
+
+# Magic number that starts dictionary-compressed Zstandard (dcz) content
+dcz_magic = bytes([0x5e, 0x2a, 0x4d, 0x18, 0x20, 0x00, 0x00, 0x00])
+dcz_header_size = len(dcz_magic) + 32 # magic, then SHA-256 of dictionary
+
+# Name of the trained dictionary's file in the data directory
+dictionary_name = "svgs.dict"
+
+class SharedDictionary():
+    """A Zstandard dictionary for WikiPathways SVGs, to compress to and
+    decompress from dcz
+    """
+
+    def __init__(self, content, level=19):
+        self.content = content
+        self.sha256 = hashlib.sha256(content).digest()
+        zstd_dict = zstandard.ZstdCompressionDict(content)
+        self.compressor = zstandard.ZstdCompressor(
+            level=level, dict_data=zstd_dict
+        )
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=zstd_dict)
+
+    def compress(self, svg):
+        """Compress SVG bytes to dcz
+        """
+        return dcz_magic + self.sha256 + self.compressor.compress(svg)
+
+    def is_dictionary_for(self, dcz):
+        """Whether dcz content was compressed with this dictionary
+        """
+        return dcz[:dcz_header_size] == dcz_magic + self.sha256
+
+    def decompress(self, dcz):
+        """Decompress dcz content to SVG bytes
+        """
+        if not dcz.startswith(dcz_magic):
+            raise ValueError("Not dictionary-compressed Zstandard (dcz)")
+        if not self.is_dictionary_for(dcz):
+            raise ValueError("Compressed with a different dictionary")
+        return self.decompressor.decompress(dcz[dcz_header_size:])
+
+def train_dictionary(svgs, size=112640, sample_size=16384):
+    """Train a Zstandard dictionary on SVG bytes, and get its content
+
+    Samples are the first `sample_size` bytes of each SVG, where the shared
+    styles and definitions are.  That trains in seconds, rather than the
+    many minutes that whole files take.
+    """
+    samples = [svg[:sample_size] for svg in svgs]
+    zstd_dict = zstandard.train_dictionary(
+        size, samples, k=1024, d=8, level=19, threads=-1
+    )
+    return zstd_dict.as_bytes()
+
+def load_dictionary(dictionary_path):
+    """Load a trained dictionary from a file
+    """
+    with open(dictionary_path, "rb") as f:
+        return SharedDictionary(f.read())
+
+def decompress_svg(dcz_path, dictionary):
+    """Read a dictionary-compressed SVG file, and get its SVG markup
+
+    `dictionary` is a `SharedDictionary`, or a path to a trained dictionary.
+    """
+    if isinstance(dictionary, str):
+        dictionary = load_dictionary(dictionary)
+    with open(dcz_path, "rb") as f:
+        return dictionary.decompress(f.read()).decode("utf-8")
+
+def get_svg_paths(data_dir):
+    """Get paths of pathways' SVG files in a directory, e.g. data/WP554.svg
+    """
+    return sorted(
+        path for path in glob.glob(data_dir + "WP*.svg")
+        if wikipathways.pathway_svg_name_regex.fullmatch(
+            os.path.basename(path)
+        )
+    )
+
+def read_svgs(data_dir):
+    """Read pathways' SVG files in a directory, as a dict of bytes by path
+    """
+    svgs = {}
+    for path in get_svg_paths(data_dir):
+        with open(path, "rb") as f:
+            svgs[path] = f.read()
+    return svgs
+
+def is_current(dcz_path, svg_path, dictionary):
+    """Whether a dcz file is newer than its SVG, and from this dictionary
+    """
+    if not os.path.exists(dcz_path):
+        return False
+    if os.path.getmtime(dcz_path) < os.path.getmtime(svg_path):
+        return False
+    with open(dcz_path, "rb") as f:
+        return dictionary.is_dictionary_for(f.read(dcz_header_size))
+
+def compress_svgs(data_dir, dictionary):
+    """Write a dcz variant beside each pathway's SVG in a directory, unless
+    current
+    """
+    num_compressed = 0
+    for svg_path in get_svg_paths(data_dir):
+        dcz_path = svg_path + ".dcz"
+        if is_current(dcz_path, svg_path, dictionary):
+            continue
+        with open(svg_path, "rb") as f:
+            dcz = dictionary.compress(f.read())
+        wikipathways.write_atomically(dcz_path, dcz)
+        num_compressed += 1
+    print(f"Compressed {num_compressed} SVGs with shared dictionary")
+
+def measure(svgs):
+    """Print total compressed sizes with and without a shared dictionary
+
+    The dictionary is trained on four fifths of the SVGs, and sizes are for
+    the other fifth, so they estimate what new pathways would get.
+    """
+    paths = list(svgs)
+    train_paths = [path for i, path in enumerate(paths) if i % 5 != 0]
+    test_paths = [path for i, path in enumerate(paths) if i % 5 == 0]
+    dictionary = SharedDictionary(
+        train_dictionary([svgs[path] for path in train_paths])
+    )
+    compressor = zstandard.ZstdCompressor(level=19)
+
+    codecs = {
+        "raw": lambda svg: svg,
+        "gzip": lambda svg: gzip.compress(svg, compresslevel=9, mtime=0),
+        "brotli": lambda svg: brotli.compress(
+            svg, mode=brotli.MODE_TEXT, quality=11, lgwin=24
+        ),
+        "zstd": compressor.compress,
+        "zstd+dict": dictionary.compress,
+    }
+    buckets = [
+        ("< 8 KB", 0, 8000),
+        ("8-64 KB", 8000, 64000),
+        (">= 64 KB", 64000, float("inf")),
+        ("all", 0, float("inf")),
+    ]
+
+    sizes_by_path = {}
+    for path in test_paths:
+        svg = svgs[path]
+        sizes_by_path[path] = {
+            name: len(codec(svg)) for name, codec in codecs.items()
+        }
+
+    print(
+        f"Held-out {len(test_paths)} of {len(paths)} SVGs, dictionary of " +
+        f"{len(dictionary.content)} bytes trained on the rest"
+    )
+    print(
+        f'{"size":<10}{"svgs":>6}' +
+        "".join(f"{name:>12}" for name in codecs) +
+        f'{"vs. gzip":>10}{"vs. brotli":>12}'
+    )
+    for label, low, high in buckets:
+        bucket = [
+            sizes for sizes in sizes_by_path.values()
+            if low <= sizes["raw"] < high
+        ]
+        if len(bucket) == 0:
+            continue
+        totals = {
+            name: sum(sizes[name] for sizes in bucket) for name in codecs
+        }
+        vs_gzip = totals["zstd+dict"] / totals["gzip"] - 1
+        vs_brotli = totals["zstd+dict"] / totals["brotli"] - 1
+        print(
+            f"{label:<10}{len(bucket):>6}" +
+            "".join(f"{totals[name]:>12}" for name in codecs) +
+            f"{vs_gzip:>10.1%}{vs_brotli:>12.1%}"
+        )
+
+# Command-line handler
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "action",
+        help=(
+            "Train a dictionary on the SVGs, compress the SVGs with it, " +
+            "or measure bytes saved by it"
+        ),
+        choices=["train", "compress", "measure"]
+    )
+    parser.add_argument(
+        "--data-dir",
+        help=(
+            "Directory of optimized SVGs.  (default: %(default)s)"
+        ),
+        default="data/"
+    )
+    parser.add_argument(
+        "--dictionary",
+        help=(
+            "Path of the trained dictionary.  " +
+            f"(default: DATA_DIR/{dictionary_name})"
+        )
+    )
+    args = parser.parse_args()
+    data_dir = os.path.join(args.data_dir, "")
+    dictionary_path = args.dictionary or data_dir + dictionary_name
+
+    if args.action == "train":
+        svgs = read_svgs(data_dir)
+        content = train_dictionary(list(svgs.values()))
+        wikipathways.write_atomically(dictionary_path, content)
+        print(f"Trained dictionary on {len(svgs)} SVGs: {dictionary_path}")
+    elif args.action == "compress":
+        compress_svgs(data_dir, load_dictionary(dictionary_path))
+    elif args.action == "measure":
+        measure(read_svgs(data_dir))
@@ -1,33 +1,38 @@
 import argparse
+from collections import Counter
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+)
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
 import glob
+import gzip
+import hashlib
+import html
 import io
+import json
+import math
+import mmap
 import os
+import queue
 import re
-import ssl
-from time import sleep
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+from time import monotonic, perf_counter, process_time, sleep, time
 import zipfile
+import zlib
 
-from selenium import webdriver
-# from selenium.webdriver.common.keys import Keys
-from webdriver_manager.chrome import ChromeDriverManager
-
-import requests
+import brotli
 from lxml import etree
-from scour import scour
-
-# Scour removes certain style attributes if their value is the
-# SVG-defined default.  However, this module sets certain style
-# attributes in doc-level CSS, which overrides the browser default.
-# E.g. this module sets `text-anchor` to default to `middle`, but
-# browser defaults it to `start` and thus Scour removes it.
-# Without having the attribute, this module can't account for
-# non-module-default attributes in `hoist_style`; so ensures such
-# attributes aren't removed by Scour.
-#
-# TODO: Other props defined in `style` in
-# `custom_lossless_optimize_svg` might be susceptible to the issue
-# described above.  Consider checking more thoroughly.
-del scour.default_properties['text-anchor']
+
+# Selenium, webdriver-manager, Requests, NumPy, Scour and multiprocessing took
+# most of the time to import this module, and each is only needed by some
+# commands, e.g. only fetching needs Requests and only optimizing needs Scour.
+# So they're imported where they're used, and `optimize` and its worker
+# processes start without loading a browser driver or HTTP stack.
 
 # # Enable importing local modules when directly calling as script
 # if __name__ == "__main__":
@@ -36,10 +41,6 @@ del scour.default_properties['text-anchor']
 
 # from lib import download_gzip
 
-ctx = ssl.create_default_context()
-ctx.check_hostname = False
-ctx.verify_mode = ssl.CERT_NONE
-
 # Organisms configured for WikiPathways caching
 organisms = [
     "Homo sapiens",
@@ -61,82 +62,266 @@ def get_svg_zip_url(organism):
     url = f"{base}wikipathways-{date}-svg-{org_us}.zip"
     return url
 
-def get_pathway_ids_and_names(organism):
-    base_url = "https://webservice.wikipathways.org/listPathways"
-    params = f"?organism={organism}&format=json"
-    url = base_url + params
-    response = requests.get(url)
-    data = response.json()
-
-    ids_and_names = [[pw['id'], pw['name']] for pw in data['pathways']]
-    return ids_and_names
+pathway_url_template = (
+    "https://www.wikipathways.org/index.php/Pathway:{id}?view=widget"
+)
 
-def unwrap_leaf(tree, has_bloat, leaf=None, selector=None):
-    """Helper for `unwrap` function
+def get_session(pool_size=1):
+    """Get an HTTP session that reuses up to `pool_size` connections per host
     """
-    ns_map = {"svg": "http://www.w3.org/2000/svg"}
-    if not selector:
-        selector = f"//svg:g[{has_bloat}]/svg:g[{has_bloat}]/svg:" + leaf
-    elements = tree.xpath(selector, namespaces=ns_map)
-    for element in elements:
-        parent = element.getparent()
-        grandparent = parent.getparent()
-        grandparent.replace(parent, element)
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+list_pathways_url = "https://webservice.wikipathways.org/listPathways"
 
-def get_has_class_clause(raw_class):
-    """Enable typical class selectors in XPath, akin to CSS ".foo"
+# Statuses of responses worth retrying, as the server may soon recover
+retry_statuses = [429, 500, 502, 503, 504]
 
-    XPath makes it complicated to detect if a string is among class values.
-    That functionality is typical for class selectors, so tailor syntax to
-    ease such common queries.
+class PathwayListClient():
+    """Get lists of pathways from the WikiPathways webservice, cached on disk
+
+    Cached lists younger than `ttl` seconds are used as is.  Older ones are
+    revalidated by ETag or Last-Modified, so an unchanged list isn't
+    downloaded again.  Failed requests are retried with exponential backoff,
+    then fall back to any cached list, however old.  Point `url` at a local
+    server to test.
     """
-    normed_class = "concat(' ', normalize-space(@class), ' ')"
-    has_class_clause = 'contains(' + normed_class + ', "' + raw_class + '")'
-    return has_class_clause
 
-def unwrap(tree):
-    """Many elements are extraneously wrapped; this pares them
+    def __init__(
+        self, cache_dir="tmp/", session=None, url=list_pathways_url,
+        ttl=24 * 60 * 60, retries=4, backoff=1, timeout=30
+    ):
+        self.cache_dir = cache_dir
+        self.session = session or get_session()
+        self.url = url
+        self.ttl = ttl
+        self.retries = retries
+        self.backoff = backoff # seconds before first retry, then doubling
+        self.timeout = timeout # seconds
+
+    def get_cache_path(self, organism):
+        slug = organism.lower().replace(" ", "-")
+        return self.cache_dir + "pathways-" + slug + ".json"
+
+    def request(self, params, headers):
+        """Get a response from the webservice, retrying transient errors
+        """
+        import requests
+
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt
+            try:
+                response = self.session.get(
+                    self.url, params=params, headers=headers,
+                    timeout=self.timeout
+                )
+                if response.status_code not in retry_statuses:
+                    response.raise_for_status()
+                    return response
+                error = f"HTTP {response.status_code}"
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = repr(e)
+
+            if attempt < self.retries:
+                print(f"Retrying {self.url} in {delay} s, after {error}")
+                sleep(delay)
+        raise requests.RequestException(f"Failed to get {self.url}: {error}")
+
+    def get_pathways(self, organism):
+        """Get the webservice's list of pathways for an organism
+        """
+        import requests
+
+        cache_path = self.get_cache_path(organism)
+        cached = None
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if time() - cached["fetched_at"] < self.ttl:
+                print(f"Found cache; using pathway list in {cache_path}")
+                return cached["data"]["pathways"]
+
+        headers = {}
+        if cached and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        params = {"organism": organism, "format": "json"}
+        try:
+            response = self.request(params, headers)
+        except requests.RequestException:
+            if cached is None:
+                raise
+            print(f"Failed to revalidate; using stale {cache_path}")
+            return cached["data"]["pathways"]
+
+        if response.status_code == 304:
+            print(f"Found unchanged pathway list; using {cache_path}")
+            data = cached["data"]
+        else:
+            data = response.json()
+
+        # Servers may omit validators from a 304, so keep those cached
+        validators = cached or {"etag": None, "last_modified": None}
+        write_atomically(cache_path, json.dumps({
+            "fetched_at": time(),
+            "etag": response.headers.get("ETag", validators["etag"]),
+            "last_modified": response.headers.get(
+                "Last-Modified", validators["last_modified"]
+            ),
+            "data": data
+        }))
+        return data["pathways"]
+
+def get_pathway_ids_and_names(organism, client=None):
+    """Get IDs and names of an organism's pathways, via a `PathwayListClient`
     """
-    ns_map = {"svg": "http://www.w3.org/2000/svg"}
+    client = client or PathwayListClient()
+    pathways = client.get_pathways(organism)
 
-    # XPath has poor support for typical class attributes,
-    # so tailor syntax accordingly
-    wrapped = [
-        "Protein", "Metabolite", "Rna", "Label", "GeneProduct", "Unknown"
-    ]
-    all_wrapped = " or ".join([
-        get_has_class_clause(w) for w in wrapped
-    ])
+    ids_and_names = [[pw['id'], pw['name']] for pw in pathways]
+    return ids_and_names
 
-    unwrap_leaf(tree, all_wrapped, "rect")
-    unwrap_leaf(tree, all_wrapped, "use")
+svg_ns = "{http://www.w3.org/2000/svg}"
+
+# Classes of groups that extraneously wrap their content
+wrapped_classes = [
+    "Protein", "Metabolite", "Rna", "Label", "GeneProduct", "Unknown"
+]
+
+def is_wrapper(element):
+    """Whether an element is a group that `unwrap` pares, by its class
+    """
+    if element is None or element.tag != svg_ns + "g":
+        return False
+    class_name = element.get("class", "")
+    return any(wrapped in class_name for wrapped in wrapped_classes)
+
+def is_attached(element, root):
+    """Whether an element is still in the tree, i.e. no pass has removed it
+    or an ancestor
+    """
+    while element is not None:
+        if element is root:
+            return True
+        element = element.getparent()
+    return False
+
+def get_elements_by_role(tree):
+    """Sort elements into the groups that DOM passes act on, in one traversal
+
+    Each element is dispatched to a visitor for its tag, which replaces an
+    XPath query per pass.  Elements of each role are in document order, as
+    such queries would return them.
+    """
+    roles = [
+        "groups", "group_uses", "uses", "rects", "texts", "edge_paths",
+        "markers", "symbols", "symbol_children", "clip_paths", "gradients",
+        "wrapped_rects", "wrapped_uses", "wrapped_texts",
+    ]
+    elements = {role: [] for role in roles}
+
+    def is_group(element):
+        return element is not None and element.tag == svg_ns + "g"
+
+    def visit_group(element, parent):
+        elements["groups"].append(element)
+
+    def visit_use(element, parent):
+        elements["uses"].append(element)
+        if is_group(parent):
+            elements["group_uses"].append(element)
+            if is_wrapper(parent) and is_wrapper(parent.getparent()):
+                elements["wrapped_uses"].append(element)
+
+    def visit_rect(element, parent):
+        elements["rects"].append(element)
+        if is_wrapper(parent) and is_wrapper(parent.getparent()):
+            elements["wrapped_rects"].append(element)
+
+    def visit_text(element, parent):
+        elements["texts"].append(element)
+        if is_group(parent) and is_wrapper(parent.getparent()):
+            elements["wrapped_texts"].append(element)
+
+    def visit_path(element, parent):
+        if is_group(parent) and "Edge" in parent.get("class", ""):
+            elements["edge_paths"].append(element)
+
+    def visit_marker(element, parent):
+        if is_group(parent) and parent.get("id") == "marker-defs":
+            elements["markers"].append(element)
+
+    def visit_symbol(element, parent):
+        elements["symbols"].append(element)
+
+    def visit_clip_path(element, parent):
+        elements["clip_paths"].append(element)
+
+    def visit_gradient(element, parent):
+        elements["gradients"].append(element)
+
+    visitors = {
+        svg_ns + "g": visit_group,
+        svg_ns + "use": visit_use,
+        svg_ns + "rect": visit_rect,
+        svg_ns + "text": visit_text,
+        svg_ns + "path": visit_path,
+        svg_ns + "marker": visit_marker,
+        svg_ns + "symbol": visit_symbol,
+        svg_ns + "clipPath": visit_clip_path,
+        svg_ns + "linearGradient": visit_gradient,
+        svg_ns + "radialGradient": visit_gradient,
+    }
 
-    text_sel = f"//svg:g[{all_wrapped}]/svg:g/svg:text"
-    unwrap_leaf(tree, all_wrapped, selector=text_sel)
+    for element in tree.iter(etree.Element):
+        parent = element.getparent()
+        if parent is not None and parent.tag == svg_ns + "symbol":
+            elements["symbol_children"].append(element)
+        visitor = visitors.get(element.tag)
+        if visitor:
+            visitor(element, parent)
 
-    # bloat_groups = ["GroupGroup", "GroupComplex", "GroupNone"]
-    # has_bloats = " or ".join([
-    #     'contains(' + normed_class + ', "' + b + '")' for b in bloat_groups
-    # ])
-    # group_child_sel = f"//svg:g[{has_bloats}]/svg:g[{has_bloats}]/*"
-    # unwrap_leaf(tree, has_bloats, selector=group_child_sel)
+    return elements
 
-    return tree
+def unwrap(elements, root):
+    """Many elements are extraneously wrapped; this pares them
+    """
+    # Replace wrapping groups with the rect, use or text they wrap, in that
+    # order.  Skip elements no longer in the tree, e.g. as an earlier
+    # replacement dropped their wrapper.
+    for role in ["wrapped_rects", "wrapped_uses", "wrapped_texts"]:
+        for element in elements[role]:
+            if not is_attached(element, root):
+                continue
+            parent = element.getparent()
+            grandparent = parent.getparent()
+            grandparent.replace(parent, element)
 
-def remove_extra_tspans(tree):
-    ns_map = {"svg": "http://www.w3.org/2000/svg"}
-    sizes = []
+def remove_extra_tspans(texts, root):
+    sizes = Counter()
 
-    texts = tree.xpath("//svg:text", namespaces=ns_map)
-    # print('text_sel', text_sel)
     for text in texts:
+        if not is_attached(text, root):
+            continue
         # print('text', etree.tostring(text))
-        tspans = text.xpath('svg:tspan', namespaces=ns_map)
+        tspans = [child for child in text if child.tag == svg_ns + "tspan"]
         if len(tspans) == 1:
             tspan = tspans[0]
             content = tspan.text
             font_size = tspan.attrib["font-size"]
-            sizes.append(font_size)
+            sizes[font_size] += 1
             # print('content', content)
             text.attrib["font-size"] = font_size
             text.remove(tspan)
@@ -144,119 +329,331 @@ def remove_extra_tspans(tree):
 
     default_font_size = None
     if len(sizes) > 0:
-        default_font_size = max(sizes, key = sizes.count)
+        # Ties go to the size seen first
+        default_font_size = sizes.most_common(1)[0][0]
 
-    return tree, default_font_size
+    return default_font_size
 
-def trim_markers(tree):
-    """Remove unused marker elements from diagram
+# E.g. url(#foo), url('#foo') or url(&quot;#foo&quot;) -> foo
+url_reference_regex = re.compile(r"""url\(\s*(?:['"]|&quot;)?#([^'"&)\s]+)""")
+
+# E.g. href="#foo" or xlink:href="#foo" -> foo
+href_reference_regex = re.compile(r'href="#([^"]*)"')
+
+def get_references(svg):
+    """Index IDs referenced in SVG markup, in one pass over its text
+
+    Returns a set of IDs referenced by `url(#...)`, in attributes or CSS, or
+    by `href="#..."` or `xlink:href="#..."`.
     """
-    ns_map = {"svg": "http://www.w3.org/2000/svg"}
+    references = set(url_reference_regex.findall(svg))
+    references.update(href_reference_regex.findall(svg))
+    return references
 
-    used_marker_ids = []
+def get_markup_size(elements):
+    """Get size in bytes of elements' markup, without namespace declarations
+    """
+    size = 0
+    for element in elements:
+        markup = etree.tostring(element, with_tail=False)
+        size += len(re.sub(rb' xmlns(:\w+)?="[^"]*"', b'', markup))
+    return size
 
-    # Identify markers that the diagram actually uses
-    elements = tree.xpath("//*")
+def remove_unreferenced(elements, references):
+    """Remove elements whose ID isn't referenced; return those removed
+    """
+    removed = []
     for element in elements:
-        attrs = element.attrib
-        start = attrs["marker-start"] if "marker-start" in attrs else ""
-        start = start.replace("url(#", "").replace(")", "")
-        end = attrs["marker-end"] if "marker-end" in attrs else ""
-        end = end.replace("url(#", "").replace(")", "")
-        if start not in used_marker_ids:
-            used_marker_ids.append(start)
-        if end not in used_marker_ids:
-            used_marker_ids.append(end)
-
-    # Remove markers that are not used
-    markers = tree.xpath('//svg:g[@id="marker-defs"]/svg:marker', namespaces=ns_map)
-    for marker in markers:
-        attrs = marker.attrib
-        id = attrs["id"] if "id" in attrs else ""
-        if id not in used_marker_ids:
-            marker.getparent().remove(marker)
+        if element.get("id") not in references:
+            element.getparent().remove(element)
+            removed.append(element)
+    return removed
 
-    return tree
+def trim_markers(markers, references):
+    """Remove unused marker elements from diagram
+    """
+    return remove_unreferenced(markers, references)
 
-def condense_colors(svg):
-    """Condense colors by using hexadecimal abbreviations where possible.
-    Consider using an abstract, general approach instead of hard-coding.
-    """
-    svg = re.sub('#000000', '#000', svg)
-    svg = re.sub('#ff0000', '#f00', svg)
-    svg = re.sub('#00ff00', '#0f0', svg)
-    svg = re.sub('#0000ff', '#00f', svg)
-    svg = re.sub('#00ffff', '#0ff', svg)
-    svg = re.sub('#ff00ff', '#f0f', svg)
-    svg = re.sub('#ffff00', '#ff0', svg)
-    svg = re.sub('#ffffff', '#fff', svg)
-    svg = re.sub('#cc0000', '#c00', svg)
-    svg = re.sub('#00cc00', '#0c0', svg)
-    svg = re.sub('#0000cc', '#00c', svg)
-    svg = re.sub('#00cccc', '#0cc', svg)
-    svg = re.sub('#cc00cc', '#c0c', svg)
-    svg = re.sub('#cccc00', '#cc0', svg)
-    svg = re.sub('#cccccc', '#ccc', svg)
-    svg = re.sub('#999999', '#999', svg)
-    svg = re.sub('#808080', 'grey', svg)
+def trim_clip_paths_and_gradients(elements, references):
+    """Remove clip paths and gradients that nothing references
+    """
+    removed_clip_paths = remove_unreferenced(elements["clip_paths"], references)
+    removed_gradients = remove_unreferenced(elements["gradients"], references)
+    return removed_clip_paths, removed_gradients
 
-    return svg
+# Characters that make a rule pattern a regular expression, not a literal
+regex_metachars = set(".^$*+?{}[]\\|()")
 
-def prep_edge_style_hoist(tree):
-    ns_map = {"svg": "http://www.w3.org/2000/svg"}
-    edge_class = get_has_class_clause("Edge")
-    selector = '//svg:g[' + edge_class + ']/svg:path'
-    elements = tree.xpath(selector, namespaces=ns_map)
-    defaults_by_prop = {
-        "fill": "transparent",
-        "stroke": "#000",
-        "marker-end": "url(#markerendarrow000000white)"
-    }
-    noneable_props = ["marker-end"]
+def is_literal_rule(rule):
+    """Whether a rewrite rule replaces a plain string with a plain string
+    """
+    pattern, replacement = rule
+    return (
+        pattern != "" and
+        isinstance(replacement, str) and
+        not any(c in regex_metachars for c in pattern) and
+        "\\" not in replacement
+    )
 
-    return elements, defaults_by_prop, noneable_props
+def can_overlap(a, b):
+    """Whether an occurrence of string `b` can overlap one of string `a`
 
-def prep_rect_style_hoist(tree):
-    ns_map = {"svg": "http://www.w3.org/2000/svg"}
-    selector = '//svg:rect'
-    elements = tree.xpath(selector, namespaces=ns_map)
-    defaults_by_prop = {
-        "fill": "#fff",
-        "stroke": "#000"
-    }
-    noneable_props = ["stroke"]
-
-    return elements, defaults_by_prop, noneable_props
-
-def prep_text_style_hoist(tree, defaults):
-    ns_map = {"svg": "http://www.w3.org/2000/svg"}
-    selector = '//svg:text'
-    elements = tree.xpath(selector, namespaces=ns_map)
-    defaults_by_prop = {
-        "fill": "#000",
-        "text-anchor": "middle",
-        # "font-weight": "normal"
-    }
-    if 'text' in defaults:
-        defaults_by_prop.update(defaults['text'])
-    noneable_props = []
-
-    return elements, defaults_by_prop, noneable_props
-
-def prep_metabolite_rect_style_hoist(tree):
-    ns_map = {"svg": "http://www.w3.org/2000/svg"}
-    has_class_clause = get_has_class_clause("Metabolite")
-    selector = f"//svg:g[{has_class_clause}]/rect"
-    elements = tree.xpath(selector, namespaces=ns_map)
-    defaults_by_prop = {
-        "stroke": "#00f"
-    }
-    noneable_props = []
+    The trivial overlap of a string with itself at the same position is not
+    counted, so `can_overlap("ab", "ab")` is False but `can_overlap("aa",
+    "aa")` is True.
+    """
+    for offset in range(1 - len(b), len(a)):
+        if a == b and offset == 0:
+            continue
+        start = max(offset, 0)
+        end = min(offset + len(b), len(a))
+        if a[start:end] == b[start - offset:end - offset]:
+            return True
+    return False
+
+def can_share_pass(group, rule):
+    """Whether a literal rule can join a group of literal rules in one pass
+
+    Merging is safe when no two patterns can overlap in text, and no
+    replacement contains a pattern.  Replacements can still create new
+    matches together with surrounding text; `apply_literal_group` detects
+    that at runtime.
+
+    Patterns must also share a first character.  Python's `re` only does
+    fast substring search for a literal prefix, so alternations without one
+    are slower than several `str.replace` calls.
+    """
+    pattern, replacement = rule
+    if pattern[0] != group[0][0][0] or can_overlap(pattern, pattern):
+        return False
+    for other_pattern, other_replacement in group:
+        if (
+            can_overlap(other_pattern, pattern) or
+            pattern in other_replacement or
+            other_pattern in replacement
+        ):
+            return False
+    return True
+
+def get_trie_pattern(words):
+    """Get a regex matching any of `words`, structured as a trie
+
+    Trie-shaped regexes avoid retrying shared prefixes for each alternative.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def get_node_pattern(node):
+        branches = [
+            re.escape(char) + get_node_pattern(child)
+            for char, child in node.items() if char != ""
+        ]
+        if len(branches) == 0:
+            return ""
+        if len(branches) == 1 and "" not in node:
+            return branches[0]
+        pattern = "(?:" + "|".join(branches) + ")"
+        return pattern + "?" if "" in node else pattern
+
+    return get_node_pattern(trie)
+
+def compile_rule(rule):
+    """Compile a rewrite rule into a pass; literal rules use `str.replace`
+    """
+    pattern, replacement = rule
+    if is_literal_rule(rule):
+        return pattern, replacement
+    return re.compile(pattern), replacement
+
+def compile_rules(rules):
+    """Compile a table of (pattern, replacement) rewrite rules into passes
+
+    Rules apply in order, as if by successive `re.sub` calls.  Runs of
+    mutually independent literal rules are merged into one pass over the
+    text; other rules each get their own pass, using `str.replace` for
+    literal rules.
+    """
+    groups = []
+    for rule in rules:
+        if (
+            is_literal_rule(rule) and len(groups) > 0 and
+            is_literal_rule(groups[-1][0]) and
+            can_share_pass(groups[-1], rule)
+        ):
+            groups[-1].append(rule)
+        else:
+            groups.append([rule])
+
+    passes = []
+    for group in groups:
+        sequential_passes = [compile_rule(rule) for rule in group]
+        if len(group) == 1:
+            passes.append(sequential_passes[0])
+            continue
+        patterns = [pattern for pattern, replacement in group]
+        group_pass = {
+            "regex": re.compile(get_trie_pattern(patterns)),
+            "replacements": dict(group),
+            "max_length": max([len(pattern) for pattern in patterns]),
+            "sequential_passes": sequential_passes
+        }
+        passes.append(group_pass)
+
+    return passes
+
+def apply_literal_group(group_pass, svg):
+    """Apply a merged pass of literal rules, as if applied one by one
+
+    Replacing one pattern could join surrounding text into a match for a later
+    pattern, which successive `re.sub` calls would then replace.  Any such
+    match must span a replacement site, so only those neighborhoods are
+    checked.  In the rare case one is found, fall back to sequential passes.
+    """
+    regex = group_pass["regex"]
+    replacements = group_pass["replacements"]
+
+    sites = []
+    shift = 0
+
+    def replace(match):
+        nonlocal shift
+        text = match.group()
+        replacement = replacements[text]
+        start = match.start() + shift
+        shift += len(replacement) - len(text)
+        sites.append((start, start + len(replacement)))
+        return replacement
+
+    new_svg = regex.sub(replace, svg)
+
+    reach = group_pass["max_length"] - 1
+    window_start, window_end = None, None
+    windows = []
+    for start, end in sites:
+        if window_end is not None and start - reach <= window_end:
+            window_end = end + reach
+        else:
+            if window_end is not None:
+                windows.append((window_start, window_end))
+            window_start, window_end = max(start - reach, 0), end + reach
+    if window_end is not None:
+        windows.append((window_start, window_end))
+
+    for window_start, window_end in windows:
+        if regex.search(new_svg, window_start, window_end):
+            return apply_rules(group_pass["sequential_passes"], svg)
+
+    return new_svg
 
-    return elements, defaults_by_prop, noneable_props
+def apply_rules(passes, svg):
+    """Rewrite SVG text with rules compiled by `compile_rules`
+    """
+    for rewrite_pass in passes:
+        if isinstance(rewrite_pass, dict):
+            svg = apply_literal_group(rewrite_pass, svg)
+            continue
+        pattern, replacement = rewrite_pass
+        if isinstance(pattern, str):
+            svg = svg.replace(pattern, replacement)
+        else:
+            svg = pattern.sub(replacement, svg)
+    return svg
 
+@lru_cache(maxsize=None)
+def import_scour():
+    """Import Scour, and adjust it for this module, on first use
+    """
+    from scour import scour
+
+    # Scour removes certain style attributes if their value is the
+    # SVG-defined default.  However, this module sets certain style
+    # attributes in doc-level CSS, which overrides the browser default.
+    # E.g. this module sets `text-anchor` to default to `middle`, but
+    # browser defaults it to `start` and thus Scour removes it.
+    # Without having the attribute, this module can't account for
+    # non-module-default attributes in `hoist_style`; so ensures such
+    # attributes aren't removed by Scour.
+    #
+    # TODO: Other props defined in `style` in
+    # `custom_lossless_optimize_svg` might be susceptible to the issue
+    # described above.  Consider checking more thoroughly.
+    #
+    # Organisms' threads may both get here first, so this is idempotent.
+    scour.default_properties.pop('text-anchor', None)
+    return scour
+
+# A 6-digit hexadecimal color, not part of a longer name
+color_regex = re.compile(r"#([0-9a-fA-F]{6})(?![\w-])")
+
+@lru_cache(maxsize=None)
+def get_color_names():
+    """Get the shortest keyword for each color that has one
+
+    Keywords come from Scour's table of SVG colors, keyed here by 6-digit
+    hexadecimal color.  Of keywords that tie, e.g. gray and grey, the last in
+    alphabetical order is kept.
+    """
+    color_names = {}
+    for name, rgb in sorted(import_scour().colors.items()):
+        channels = re.findall(r"\d+", rgb)
+        hex_color = "".join(f"{int(channel):02x}" for channel in channels)
+        if len(name) <= len(color_names.get(hex_color, name)):
+            color_names[hex_color] = name
+    return color_names
+
+@lru_cache(maxsize=None)
+def shorten_color(hex_color, prefix="#"):
+    """Get the shortest form of a 6-digit hexadecimal color
+
+    E.g. ffcc00 -> #fc0, a52a2a -> brown.  `prefix` precedes digits, as "#"
+    does in markup; marker IDs have none.
+    """
+    hex_color = hex_color.lower()
+    if hex_color[0::2] == hex_color[1::2]:
+        short_color = prefix + hex_color[0::2]
+    else:
+        short_color = prefix + hex_color
+    name = get_color_names().get(hex_color, short_color)
+    return name if len(name) < len(short_color) else short_color
 
-def hoist_style(tree, defaults):
+def condense_colors(svg):
+    """Condense hexadecimal colors to abbreviations or keywords where shorter
+    """
+    return color_regex.sub(lambda match: shorten_color(match.group(1)), svg)
+
+# Default styles hoisted to the `style` tag, and styles that need an explicit
+# "none" when absent, by role of the elements that have them
+hoisted_styles = {
+    "edge_paths": (
+        {
+            "fill": "transparent",
+            "stroke": "#000",
+            "marker-end": "url(#markerendarrow000000white)"
+        },
+        ["marker-end"]
+    ),
+    "rects": (
+        {
+            "fill": "#fff",
+            "stroke": "#000"
+        },
+        ["stroke"]
+    ),
+    "texts": (
+        {
+            "fill": "#000",
+            "text-anchor": "middle",
+            # "font-weight": "normal"
+        },
+        []
+    ),
+}
+
+def hoist_style(elements, defaults):
     """Move default styles from elements to `style` tag
 
     The raw diagram's styles are encoded as attributes on every element.
@@ -267,21 +664,12 @@ def hoist_style(tree, defaults):
 
     [1] https://developer.mozilla.org/en-US/docs/Web/CSS/Specificity
     """
-    ns_map = {"svg": "http://www.w3.org/2000/svg"}
+    for role in hoisted_styles:
+        defaults_by_prop, noneable_props = hoisted_styles[role]
+        if role == 'texts' and 'text' in defaults:
+            defaults_by_prop = {**defaults_by_prop, **defaults['text']}
 
-    for name in ['metabolite_rect', 'edge', 'rect', 'text']:
-        if name == 'edge':
-            e, d, n = prep_edge_style_hoist(tree)
-        elif name == 'rect':
-            e, d, n = prep_rect_style_hoist(tree)
-        elif name == 'text':
-            e, d, n = prep_text_style_hoist(tree, defaults)
-        elif name == 'metabolite_rect':
-            e, d, n = prep_metabolite_rect_style_hoist(tree)
-
-        elements, defaults_by_prop, noneable_props = [e, d, n]
-
-        for element in elements:
+        for element in elements[role]:
             attrs = element.attrib
             styles = []
 
@@ -309,44 +697,28 @@ def hoist_style(tree, defaults):
             if len(styles) > 0:
                 element.attrib['style'] = ";".join(styles)
 
-    return tree
 
-
-def trim_symbols_and_uses_and_groups(tree):
-    ns_map = {"svg": "http://www.w3.org/2000/svg"}
+def trim_symbols_and_uses_and_groups(elements, references):
     # Remove unused color attribute in group elements
-    groups = tree.xpath("//svg:g", namespaces=ns_map)
-    for group in groups:
+    for group in elements["groups"]:
         if 'color' in group.attrib:
             del group.attrib['color']
 
-    used_symbols = []
-    group_uses = tree.xpath("//svg:g/svg:use", namespaces=ns_map)
-    for group_use in group_uses:
-        if group_use.attrib["href"] and group_use.attrib["href"] != "#none":
-            # E.g. href="#foo" -> foo
-            used_symbols.append(group_use.attrib["href"][1:])
-        else:
+    for group_use in elements["group_uses"]:
+        if not group_use.attrib["href"] or group_use.attrib["href"] == "#none":
             group_use.getparent().remove(group_use)
 
-    symbols = tree.xpath("//svg:symbol", namespaces=ns_map)
-    for symbol in symbols:
-        id = symbol.attrib["id"]
-        if id not in used_symbols or id == 'none':
-            symbol.getparent().remove(symbol)
+    references = references - {"none"}
+    removed = remove_unreferenced(elements["symbols"], references)
 
-    symbol_children = tree.xpath("//svg:symbol/*", namespaces=ns_map)
-    for sc in symbol_children:
+    # Children of removed symbols are out of the tree, so editing them is moot
+    for sc in elements["symbol_children"]:
         if "stroke" in sc.attrib and sc.attrib["stroke"] == "currentColor":
             del sc.attrib["stroke"]
 
-    return tree
+    return removed
 
-def trim_transform(tree):
-    ns_map = {"svg": "http://www.w3.org/2000/svg"}
-    rects = tree.xpath("//svg:rect", namespaces=ns_map)
-    uses = tree.xpath("//svg:use", namespaces=ns_map)
-    elements = rects + uses
+def trim_transform(elements):
     for element in elements:
         if "transform" in element.attrib:
             matrix = element.attrib["transform"]
@@ -357,40 +729,282 @@ def trim_transform(tree):
             is_significant = any([c > 1.1 for c in coords])
             if not is_significant:
                 del element.attrib["transform"]
-    return tree
 
-def custom_lossless_optimize_svg(svg, pwid):
-    """Losslessly decrease size of WikiPathways SVG
-    """
-    ns_map = {"svg": "http://www.w3.org/2000/svg"}
+font_family = "'Liberation Sans', Arial, sans-serif"
 
-    svg = re.sub(pwid.lower(), '', svg)
-    svg = condense_colors(svg)
+# Font families set in the `style` tag by `custom_lossless_optimize_svg`
+font_family_rules = compile_rules([
+    ('font-family="Arial"', ''),
+    (f'font-family="{font_family}"', ''),
+])
 
-    svg = svg.replace('<?xml version="1.0" encoding="UTF-8"?>\n', '')
-    tree = etree.fromstring(svg)
+# Attribute edits applied after `custom_lossless_optimize_svg` serializes the
+# DOM
+lossless_attribute_rules = [
+    ('xml:space="preserve"', ''),
 
-    controls = tree.xpath('//*[@class="svg-pan-zoom-control"]')[0]
-    tree.remove(controls)
-    controls_style = tree.xpath('//*[@id="svg-pan-zoom-controls-styles"]')[0]
-    controls_style.getparent().remove(controls_style)
+    # Remove "px" from attributes where numbers are assumed to be pixels.
+    (r'width="([0-9.]+)px"', r'width="\1"'),
+    (r'height="([0-9.]+)px"', r'height="\1"'),
+    (r'stroke-width="([0-9.]+)px"', r'stroke-width="\1"'),
 
-    metadata = tree.xpath('//*[@id="' + pwid + '-text"]')[0]
-    metadata.getparent().remove(metadata)
+    ('fill="inherit"', ''),
+    ('stroke-width="inherit"', ''),
+    ('color="inherit"', ''),
 
-    icons_id = "icon-defs-ArcPathVisioBraceEllipseEndoplasmicReticulumGolgiApparatusHexagonPathVisioMimDegradationMitochondriaOctagonPentagonPathVisioRectangleRoundedRectangleSarcoplasmicReticulumTriangleEquilateralEastTrianglePathVisionone"
-    icon_defs = tree.xpath('//*[@id="' + icons_id + '"]')[0]
-    icon_defs.attrib["id"] = "icon-defs"
+    ('fill-opacity="0"', ''),
+    ('dominant-baseline="central"', ''),
+    ('overflow="hidden"', ''),
+
+    # Match any anchor or group tag, up until closing angle bracket (>), that
+    # includes a color attribute with the value black (#000).
+    # For such matches, remove the color attribute but not anything else.
+    (r'<g([^>]*)(color="#000")', r'<g \1'),
 
-    tree = trim_markers(tree)
+    (r'<(rect class="Icon"[^>]*)(color="#000")', r'<\1'),
+    (r'<(rect class="Icon"[^>]*)(fill="#000")', r'<\1'),
 
-    tree = trim_symbols_and_uses_and_groups(tree)
+    (r'<(text class="Text"[^>]*)(fill="#000")', r'<\1'),
+    (r'<(text class="Text"[^>]*)(stroke="white" stroke-width="0")', r'<\1'),
 
-    tree = trim_transform(tree)
+    (r'<(text[^>]*)(clip\-path="[^"]*)"', r'<\1'),
+    # (r'<defs><clipPath.*</defs>', r''),
 
-    tree, default_font_size = remove_extra_tspans(tree)
+    (r'class="([^"]*)( Node)"', r'class="\1"'),
+    (r'class="([^"]*)( textContent)"', r'class="\1"'),
+
+    (r'id="[^"]*-text-clipPath"', ''),
+
+    # Remove class attributes from elements where it can be deduced
+    (r'<rect([^>]*)(class="[^"]*)"', r'<rect \1'),
+    (r'<text([^>]*)(class="[^"]*)"', r'<text \1'),
+    (r'<tspan([^>]*)(class="[^"]*)"', r'<tspan \1'),
+
+    (r'<path([^>]*)(id="[^"]*)"', r'<path \1'),
+    # (r'<path([^>]*)(fill="transparent")', r'<path \1'),
+
+    # ('text-anchor="middle"', ''),
+]
+
+# A marker ID, after its prefix is shortened, e.g. markerendarrow000000white
+# -> mea000000white.  IDs end with the marker's color and its background's.
+marker_id_regex = (
+    r"(mea|mem[a-z]+?|marker[a-z]+?)([0-9a-f]{6})(white|[0-9a-f]{6})\b"
+)
+
+def shorten_marker_id(match):
+    """Shorten the colors in a marker ID, e.g. meaff0000white -> meaf00
+
+    White backgrounds, the norm, are dropped, and other backgrounds kept in
+    full, so distinct IDs stay distinct.  Black arrows on white are "mea".
+    """
+    prefix, color, background = match.groups()
+    color = shorten_color(color, prefix="")
+    background = "" if background == "white" else background
+    if prefix == "mea" and color == "000" and background == "":
+        return "mea"
+    return prefix + color + background
+
+# Shorten marker IDs, and references to them
+marker_id_rules = [
+    (r'markerendarrow', 'mea'),
+    (r'markerendmim', 'mem'),
+    (marker_id_regex, shorten_marker_id),
+]
+
+lossless_id_rules = [
+    (r'id="[^"]*-icon" ', ''),
+    (r'id="[^"]*-text" class="[^"]*"', ''),
+]
+
+# Text rewrites applied after `custom_lossless_optimize_svg` serializes the DOM
+lossless_rules = compile_rules(
+    lossless_attribute_rules +
+    marker_id_rules +
+    lossless_id_rules
+)
+
+# Decimal places kept in coordinates and lengths by `compact_numbers`
+number_precision = 2
+
+# Attributes whose values are only coordinates or lengths
+numeric_attributes = {
+    "d", "points", "transform", "x", "y", "width", "height",
+    "x1", "y1", "x2", "y2", "cx", "cy", "r", "rx", "ry", "stroke-width"
+}
+
+# Attributes with lists of coordinates, where a number needs no separator
+# before it if it starts with "." and the number before it has a "."
+coordinate_list_attributes = {"d", "points"}
+
+# A decimal point and the digits after it.  A pattern that starts with a
+# literal is far faster to scan for, so digits before the point are split off
+# the text before it instead.
+fraction_regex = re.compile(r"\.(\d+)")
+
+# The decimal point and digits of a number with an exponent, e.g. 1.5e-3
+mantissa_regex = re.compile(r"\.\d+(?=[eE][-+]?\d)")
+
+def format_numbers(values, fractions, precision, fixed=False):
+    """Format an array of numbers with `precision` decimal places, in bulk
+
+    `fractions` are the digits after each number's decimal point, to round
+    halves away from zero as decimals, e.g. 1.005 -> 1.01 and 2.675 -> 2.68,
+    though neither is a half as a binary number.  Unless `fixed`, redundant
+    zeros are dropped, e.g. 0.50 -> .5, 2.00 -> 2.
+    """
+    import numpy as np
+
+    if len(values) == 0:
+        return np.array([], dtype=str)
+    # Round on the digit after the last kept one, as most decimals are a bit
+    # off as binary numbers.  Less a half more than that digit, what's after
+    # the kept digits is within a twentieth of zero, and rounds off.
+    lengths = np.array(list(map(len, fractions)))
+    digits = np.frombuffer("".join(fractions).encode(), np.uint8) - ord("0")
+    places = np.cumsum(lengths) - lengths + precision
+    is_long = lengths > precision
+    next_digit = np.where(is_long, digits[np.where(is_long, places, 0)], 0)
+    scale = 10 ** precision
+    kept = np.rint(np.abs(values) * scale - (next_digit + 0.5) / 10)
+    magnitude = kept.astype(np.int64) + (next_digit >= 5)
+    integer = (magnitude // scale).astype(str)
+    if precision > 0:
+        fraction = (magnitude % scale).astype(str)
+        fraction = np.strings.zfill(fraction, precision)
+    else:
+        fraction = np.full(len(values), "")
+    if not fixed:
+        fraction = np.strings.rstrip(fraction, "0")
+        integer = np.where((integer == "0") & (fraction != ""), "", integer)
+    point = np.where(fraction == "", "", ".")
+    sign = np.where((values < 0) & (magnitude > 0), "-", "")
+    return sign + integer + point + fraction
+
+def get_attribute_names(heads):
+    """Get the attribute each number is in, given the text before each
+
+    Numbers in text, outside tags, get None.
+    """
+    names = []
+    name = None
+    for head in heads:
+        # Text with neither starts nor ends a value, e.g. " " in "1.5 2.5"
+        if '"' in head or ">" in head:
+            value_start = head.rfind('="')
+            if value_start > head.rfind(">"):
+                name = head[:value_start].rsplit(" ", 1)[-1]
+            else:
+                name = None
+        names.append(name)
+    return names
+
+def compact_numbers(
+    svg, precision=number_precision, attributes=numeric_attributes
+):
+    """Round decimal numbers in SVG markup, as one NumPy batch
+
+    Numbers in `attributes` get at most `precision` decimal places, without
+    redundant zeros, nor separators in `d` and `points`.  Numbers in other
+    `numeric_attributes` are left as they are.  Other numbers with over one
+    decimal place, e.g. in CSS or text, get two places.
+    """
+    import numpy as np
+
+    pieces = fraction_regex.split(svg)
+    fractions = pieces[1::2]
+    if len(fractions) == 0:
+        return svg
+
+    # Split the digits before each decimal point off the text before it
+    heads = [text.rstrip("0123456789") for text in pieces[0:-1:2]]
+    numbers = [
+        text[len(head):] + "." + fraction
+        for text, head, fraction in zip(pieces[0::2], heads, fractions)
+    ]
+    names = get_attribute_names(heads)
+
+    values = np.array(numbers, dtype=np.float64)
+    is_numeric = np.array([name in numeric_attributes for name in names])
+    is_compacted = is_numeric
+    if attributes is not numeric_attributes:
+        is_compacted = np.array([name in attributes for name in names])
+    fraction_lengths = np.array(list(map(len, fractions)))
+    is_long = fraction_lengths > 1
+    # Leave numbers too big to round exactly as 64-bit floats as they are
+    in_range = np.abs(values) * 10 ** max(precision, 2) < 2 ** 52
+    # Leave mantissas, e.g. 1.5 in 1.5e-3, as they are
+    mantissas = [match.start() for match in mantissa_regex.finditer(svg)]
+    if mantissas:
+        starts = np.cumsum(list(map(len, pieces[0:-1:2])))
+        starts[1:] += np.cumsum(fraction_lengths[:-1] + 1)
+        in_range[np.searchsorted(starts, mantissas)] = False
+    # Leave dotted sequences outside coordinates, e.g. 1.11.1.12, as they are
+    is_joined = np.array([text == "" for text in pieces[0:-1:2]])
+    is_joined[0] = False
+    is_dotted = is_joined | np.append(is_joined[1:], False)
+
+    numbers = np.array(numbers, dtype=object)
+    fractions = np.array(fractions, dtype=object)
+    compacted = np.flatnonzero(is_compacted & in_range)
+    formatted = format_numbers(
+        values[compacted], fractions[compacted].tolist(), precision
+    )
+    numbers[compacted] = formatted
+    zeros = compacted[formatted == "0"]
+    rounded = ~is_numeric & ~is_dotted & is_long & in_range
+    numbers[rounded] = format_numbers(
+        values[rounded], fractions[rounded].tolist(), 2, fixed=True
+    )
+    numbers = numbers.tolist()
+
+    # Drop minus signs before zeros, keeping them apart from numbers before
+    for i in zeros:
+        if heads[i] == "-" and i > 0:
+            heads[i] = " "
+        elif heads[i][-1:] == "-":
+            heads[i] = heads[i][:-1]
+
+    # Drop separators before numbers starting with "." in coordinate lists
+    separated = [
+        i for i, head in enumerate(heads[1:], 1) if head in (" ", ",")
+    ]
+    for i in separated:
+        if (
+            numbers[i][0] == "." and "." in numbers[i - 1] and
+            names[i] in coordinate_list_attributes
+        ):
+            heads[i] = ""
+
+    pieces[0:-1:2] = heads
+    pieces[1::2] = numbers
+    return "".join(pieces)
+
+# ID of the group of icon definitions in raw SVG, renamed to "icon-defs"
+icons_id = "icon-defs-ArcPathVisioBraceEllipseEndoplasmicReticulumGolgiApparatusHexagonPathVisioMimDegradationMitochondriaOctagonPentagonPathVisioRectangleRoundedRectangleSarcoplasmicReticulumTriangleEquilateralEastTrianglePathVisionone"
+
+def trim_lossless_elements(tree, references, default_font_size=None):
+    """Losslessly trim a parsed SVG's elements, in place
+
+    Returns the pruned markers, symbols, clip paths and gradients, and the
+    font size hoisted as the default for text.  That's the most common font
+    size among text, unless `default_font_size` is given.
+    """
+    # Walk the tree once; the passes below act on the elements it finds.
+    # Passes that remove elements leave them in these lists, so passes that
+    # aggregate or restructure check that an element is still in the tree.
+    elements = get_elements_by_role(tree)
+
+    # Prune definitions that nothing references
+    markers = trim_markers(elements["markers"], references)
+    symbols = trim_symbols_and_uses_and_groups(elements, references)
+    clip_paths, gradients = trim_clip_paths_and_gradients(elements, references)
+
+    trim_transform(elements["rects"] + elements["uses"])
+
+    font_size = remove_extra_tspans(elements["texts"], tree)
+    default_font_size = default_font_size or font_size
 
-    font_size_css = ""
     defaults = {}
     if default_font_size:
         defaults = {
@@ -398,125 +1012,140 @@ def custom_lossless_optimize_svg(svg, pwid):
                 "font-size": default_font_size
             }
         }
-        font_size_css = "font-size: " + default_font_size + ";"
-    tree = hoist_style(tree, defaults)
+    hoist_style(elements, defaults)
 
-    tree = unwrap(tree)
+    unwrap(elements, tree)
 
-    svg = etree.tostring(tree).decode("utf-8")
-    svg = '<?xml version="1.0" encoding="UTF-8"?>\n' + svg
+    pruned = (markers, symbols, clip_paths, gradients)
+    return pruned, default_font_size
 
-    font_family = "\'Liberation Sans\', Arial, sans-serif"
-    svg = re.sub('font-family="Arial"', '', svg)
-    svg = re.sub(f'font-family="{font_family}"', '', svg)
-    style = (
-        "<style>" +
-            "svg.Diagram {" +
-            f"font-family: {font_family}; "
-            "}" +
-            ".Diagram path {" +
-                "fill: transparent;" +
-                "stroke: #000;" +
-                # "stroke-width: 2;" +
-                "marker-end: url(#mea);"
-            "}" +
-            ".Diagram symbol path {" +
-                "fill: inherit;" +
-                "stroke: inherit;" +
-                "stroke-width: inherit;" +
-                "marker-end: inherit;"
-            "}" +
-            ".Diagram rect {" +
-                "fill: #fff;" +
-                "stroke: #000;" +
-            "}" +
-            ".Diagram text {" +
-                "dominant-baseline: central;" +
-                "overflow: hidden;" +
-                "text-anchor: middle;" +
-                "fill: #000;" +
-                font_size_css +
-            #   "stroke: #000; " +
-            "}" +
-            # "g > a {" +
-            #   "color: #000;" +
-            # "}" +
-        "</style>"
+# Kinds of definitions that `trim_lossless_elements` prunes, in its order
+pruned_kinds = ["markers", "symbols", "clip_paths", "gradients"]
+
+def count_pruned(pruned):
+    """Count definitions pruned by `trim_lossless_elements` by kind, with
+    their total size in bytes
+    """
+    counts = {
+        kind: len(elements) for kind, elements in zip(pruned_kinds, pruned)
+    }
+    counts["bytes"] = get_markup_size(sum(pruned, []))
+    return counts
+
+def condense_scoured_svg(svg, pwid):
+    """Drop the lowercase pathway ID from scoured SVG, and condense colors
+    """
+    svg = re.sub(pwid.lower(), '', svg)
+    return condense_colors(svg)
+
+def get_lossless_tree(svg, pwid):
+    """Parse scoured WikiPathways SVG, and losslessly trim its DOM
+
+    Returns the tree, the most common font size among text, if any, and the
+    definitions pruned, as from `trim_lossless_elements`.
+    """
+    svg = condense_scoured_svg(svg, pwid)
+
+    svg = svg.replace('<?xml version="1.0" encoding="UTF-8"?>\n', '')
+    references = get_references(svg)
+    tree = etree.fromstring(svg)
+
+    # Find pan-zoom controls, metadata, and icon definitions in one query
+    landmarks = tree.xpath(
+        '//*[@class="svg-pan-zoom-control" or ' +
+        '@id="svg-pan-zoom-controls-styles" or ' +
+        '@id="' + pwid + '-text" or @id="' + icons_id + '"]'
     )
-    old_style = '<style type="text/css">'
-    svg = re.sub(old_style, style + old_style, svg)
 
-    svg = re.sub('xml:space="preserve"', '', svg)
+    def get_landmark(name, value):
+        return [e for e in landmarks if e.get(name) == value][0]
 
-    # Remove "px" from attributes where numbers are assumed to be pixels.
-    svg = re.sub(r'width="([0-9.]+)px"', r'width="\1"', svg)
-    svg = re.sub(r'height="([0-9.]+)px"', r'height="\1"', svg)
-    svg = re.sub(r'stroke-width="([0-9.]+)px"', r'stroke-width="\1"', svg)
+    controls = get_landmark("class", "svg-pan-zoom-control")
+    tree.remove(controls)
+    controls_style = get_landmark("id", "svg-pan-zoom-controls-styles")
+    controls_style.getparent().remove(controls_style)
 
-    svg = re.sub('fill="inherit"', '', svg)
-    svg = re.sub('stroke-width="inherit"', '', svg)
-    svg = re.sub('color="inherit"', '', svg)
+    metadata = get_landmark("id", pwid + "-text")
+    metadata.getparent().remove(metadata)
 
-    svg = re.sub('fill-opacity="0"', '', svg)
-    svg = re.sub('dominant-baseline="central"', '', svg)
-    svg = re.sub('overflow="hidden"', '', svg)
+    icon_defs = get_landmark("id", icons_id)
+    icon_defs.attrib["id"] = "icon-defs"
 
-    # Match any anchor or group tag, up until closing angle bracket (>), that
-    # includes a color attribute with the value black (#000).
-    # For such matches, remove the color attribute but not anything else.
-    svg = re.sub(r'<g([^>]*)(color="#000")', r'<g \1', svg)
+    pruned, default_font_size = trim_lossless_elements(tree, references)
 
-    svg = re.sub(r'<(rect class="Icon"[^>]*)(color="#000")', r'<rect \1', svg)
-    svg = re.sub(r'<(rect class="Icon"[^>]*)(fill="#000")', r'<rect \1', svg)
+    return tree, default_font_size, pruned
 
-    svg = re.sub(r'<(text class="Text"[^>]*)(fill="#000")', r'<\1', svg)
-    svg = re.sub(r'<(text class="Text"[^>]*)(stroke="white" stroke-width="0")', r'<\1', svg)
+def get_default_css(default_font_size):
+    """Get CSS for defaults that optimized SVGs omit from elements
+    """
+    font_size_css = ""
+    if default_font_size:
+        font_size_css = "font-size: " + default_font_size + ";"
+    return (
+        "svg.Diagram {" +
+        f"font-family: {font_family}; "
+        "}" +
+        ".Diagram path {" +
+            "fill: transparent;" +
+            "stroke: #000;" +
+            # "stroke-width: 2;" +
+            "marker-end: url(#mea);"
+        "}" +
+        ".Diagram symbol path {" +
+            "fill: inherit;" +
+            "stroke: inherit;" +
+            "stroke-width: inherit;" +
+            "marker-end: inherit;"
+        "}" +
+        ".Diagram rect {" +
+            "fill: #fff;" +
+            "stroke: #000;" +
+        "}" +
+        ".Diagram text {" +
+            "dominant-baseline: central;" +
+            "overflow: hidden;" +
+            "text-anchor: middle;" +
+            "fill: #000;" +
+            font_size_css +
+        #   "stroke: #000; " +
+        "}"
+        # "g > a {" +
+        #   "color: #000;" +
+        # "}" +
+    )
 
-    svg = re.sub(r'<(text[^>]*)(clip\-path="[^"]*)"', r'<\1', svg)
-    # svg = re.sub(r'<defs><clipPath.*</defs>', r'', svg)
+def rewrite_lossless_markup(svg, default_font_size):
+    """Apply lossless text rewrites to markup from `get_lossless_tree`, and
+    add CSS for defaults before the diagram's own
+    """
+    svg = apply_rules(font_family_rules, svg)
+    style = "<style>" + get_default_css(default_font_size) + "</style>"
+    old_style = '<style type="text/css">'
+    svg = re.sub(old_style, style + old_style, svg)
 
-    svg = re.sub(r'class="([^"]*)( Node)"', r'class="\1"', svg)
-    svg = re.sub(r'class="([^"]*)( textContent)"', r'class="\1"', svg)
+    return apply_rules(lossless_rules, svg)
 
-    svg = re.sub(r'id="[^"]*-text-clipPath"', '', svg)
+def custom_lossless_optimize_svg(svg, pwid, profiler=None):
+    """Losslessly decrease size of WikiPathways SVG
 
-    # Remove class attributes from elements where it can be deduced
-    svg = re.sub(r'<rect([^>]*)(class="[^"]*)"', r'<rect \1', svg)
-    svg = re.sub(r'<text([^>]*)(class="[^"]*)"', r'<text \1', svg)
-    svg = re.sub(r'<tspan([^>]*)(class="[^"]*)"', r'<tspan \1', svg)
-
-    svg = re.sub(r'<path([^>]*)(id="[^"]*)"', r'<path \1', svg)
-    # svg = re.sub(r'<path([^>]*)(fill="transparent")', r'<path \1', svg)
-
-    # svg = re.sub('text-anchor="middle"', '', svg)
-
-    svg = re.sub(r'markerendarrow', 'mea', svg)
-    svg = re.sub(r'markerendmim', 'mem', svg)
-    svg = re.sub('mea000000white', 'mea', svg)
-    svg = re.sub(r'mea([^white]+)white', r'mea\1', svg)
-    svg = re.sub('mea000000', 'mea000', svg)
-    svg = re.sub('meaff0000', 'meaf00', svg)
-    svg = re.sub('mea00ff00', 'mea0f0', svg)
-    svg = re.sub('mea0000ff', 'mea00f', svg)
-    svg = re.sub('mea00ffff', 'mea0ff', svg)
-    svg = re.sub('meaff00ff', 'meaf0f', svg)
-    svg = re.sub('meaffff00', 'meaff0', svg)
-    svg = re.sub('meaffffff', 'meafff', svg)
-    svg = re.sub('meacc0000', 'meac00', svg)
-    svg = re.sub('mea00cc00', 'mea0c0', svg)
-    svg = re.sub('mea0000cc', 'mea00c', svg)
-    svg = re.sub('mea00cccc', 'mea0cc', svg)
-    svg = re.sub('meacc00cc', 'meac0c', svg)
-    svg = re.sub('meacccc00', 'meacc0', svg)
-    svg = re.sub('meacccccc', 'meaccc', svg)
-    svg = re.sub('mea999999', 'mea999', svg)
-    svg = re.sub('mea808080', 'meagrey', svg)
-    svg = re.sub('000000white', '000', svg)
-
-    svg = re.sub(r'id="[^"]*-icon" ', '', svg)
-    svg = re.sub(r'id="[^"]*-text" class="[^"]*"', '', svg)
-
-    svg = re.sub(r'\d*\.\d{2,}', lambda m: format(float(m.group(0)), '.2f'), svg)
+    Numbers are rounded by `compact_numbers`, last.  A `StageProfiler`, if
+    given, marks the DOM passes, with counts of the definitions they prune,
+    the text rewrites and the rounding.
+    """
+    tree, default_font_size, pruned = get_lossless_tree(svg, pwid)
+
+    svg = etree.tostring(tree).decode("utf-8")
+    svg = '<?xml version="1.0" encoding="UTF-8"?>\n' + svg
+    if profiler:
+        profiler.mark("dom", svg, pruned=count_pruned(pruned))
+
+    svg = rewrite_lossless_markup(svg, default_font_size)
+    if profiler:
+        profiler.mark("lossless_rules", svg)
+
+    svg = compact_numbers(svg)
+    if profiler:
+        profiler.mark("numbers", svg)
 
     # svg = re.sub(
     #     r'text-anchor="middle"><tspan\s+x="0" y="0"',
@@ -526,6 +1155,85 @@ def custom_lossless_optimize_svg(svg, pwid):
 
     return svg
 
+# Remove non-leaf pathway categories.
+lossy_category_rules = [
+    ('SingleFreeNode DataNode ', ''),
+    ('DataNode SingleFreeNode ', ''),
+    ('Shape SingleFreeNode', ''),
+    ('SingleFreeNode Label', 'Label'),
+    ('Label SingleFreeNode', 'Label'),
+    ('Edge Interaction ', ''),
+    ('Interaction Edge ', ''),
+    ('Edge Interaction', 'Edge'),
+    ('Interaction Edge', 'Edge'),
+    # ('class="Interaction,Edge" ', ''),
+    ('GraphicalLine Edge', 'Edge'),
+    ('Metabolite Node Icon', 'Icon'),
+    ('Label Node Icon', 'Icon'),
+    ('GroupGroup Node Icon', 'Icon'),
+    ('GroupComplex Node Icon', 'Icon'),
+    ('Group Complex Icon', 'Icon'),
+
+    ('Anchor Burr', 'AB'),
+]
+
+lossy_xref_rules = [
+    # Interaction data attributes
+    (r'SBO_[0-9]+\s*', ''),
+
+    # Gene data attributes
+    (r'Entrez_Gene_[0-9]+\s*', ''),
+    (r'Ensembl_ENS\w+\s*', ''),
+    (r'HGNC_\w+\s*', ''),
+    (r'Wikidata_Q[0-9]+\s*', ''),
+    (r'P594_ENSG[0-9]+\s*', ''),
+    (r'P351_\w+\s*', ''),
+    (r'P353_\w+\s*', ''),
+    (r'P594_ENSG[0-9]+\s*', ''),
+
+    # Metabolite data attributes
+    (r'P683_CHEBI_[0-9]+\s*', ''),
+    (r'P2057_\w+\s*', ''),
+    (r'ChEBI_[0-9]+\s*', ''),
+    (r'ChEBI_CHEBI[0-9]+\s*', ''),
+    (r'ChEBI_CHEBI_[0-9]+\s*', ''),
+    ('P683_[0-9]+', ''),
+    (r'HMDB_\w+\s*', ''),
+    (' Enzyme_Nomenclature_[0-9_]*', ''),
+    (' PubChem-compound_[0-9]*', ''),
+    (' Chemspider_[0-9]*', ''),
+    (' CAS_[0-9-]+', ''),
+
+    # Other miscellaneous data attributes
+    (' Pfam_PF[0-9]+', ''),
+    (r' Uniprot-TrEMBL_\w+', ''),
+    (' WikiPathways_WP[0-9]+', ''),
+
+    # Group data attributes
+    ('Group GroupGroup', 'GroupGroup'),
+    ('Group GroupNone', 'GroupNone'),
+    ('Group Complex GroupComplex', 'GroupComplex'),
+]
+
+# Attribute removals
+lossy_attribute_rules = [
+    ('about="[^"]*"', ''),
+    ('typeof="[^"]*"', ''),
+
+    (r'xlink:href="http[^\'" >]*"', ''),
+
+    (r' href="#none"', ''),
+    ('target="_blank"', ''),
+]
+
+# Lossy text rewrites, applied by `custom_lossy_optimize_svg`
+lossy_rules = compile_rules(
+    lossy_category_rules +
+    [(r'class="[^"]*,[^"]*"', '')] +
+    lossy_xref_rules +
+    lossy_attribute_rules
+)
+
 def custom_lossy_optimize_svg(svg):
     """Lossily decrease size of WikiPathways SVG
 
@@ -537,92 +1245,1804 @@ def custom_lossy_optimize_svg(svg):
     client-side software.  It might make sense to do that in the pvjs library.
     """
 
-    # Remove non-leaf pathway categories.
-    svg = re.sub('SingleFreeNode DataNode ', '', svg)
-    svg = re.sub('DataNode SingleFreeNode ', '', svg)
-    svg = re.sub('Shape SingleFreeNode', '', svg)
-    svg = re.sub('SingleFreeNode Label', 'Label', svg)
-    svg = re.sub('Label SingleFreeNode', 'Label', svg)
-    svg = re.sub('Edge Interaction ', '', svg)
-    svg = re.sub('Interaction Edge ', '', svg)
-    svg = re.sub('Edge Interaction', 'Edge', svg)
-    svg = re.sub('Interaction Edge', 'Edge', svg)
-    # svg = re.sub('class="Interaction,Edge" ', '', svg)
-    svg = re.sub('GraphicalLine Edge', 'Edge', svg)
-    svg = re.sub('Metabolite Node Icon', 'Icon', svg)
-    svg = re.sub('Label Node Icon', 'Icon', svg)
-    svg = re.sub('GroupGroup Node Icon', 'Icon', svg)
-    svg = re.sub('GroupComplex Node Icon', 'Icon', svg)
-    svg = re.sub('Group Complex Icon', 'Icon', svg)
+    svg = apply_rules(lossy_rules, svg)
 
-    svg = re.sub('Anchor Burr', 'AB', svg)
+    # svg = re.sub('font-weight="bold"', '', svg)
 
+    return svg
 
-    svg = re.sub(r'class="[^"]*,[^"]*"', '', svg)
+# Classes for xrefs that `lossy_xref_rules` removes, by prefix, with the
+# prefix of the compact identifier (CURIE) that `get_index_terms` gives them.
+# Wikidata properties (e.g. P351) note the same xrefs as other databases.
+xref_prefixes = {
+    "Entrez_Gene_": "ncbigene",
+    "P351_": "ncbigene",
+    "Ensembl_": "ensembl",
+    "P594_": "ensembl",
+    "HGNC_": "hgnc.symbol",
+    "P353_": "hgnc.symbol",
+    "Wikidata_": "wikidata",
+    "ChEBI_": "chebi",
+    "P683_": "chebi",
+    "HMDB_": "hmdb",
+    "P2057_": "hmdb",
+    "Enzyme_Nomenclature_": "ec",
+    "PubChem-compound_": "pubchem.compound",
+    "Chemspider_": "chemspider",
+    "CAS_": "cas",
+    "Pfam_": "pfam",
+    "Uniprot-TrEMBL_": "uniprot",
+    "WikiPathways_": "wikipathways",
+}
+xref_class_regex = re.compile(
+    "(" + "|".join(re.escape(prefix) for prefix in xref_prefixes) + r")(\S+)"
+)
+indexed_tag_regex = re.compile(r'<g\s([^>]*\bid="[^>]*)>')
+attribute_regex = re.compile(r'([\w:-]+)="([^"]*)"')
+
+def get_attributes(markup):
+    """Get the attributes in start tag markup, with values unescaped, e.g.
+    {"name": "IL-1 & IL-6"} for ' name="IL-1 &amp; IL-6"'
+
+    Which characters markup escapes differs between pipelines, e.g.
+    low-memory mode's has `&#NNN;` for some that others have as is, so
+    values are unescaped to compare.
+    """
+    return {
+        name: html.unescape(value)
+        for name, value in attribute_regex.findall(markup)
+    }
 
-    # Interaction data attributes
-    svg = re.sub('SBO_[0-9]+\s*', '', svg)
+def get_xref_term(prefix, local_id):
+    """Get the compact identifier for an xref class, e.g. "chebi:15422" for
+    "ChEBI_CHEBI_15422", or None if it has no identifier
+    """
+    curie_prefix = xref_prefixes[prefix]
+    if curie_prefix == "chebi":
+        local_id = re.sub(r"^CHEBI[:_]?", "", local_id)
+    elif curie_prefix == "hgnc.symbol" and re.match(r"(HGNC:)?\d+$", local_id):
+        # An HGNC ID rather than a symbol
+        curie_prefix, local_id = "hgnc", local_id.split(":")[-1]
+    elif curie_prefix == "ec":
+        local_id = local_id.replace("_", ".")
+    if local_id == "":
+        return None
+    return (curie_prefix + ":" + local_id).lower()
+
+def get_index_terms(svg, pwid):
+    """Get (term, element ID) pairs to index a pathway by, from scoured SVG
+
+    Terms are the compact identifiers of xrefs in classes of groups, e.g.
+    "ncbigene:7157" or "chebi:15422", and the labels of nodes, e.g. "tp53",
+    from their `name` attributes, which have the text of their labels.  All
+    are lowercase, to look up case-insensitively.  These are found before
+    `custom_lossy_optimize_svg` removes the xrefs.
+    """
+    terms = set()
+    for match in indexed_tag_regex.finditer(svg):
+        attrib = get_attributes(match.group(1))
+        element_id = attrib["id"]
+        if element_id == pwid:
+            # The whole pathway, named by its title and organism
+            continue
+        xrefs = xref_class_regex.findall(attrib.get("class", ""))
+        for prefix, local_id in xrefs:
+            term = get_xref_term(prefix, local_id)
+            if term:
+                terms.add((term, element_id))
+        label = " ".join(attrib.get("name", "").split()).lower()
+        if label:
+            terms.add((label, element_id))
+    return sorted(terms)
+
+# Start and end tags, e.g. <g id="a1">, <rect/> or </g>, with attributes.
+# Serializers escape ">" in attribute values.
+tag_regex = re.compile(r'<(/?)([\w:-]+)([^>]*?)(/?)>')
+
+id_attribute_regex = re.compile(r' id="([^"]*)"')
+removed_attribute_regex = re.compile(r' (about|typeof|class|xlink:href)="')
+
+# Columns of the data in `get_removed_columns`, after element IDs
+removed_data_columns = ["about", "typeof", "class", "href"]
+
+# Suffix of xref sidecars, e.g. WP554.xrefs.json beside WP554.svg
+xrefs_suffix = ".xrefs.json"
+
+def note_removed_data(svg, records, ids):
+    """Note data that `custom_lossy_optimize_svg` removes from scoured SVG
+    markup, in a dict of records by element ID
+
+    Data are the `about` and `typeof` attributes, the classes that the lossy
+    rules remove (e.g. "Entrez_Gene_7157"), and external links.  Data on an
+    element without an ID is noted for its closest ancestor with one, and
+    values for the same ID are joined by spaces.  `ids` has the ID for each
+    open element, so markup can be noted in pieces; start with `[None]`.
+    Values are unescaped, as in `get_attributes`.
+    """
+    xlink_href = "xlink:href"
+    class_values = []
+    class_ids = []
+
+    def note(element_id, name, value):
+        record = records.setdefault(element_id, {})
+        record[name] = " ".join(filter(None, [record.get(name), value]))
+
+    for match in tag_regex.finditer(svg):
+        is_end, _, attributes, is_empty = match.groups()
+        if is_end:
+            ids.pop()
+            continue
+        element_id = ids[-1]
+        if ' id="' in attributes:
+            element_id = id_attribute_regex.search(attributes).group(1)
+            element_id = html.unescape(element_id)
+        if not is_empty:
+            ids.append(element_id)
+        if element_id is None:
+            continue
+        if not removed_attribute_regex.search(attributes):
+            continue
+        # Which data the rules remove is decided on values as in markup
+        attrib = dict(attribute_regex.findall(attributes))
+        for name in ["about", "typeof"]:
+            if name in attrib:
+                note(element_id, name, html.unescape(attrib[name]))
+        if is_removable_link(attrib.get(xlink_href, "")):
+            note(element_id, "href", html.unescape(attrib[xlink_href]))
+        if "class" in attrib:
+            class_values.append(attrib["class"])
+            class_ids.append(element_id)
+
+    # Find removed classes by applying the lossy rules to all at once, joined
+    # by a separator that no rule can match across
+    joined_values = "\x00".join([f'class="{v}"' for v in class_values])
+    new_values = apply_rules(lossy_rules, joined_values).split("\x00")
+    for element_id, value, new_value in zip(
+        class_ids, class_values, new_values
+    ):
+        kept = set(new_value[len('class="'):-1].split())
+        removed = [name for name in value.split() if name not in kept]
+        if removed:
+            note(element_id, "class", html.unescape(" ".join(removed)))
+
+def get_removed_columns(records):
+    """Get records from `note_removed_data` as columns for an xref sidecar,
+    with None for missing values
+
+    Columns are sorted by element ID, as pipelines note them in different
+    orders.
+    """
+    element_ids = sorted(records)
+    columns = {"ids": element_ids}
+    for name in removed_data_columns:
+        columns[name] = [records[id].get(name) for id in element_ids]
+    return columns
+
+def get_removed_data(svg):
+    """Get data that `custom_lossy_optimize_svg` removes from scoured SVG,
+    keyed by element ID, as columns for an xref sidecar
+    """
+    records = {}
+    note_removed_data(svg, records, [None])
+    return get_removed_columns(records)
 
-    # Gene data attributes
-    svg = re.sub('Entrez_Gene_[0-9]+\s*', '', svg)
-    svg = re.sub('Ensembl_ENS\w+\s*', '', svg)
-    svg = re.sub('HGNC_\w+\s*', '', svg)
-    svg = re.sub('Wikidata_Q[0-9]+\s*', '', svg)
-    svg = re.sub('P594_ENSG[0-9]+\s*', '', svg)
-    svg = re.sub('P351_\w+\s*', '', svg)
-    svg = re.sub('P353_\w+\s*', '', svg)
-    svg = re.sub('P594_ENSG[0-9]+\s*', '', svg)
+def write_removed_data(path, columns):
+    """Write columns from `get_removed_data` as a compact JSON sidecar
+    """
+    content = json.dumps(columns, separators=(",", ":"))
+    write_atomically(path, content)
 
-    # Metabolite data attributes
-    svg = re.sub('P683_CHEBI_[0-9]+\s*', '', svg)
-    svg = re.sub('P2057_\w+\s*', '', svg)
-    svg = re.sub('ChEBI_[0-9]+\s*', '', svg)
-    svg = re.sub('ChEBI_CHEBI[0-9]+\s*', '', svg)
-    svg = re.sub('ChEBI_CHEBI_[0-9]+\s*', '', svg)
-    svg = re.sub('P683_[0-9]+', '', svg)
-    svg = re.sub('HMDB_\w+\s*', '', svg)
-    svg = re.sub(' Enzyme_Nomenclature_[0-9_]*', '', svg)
-    svg = re.sub(' PubChem-compound_[0-9]*', '', svg)
-    svg = re.sub(' Chemspider_[0-9]*', '', svg)
-    svg = re.sub(' CAS_[0-9-]+', '', svg)
 
-    # Other miscellaneous data attributes
-    svg = re.sub(' Pfam_PF[0-9]+', '', svg)
-    svg = re.sub(' Uniprot-TrEMBL_\w+', '', svg)
-    svg = re.sub(' WikiPathways_WP[0-9]+', '', svg)
+def is_removable_link(href):
+    """Whether `lossy_rules` removes an `xlink:href` with this value
+    """
+    return href.startswith("http") and " " not in href and "'" not in href
 
-    # Group data attributes
-    svg = re.sub('Group GroupGroup', 'GroupGroup', svg)
-    svg = re.sub('Group GroupNone', 'GroupNone', svg)
-    svg = re.sub('Group Complex GroupComplex', 'GroupComplex', svg)
+# Name of a pathway's SVG file, e.g. WP554.svg, but not of its
+# level-of-detail variants, e.g. WP554.lod200.svg, nor of the sprite sheet
+pathway_svg_name_regex = re.compile(r"WP\d+\.svg")
+
+def get_pwid(svg_path):
+    """Get WikiPathways ID (e.g. "WP231") from path to an SVG file
+    """
+    original_name = svg_path.split("/")[-1]
+    name = original_name.split(".svg")[0]
+    return re.search(r"WP\d+", name).group() # pathway ID
 
-    svg = re.sub('about="[^"]*"', '', svg)
-    svg = re.sub('typeof="[^"]*"', '', svg)
+def get_hash(content):
+    """Get SHA-256 hex digest of bytes
+    """
+    return hashlib.sha256(content).hexdigest()
 
-    svg = re.sub(r'xlink:href="http[^\'" >]*"', '', svg)
+def get_file_hash(path):
+    """Get SHA-256 hex digest of a file, read in chunks
+    """
+    sha256 = hashlib.sha256()
+    for chunk in read_chunks(path):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+# Version of the optimizer's passes.  Bump this with any change to the code
+# of optimizing that changes its output, as `get_pipeline_version` can't
+# detect those.  Edits to the tables it hashes need no bump.
+optimizer_version = 2
+
+def get_fingerprint_value(value):
+    """Get a JSON-serializable stand-in for a value in a table that
+    `get_pipeline_version` hashes, e.g. a rule's replacement function
+    """
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return value.__name__
+
+@lru_cache(maxsize=None)
+def get_pipeline_version():
+    """Fingerprint the optimization pipeline, to detect changes to it
+
+    This hashes `optimizer_version`, the rule tables and settings that
+    optimizing reads, and the versions of Scour and lxml.  Other edits to
+    this module, e.g. to fetching or the CLI, don't change the version, so
+    don't force a full rebuild.
+    """
+    # Scour's package has its version, without its slow-to-import code
+    import scour
+
+    tables = [
+        optimizer_version,
+        wrapped_classes, hoisted_styles, font_family, icons_id,
+        get_default_css("{font_size}"),
+        lossless_attribute_rules, marker_id_rules, lossless_id_rules,
+        lossy_category_rules, lossy_xref_rules, lossy_attribute_rules,
+        number_precision, numeric_attributes, coordinate_list_attributes,
+        lod_min_pixels, lod_min_text_pixels, lod_sized_tags,
+        lod_definition_tags, lod_numeric_attributes,
+        f"scour {scour.__version__}", f"lxml {etree.__version__}"
+    ]
+    fingerprint = json.dumps(tables, default=get_fingerprint_value)
+    return get_hash(fingerprint.encode("utf-8"))[:16]
 
-    svg = re.sub(r' href="#none"', '', svg)
-    svg = re.sub('target="_blank"', '', svg)
+@contextmanager
+def open_atomically(path, mode="wb"):
+    """Open a file to write such that readers never see it partially written
 
-    # svg = re.sub('font-weight="bold"', '', svg)
+    Writes go to a temporary file in the same directory, which is renamed
+    over the destination path once the `with` block finishes without error.
+    """
+    dir = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def write_atomically(path, content):
+    """Write text or bytes to a file such that readers never see it partially
+    written, via `open_atomically`
+    """
+    mode = "wb" if isinstance(content, bytes) else "w"
+    with open_atomically(path, mode) as f:
+        f.write(content)
+
+def prepare_raw_svg(content):
+    """Normalize fetched SVG markup into a raw SVG file's content
+    """
+    svg = re.sub(r"^\s*<\?xml[^>]*\?>\s*", "", content)
+    svg = svg.replace(
+        'typeof="Diagram" xmlns:xlink="http://www.w3.org/1999/xlink"',
+        'typeof="Diagram"'
+    )
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + svg
+
+class StageProfiler():
+    """Measure each stage of optimizing an SVG
+
+    After each stage, `mark` records the wall time and CPU time since the
+    previous mark, and the size of the stage's output.  Stages that output a
+    tree rather than markup have no size, so bytes saved by the next stage
+    count from the last known size.  Other details of a stage, e.g. what it
+    pruned, can be given as keyword arguments to `mark`.
+    """
+
+    def __init__(self, pwid, svg):
+        self.pwid = pwid
+        self.size = len(svg.encode("utf-8"))
+        self.stages = []
+        self.wall_time = perf_counter()
+        self.cpu_time = process_time()
+
+    def mark(self, stage, output=None, **details):
+        wall_time = perf_counter()
+        cpu_time = process_time()
+
+        size = None
+        saved = None
+        if output is not None:
+            size = len(output.encode("utf-8"))
+            saved = self.size - size
+            self.size = size
+
+        self.stages.append({
+            "pwid": self.pwid,
+            "stage": stage,
+            "wall_s": round(wall_time - self.wall_time, 6),
+            "cpu_s": round(cpu_time - self.cpu_time, 6),
+            "bytes": size,
+            "saved_bytes": saved,
+            **details
+        })
+
+        # Don't count time spent measuring output size toward the next stage
+        self.wall_time = perf_counter()
+        self.cpu_time = process_time()
+
+def get_percentile(values, percent):
+    """Get the nearest-rank percentile of a list of numbers
+    """
+    values = sorted(values)
+    rank = math.ceil(percent / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+def summarize_stages(stages):
+    """Summarize stage measurements from `StageProfiler` as table rows
+
+    Each stage gets p50, p95 and total wall and CPU seconds across pathways,
+    and the total bytes it saved.
+    """
+    stages_by_name = {}
+    for stage in stages:
+        stages_by_name.setdefault(stage["stage"], []).append(stage)
+
+    header = (
+        f'{"stage":<16}{"svgs":>6}' +
+        f'{"wall p50":>10}{"p95":>9}{"total":>10}' +
+        f'{"cpu p50":>10}{"p95":>9}{"total":>10}' +
+        f'{"saved bytes":>14}'
+    )
+    rows = [header]
+    for name, stages in stages_by_name.items():
+        row = f"{name:<16}{len(stages):>6}"
+        for measure in ["wall_s", "cpu_s"]:
+            values = [stage[measure] for stage in stages]
+            row += (
+                f"{get_percentile(values, 50):>10.3f}" +
+                f"{get_percentile(values, 95):>9.3f}" +
+                f"{sum(values):>10.2f}"
+            )
+        saved = [
+            stage["saved_bytes"] for stage in stages
+            if stage["saved_bytes"] is not None
+        ]
+        row += f"{sum(saved):>14}" if saved else f'{"-":>14}'
+        rows.append(row)
+
+    return rows
+
+def scour_svg(svg):
+    """Clean raw SVG with Scour, the first stage of optimizing it
+    """
+    svg = re.sub("fill-opacity:inherit;", "", svg)
+
+    scour = import_scour()
+    scour_options = scour.sanitizeOptions()
+    scour_options.remove_metadata = False
+    scour_options.newlines = False
+    scour_options.strip_comments = True
+    scour_options.strip_ids = False
+    scour_options.shorten_ids = False
+    scour_options.strip_xml_space_attribute = True
+    scour_options.keep_defs = True
+
+    return scour.scourString(svg, options=scour_options)
+
+def optimize_svg(
+    svg, pwid, output_dir, profile=False, index=False, xrefs=False, lod=None
+):
+    """Optimize a raw SVG, and write the result to `output_dir`
+
+    This is a module-level function, rather than a `WikiPathwaysCache`
+    method, so it can run in process pool workers.  Returns the pathway ID,
+    an error message, which is None if optimization succeeded, with
+    `profile`, measurements of each stage from `StageProfiler`, and, with
+    `index`, terms to index the pathway by from `get_index_terms`.
+
+    With `xrefs`, data that lossy optimization removes is written to an
+    xref sidecar.
+    With `lod`, a list of sizes in pixels, a level-of-detail variant is
+    written for each, by `write_lod_svgs`.
+    """
+    optimized_svg_path = output_dir + pwid + ".svg"
+    print(f"Optimizing to create: {optimized_svg_path}")
+
+    profiler = StageProfiler(pwid, svg) if profile else None
+    stages = profiler.stages if profile else None
+    terms = None
+
+    try:
+        clean_svg = scour_svg(svg)
+    except Exception as e:
+        print(f"Encountered error while optimizing SVG for {pwid}")
+        return pwid, repr(e), stages, terms
+
+    repo_url = "https://github.com/eweitz/cachome/tree/main/"
+    code_url = f"{repo_url}src/wikipathways.py"
+    data_url = f"{repo_url}{optimized_svg_path}"
+    wp_url = f"https://www.wikipathways.org/index.php/Pathway:{pwid}"
+    provenance = "\n".join([
+        "<!--",
+        f"  WikiPathways page: {wp_url}",
+        f"  URL for this compressed file: {data_url}",
+        # f"  Uncompressed SVG file: {original_name}",
+        # f"  From upstream ZIP archive: {url}",
+        f"  Source code for compression: {code_url}",
+        "-->"
+    ])
+
+    clean_svg = clean_svg.replace(
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<?xml version="1.0" encoding="UTF-8"?>\n' + provenance
+    )
+    if profiler:
+        profiler.mark("scour", clean_svg)
+    if index:
+        terms = get_index_terms(clean_svg, pwid)
+        if profiler:
+            profiler.mark("index")
+    if xrefs:
+        removed_data = get_removed_data(clean_svg)
+        if profiler:
+            profiler.mark("xrefs")
+
+    # clean_svg = re.sub('tspan x="0" y="0"', 'tspan', clean_svg)
+    try:
+        clean_svg = custom_lossless_optimize_svg(clean_svg, pwid, profiler)
+        clean_svg = custom_lossy_optimize_svg(clean_svg)
+        if profiler:
+            profiler.mark("lossy_rules", clean_svg)
+    except Exception as e:
+        print(f"Encountered error while optimizing SVG for {pwid}")
+        return pwid, repr(e), stages, terms
+
+    write_atomically(optimized_svg_path, clean_svg)
+    if xrefs:
+        write_removed_data(output_dir + pwid + xrefs_suffix, removed_data)
+    if profiler:
+        profiler.mark("write")
+
+    if lod:
+        try:
+            write_lod_svgs(clean_svg, pwid, output_dir, lod)
+        except Exception as e:
+            print(f"Encountered error while making LOD SVGs for {pwid}")
+            return pwid, repr(e), stages, terms
+        if profiler:
+            profiler.mark("lod")
+
+    return pwid, None, stages, terms
+
+def optimize_svg_file(
+    svg_path, output_dir, profile=False, index=False, xrefs=False, lod=None
+):
+    """Optimize a raw SVG file, and write the result to `output_dir`
+    """
+    pwid = get_pwid(svg_path)
+    with open(svg_path, 'r') as f:
+        svg = f.read()
+    return optimize_svg(
+        svg, pwid, output_dir, profile, index, xrefs, lod
+    )
+
+# Markup that `stream_optimize_svg` sends to Scour at once, in characters.
+# Scour's DOM takes about ten times as many bytes.
+stream_batch_size = 256 * 1024
+
+# Scour moves styles shared by all children of a group up to the group, and
+# drops styles from a group whose children all override them.  When Scour
+# gets a container with only a batch of its children, neither is true of the
+# whole container.  A first child without styles, that Scour keeps, stops
+# both.
+scour_sentinel = "<title>stream</title>"
+
+def is_stream_container(element):
+    """Whether `stream_optimize_svg` writes an element's children one by one,
+    rather than holding the element whole
+
+    These are `defs`, and the viewport groups that hold the whole diagram.
+    """
+    if element.tag == svg_ns + "defs":
+        return True
+    class_name = element.get("class", "")
+    return element.tag == svg_ns + "g" and "viewport" in class_name.lower()
+
+def iter_svg_chunks(source):
+    """Incrementally parse SVG, yielding (event, element) pairs
+
+    The root and stream containers are "open" once their start tag is parsed,
+    so they have attributes but no children, and "close" after their last
+    child.  Their other children are each a "chunk", yielded once parsed and
+    then dropped, so memory holds about one chunk at a time.  `source` is a
+    path or a file object.
+    """
+    containers = []
+    depth = 0
+    context = etree.iterparse(
+        source, events=("start", "end"), remove_comments=True,
+        remove_pis=True, huge_tree=True
+    )
+    for event, element in context:
+        if event == "start":
+            if depth == len(containers) and (
+                depth == 0 or is_stream_container(element)
+            ):
+                containers.append(element)
+                yield "open", element
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == len(containers) - 1:
+            yield "close", containers.pop()
+            element.clear()
+        elif depth == len(containers):
+            parent = containers[-1]
+            yield "chunk", element
+            # The chunk may have been moved out of the tree as it was used
+            if element.getparent() is parent:
+                parent.remove(element)
+
+def get_start_tag(element, nsmap={}):
+    """Get the markup of an element's start tag
+
+    Namespace declarations in `nsmap`, i.e. those made by the root, are left
+    out.
+    """
+    shallow = etree.Element(element.tag, dict(element.attrib), element.nsmap)
+    tag = get_chunk_markup(shallow, nsmap)
+    return tag[:-2] + ">"
+
+def get_end_tag(element):
+    """Get the markup of an element's end tag
+    """
+    return "</" + etree.QName(element).localname + ">"
+
+def get_chunk_markup(element, nsmap):
+    """Get an element's markup, leaving out namespace declarations in `nsmap`
+    """
+    markup = etree.tostring(element, with_tail=False).decode("utf-8")
+    tag_end = markup.index(">")
+    start_tag = markup[:tag_end]
+    for prefix, uri in nsmap.items():
+        name = "xmlns:" + prefix if prefix else "xmlns"
+        start_tag = start_tag.replace(f' {name}="{uri}"', "", 1)
+    return start_tag + markup[tag_end:]
+
+def scour_svg_stream(
+    source, target, pwid, batch_size=stream_batch_size, on_write=None
+):
+    """Scour raw SVG in batches of chunks from `iter_svg_chunks`, writing it
+    to the binary `target` file as it goes, with colors condensed
+
+    Pan-zoom controls and metadata are dropped, as by `get_lossless_tree`:
+    the first of each, if it's a chunk.  Returns the IDs referenced
+    in the SVG, a count of the font sizes of text with one `tspan`, by
+    size and the IDs of definitions the text is in, and the namespaces that
+    Scour kept, as it drops those a batch doesn't use.  The root declares
+    all the raw SVG's namespaces, as a later batch may use them.  An `on_write`
+    function, if given, is called with each piece of markup written, in
+    order, e.g. to find data in it that later passes remove.
+    """
+    landmarks = [
+        ("class", "svg-pan-zoom-control"),
+        ("id", "svg-pan-zoom-controls-styles"),
+        ("id", pwid + "-text"),
+    ]
+    definitions = [
+        svg_ns + "marker", svg_ns + "symbol", svg_ns + "clipPath",
+        svg_ns + "linearGradient", svg_ns + "radialGradient",
+    ]
+    references = set()
+    font_sizes = Counter()
+    namespaces = {}
+
+    containers = []
+    written_containers = []
+    batch = []
+    batch_length = 0
+
+    def write(markup):
+        target.write(markup.encode("utf-8"))
+        if on_write:
+            on_write(markup)
+
+    def flush():
+        nonlocal batch_length
+        root, root_nsmap = containers[0], containers[0].nsmap
+        head = get_start_tag(root) + scour_sentinel + "".join([
+            get_start_tag(container, root_nsmap) + scour_sentinel
+            for container in containers[1:]
+        ])
+        tail = "".join([get_end_tag(c) for c in reversed(containers)])
+        svg = '<?xml version="1.0" encoding="UTF-8"?>\n'
+        svg += head + "".join(batch) + tail
+        batch.clear()
+        batch_length = 0
+
+        svg = condense_scoured_svg(scour_svg(svg), pwid)
+        references.update(get_references(svg))
+        scoured_root = etree.fromstring(svg.encode("utf-8"))
+        parent = scoured_root
+        scoured_containers = [parent]
+        for i in range(len(containers)):
+            parent.remove(parent[0]) # The sentinel
+            if i < len(containers) - 1:
+                parent = parent[0]
+                scoured_containers.append(parent)
+
+        # Start tags are written as the first batch in each container has
+        # been scoured
+        nsmap = scoured_root.nsmap
+        namespaces.update(nsmap)
+        for i, scoured in enumerate(scoured_containers):
+            if containers[i] not in written_containers:
+                if i == 0:
+                    all_nsmap = {**root_nsmap, **nsmap}
+                    scoured = etree.Element(
+                        scoured.tag, dict(scoured.attrib), all_nsmap
+                    )
+                write(get_start_tag(scoured, nsmap if i > 0 else {}))
+                written_containers.append(containers[i])
+
+        for chunk in parent:
+            for text in chunk.iter(svg_ns + "text"):
+                tspans = [
+                    child for child in text if child.tag == svg_ns + "tspan"
+                ]
+                if len(tspans) != 1:
+                    continue
+                ids = tuple([
+                    e.get("id") for e in text.iterancestors(*definitions)
+                ])
+                font_sizes[(tspans[0].attrib["font-size"], ids)] += 1
+            write(get_chunk_markup(chunk, nsmap))
+
+    for event, element in iter_svg_chunks(source):
+        if event == "chunk":
+            landmark = [
+                (name, value) for name, value in landmarks
+                if element.get(name) == value
+            ]
+            if landmark:
+                landmarks.remove(landmark[0])
+                continue
+            markup = get_chunk_markup(element, containers[0].nsmap)
+            batch.append(markup)
+            batch_length += len(markup)
+            if batch_length >= batch_size:
+                flush()
+            continue
+
+        if event == "open":
+            if len(batch) > 0:
+                flush()
+            containers.append(element)
+        else:
+            if len(batch) > 0 or element not in written_containers:
+                flush()
+            write(get_end_tag(containers.pop()))
+            written_containers.remove(element)
+
+    return references, font_sizes, namespaces
+
+def get_default_font_size(font_sizes, references):
+    """Get the most common font size among text with one `tspan`, from
+    counts by `scour_svg_stream`, leaving out text in pruned definitions
+    """
+    sizes = Counter()
+    for (size, ids), count in font_sizes.items():
+        if all(id in references for id in ids):
+            sizes[size] += count
+    if len(sizes) == 0:
+        return None
+    # Ties go to the size seen first
+    return sizes.most_common(1)[0][0]
+
+def stream_optimize_svg(
+    source, pwid, output_dir, index=False, xrefs=False, lod=None,
+    batch_size=stream_batch_size
+):
+    """Optimize raw SVG as `optimize_svg` does, in memory bounded by the
+    largest chunk from `iter_svg_chunks` rather than by the whole diagram
+
+    Scour runs on batches of `batch_size` characters of markup, and writes
+    to an anonymous temporary file.  Then each chunk is read back, trimmed
+    as in `custom_lossless_optimize_svg` but with IDs referenced and the
+    default font size found in the whole diagram, rewritten, and written to
+    the output.  Output can differ slightly from `optimize_svg`'s, as Scour
+    sees each batch alone.
+
+    Peak memory is about 10 * `batch_size` bytes for Scour, plus several
+    times the size of the largest chunk, e.g. the biggest complex of nodes.
+    `source` is a path, or bytes of raw SVG.  Returns the pathway ID, an
+    error message, which is None if optimization succeeded, None for stage
+    measurements, which this doesn't take, and, with `index`, terms to
+    index the pathway by.  With `xrefs`, an xref sidecar is written too.
+    With `lod`, so are level-of-detail variants, from the optimized SVG read
+    back whole, as it's much smaller than the raw SVG.
+    """
+    optimized_svg_path = output_dir + pwid + ".svg"
+    print(f"Optimizing with low memory to create: {optimized_svg_path}")
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+
+    # Shallow copies of open containers, as a tree, so passes that look at
+    # ancestors see what they would in the whole tree
+    copies = []
+    num_started = 0
+    has_icon_defs = False
+
+    # Namespaces the scoured root declares that Scour dropped from every
+    # batch, so aren't used, and that the output's root leaves out
+    unused_namespaces = {}
+
+    # Data that later passes remove, found in scoured markup as it's written
+    terms = set()
+    removed_records = {}
+    open_ids = [None]
+
+    def note_scoured(markup):
+        if index:
+            terms.update(get_index_terms(markup, pwid))
+        if xrefs:
+            note_removed_data(markup, removed_records, open_ids)
+
+    def trim_and_write(f, references, default_font_size, closing=False):
+        """Trim the open containers and the chunk in the innermost one, then
+        write any unwritten start tags and the chunk.  When `closing`, the
+        innermost container, which has no chunks, is written whole instead.
+        """
+        nonlocal num_started
+        trim_lossless_elements(copies[0], references, default_font_size)
+
+        nsmap = copies[0].nsmap
+        num_containers = len(copies) - 1 if closing else len(copies)
+        markup = ""
+        for i in range(num_started, num_containers):
+            markup += get_start_tag(
+                copies[i], nsmap if i > 0 else unused_namespaces
+            )
+        num_started = num_containers
+        if closing:
+            markup += get_chunk_markup(
+                copies[-1], nsmap if copies[1:] else unused_namespaces
+            )
+        else:
+            # Passes may have replaced the chunk, or removed it
+            for element in list(copies[-1]):
+                markup += get_chunk_markup(element, nsmap)
+                copies[-1].remove(element)
+
+        markup = rewrite_lossless_markup(markup, default_font_size)
+        markup = custom_lossy_optimize_svg(markup)
+        f.write(compact_numbers(markup))
+
+    fd, tmp_path = tempfile.mkstemp(dir=output_dir, suffix=".tmp")
+    try:
+        scoured = tempfile.TemporaryFile()
+        with scoured, os.fdopen(fd, "w", encoding="utf-8") as f:
+            references, font_sizes, namespaces = scour_svg_stream(
+                source, scoured, pwid, batch_size, note_scoured
+            )
+            default_font_size = get_default_font_size(font_sizes, references)
+            scoured.seek(0)
+
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            for event, element in iter_svg_chunks(scoured):
+                if event == "open":
+                    tag, attrib = element.tag, dict(element.attrib)
+                    if len(copies) == 0:
+                        copy = etree.Element(tag, attrib, element.nsmap)
+                        unused_namespaces.update({
+                            prefix: uri
+                            for prefix, uri in element.nsmap.items()
+                            if namespaces.get(prefix) != uri
+                        })
+                    else:
+                        copy = etree.SubElement(copies[-1], tag, attrib)
+                    copies.append(copy)
+                elif event == "chunk":
+                    if element.get("id") == icons_id and not has_icon_defs:
+                        element.attrib["id"] = "icon-defs"
+                        has_icon_defs = True
+                    copies[-1].append(element)
+                    trim_and_write(f, references, default_font_size)
+                else:
+                    if num_started == len(copies):
+                        f.write(get_end_tag(copies[-1]))
+                        num_started -= 1
+                    else:
+                        trim_and_write(
+                            f, references, default_font_size, closing=True
+                        )
+                    copy = copies.pop()
+                    if len(copies) > 0:
+                        copies[-1].remove(copy)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, optimized_svg_path)
+        if xrefs:
+            write_removed_data(
+                output_dir + pwid + xrefs_suffix,
+                get_removed_columns(removed_records)
+            )
+    except Exception as e:
+        os.remove(tmp_path)
+        print(f"Encountered error while optimizing SVG for {pwid}")
+        return pwid, repr(e), None, None
+
+    if lod:
+        try:
+            with open(optimized_svg_path, encoding="utf-8") as f:
+                write_lod_svgs(f.read(), pwid, output_dir, lod)
+        except Exception as e:
+            print(f"Encountered error while making LOD SVGs for {pwid}")
+            return pwid, repr(e), None, None
+
+    return pwid, None, None, sorted(terms) if index else None
+
+# Smallest size, in pixels at a level of detail's scale, of the shapes and
+# text that its variant keeps.  Smaller shapes are specks, and smaller text
+# is illegible.
+lod_min_pixels = 2
+lod_min_text_pixels = 4
+
+# Shapes dropped from LOD variants when small, by the attributes that size
+# them, and what to multiply those by to get the shape's size
+lod_sized_tags = {
+    "rect": (["width", "height"], 1),
+    "use": (["width", "height"], 1),
+    "image": (["width", "height"], 1),
+    "ellipse": (["rx", "ry"], 2),
+    "circle": (["r"], 2),
+}
+
+# Definitions that LOD variants drop unless something references them
+lod_definition_tags = [
+    "clipPath", "filter", "linearGradient", "marker", "mask", "pattern",
+    "radialGradient", "symbol"
+]
+
+# Numbers rounded for LOD variants.  Not stroke widths, which rounding down
+# hides, nor other transforms than translations, e.g. scales in matrices.
+lod_numeric_attributes = numeric_attributes - {"transform", "stroke-width"}
+
+length_regex = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+translate_regex = re.compile(r"translate\(([^)]*)\)")
+css_class_regex = re.compile(r"\.(-?[_a-zA-Z][\w-]*)")
+default_text_size_regex = re.compile(
+    r"\.Diagram text \{[^}]*?font-size: ?([^;}]+)"
+)
+font_size_regex = re.compile(r"font-size: ?([^;]+)")
+
+# A number joined to one before it that has a decimal point, e.g. ".69" in
+# "90.31.69", which needs a separator again if rounding drops its point
+joined_number_regex = re.compile(r"(\.\d+)(?=\.)")
+
+# A marker property referencing an element by ID, e.g.
+# "marker-end: url(#mea)", and one for paths in the default CSS that's none
+marker_reference_regex = re.compile(
+    r"(marker(?:-start|-mid|-end)?: ?)url\(#([^)]*)\)"
+)
+path_marker_end_none_regex = re.compile(
+    r"\.Diagram path ?\{[^}]*marker-end: ?none"
+)
+url_regex = re.compile(r"url\(#([^)]*)\)")
+css_comment_regex = re.compile(r"/\*.*?\*/", re.S)
+
+def get_lod_suffix(size):
+    """Get the suffix of a level-of-detail variant, e.g. ".lod200.svg"
+    """
+    return f".lod{size}.svg"
+
+def get_length(value, default=0.0):
+    """Get the number in an SVG length, e.g. 2000.0 for "2e3px"
+
+    WikiPathways SVGs use only user units and pixels, which are the same.
+    """
+    match = length_regex.match(value or "")
+    return float(match.group()) if match else default
+
+def format_length(number, precision):
+    """Format a number with at most `precision` decimal places
+    """
+    text = f"{number:.{precision}f}"
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    return "0" if text == "-0" else text
+
+def get_font_size(element, inherited):
+    """Get the font size an element sets, by attribute or style, else the
+    size it inherits
+    """
+    match = font_size_regex.search(element.get("style", ""))
+    if match:
+        return get_length(match.group(1), inherited)
+    return get_length(element.get("font-size"), inherited)
+
+def drop_small_elements(element, min_size, min_font_size, font_size):
+    """Remove shapes and text smaller than given sizes from an element's
+    content, leaving definitions as they are
+    """
+    for child in list(element):
+        if not isinstance(child.tag, str):
+            continue
+        tag = etree.QName(child).localname
+        if tag == "defs":
+            continue
+        if tag == "text":
+            if get_font_size(child, font_size) < min_font_size:
+                element.remove(child)
+        elif tag in lod_sized_tags:
+            names, factor = lod_sized_tags[tag]
+            size = max(get_length(child.get(name)) for name in names)
+            if size * factor < min_size:
+                element.remove(child)
+        else:
+            drop_small_elements(
+                child, min_size, min_font_size,
+                get_font_size(child, font_size)
+            )
+
+def resolve_marker_reference(match, ids):
+    """Get a marker property from `marker_reference_regex`, with "none" if
+    its marker isn't among `ids`
+    """
+    if match.group(2) in ids:
+        return match.group(0)
+    return match.group(1) + "none"
+
+def minify_css(css):
+    """Remove comments and whitespace that don't matter from CSS
+    """
+    css = re.sub(r"\s+", " ", css_comment_regex.sub("", css))
+    css = re.sub(r" ?([{};,]) ?", r"\1", css)
+    css = re.sub(r": ", ":", css)
+    return css.replace(";}", "}").strip()
+
+def replace_with_children(element):
+    """Replace an element with its children
+    """
+    parent = element.getparent()
+    index = parent.index(element)
+    parent[index:index + 1] = list(element)
+
+def collapse_groups(root, precision):
+    """Remove empty groups, unwrap ones without attributes, and move
+    translations of groups with one child to the child
 
+    A translated rect, use or image gets its offset added to its position,
+    rather than a `transform`.
+    """
+    for group in reversed(list(root.iter(svg_ns + "g"))):
+        if group.getparent() is None:
+            continue
+        if len(group) == 0:
+            group.getparent().remove(group)
+            continue
+        if len(group.attrib) == 0:
+            replace_with_children(group)
+            continue
+        transform = group.get("transform", "")
+        match = translate_regex.fullmatch(transform)
+        if list(group.attrib) != ["transform"] or len(group) != 1:
+            continue
+        if not match:
+            continue
+        child = group[0]
+        tag = etree.QName(child).localname
+        if tag in ["rect", "use", "image"] and "transform" not in child.attrib:
+            offsets = re.split(r"[\s,]+", match.group(1).strip()) + ["0"]
+            for name, offset in zip(["x", "y"], offsets):
+                position = get_length(child.get(name)) + get_length(offset)
+                child.set(name, format_length(position, precision))
+        else:
+            child_transform = child.get("transform")
+            if child_transform:
+                transform += " " + child_transform
+            child.set("transform", transform)
+        replace_with_children(group)
+
+    for defs in list(root.iter(svg_ns + "defs")):
+        if len(defs) == 0:
+            defs.getparent().remove(defs)
+
+def make_lod_svg(svg, pwid, size):
+    """Make a level-of-detail variant of optimized SVG, for rendering its
+    diagram at most `size` pixels wide or high, e.g. as a thumbnail
+
+    The diagram's size is that of the pathway's background rect.  At the
+    scale that fits it in `size`, shapes smaller than `lod_min_pixels` and
+    text smaller than `lod_min_text_pixels` are dropped, as are definitions
+    that are then unreferenced, and data only interactive clients use:
+    unreferenced IDs, names, descriptions and classes that no CSS selects.
+    Then groups are collapsed, and coordinates rounded to the precision the
+    scale needs.
+    """
+    root = etree.fromstring(svg.encode("utf-8"))
+
+    scale = 1
+    pathway = root.find(f".//{svg_ns}g[@id='{pwid}']")
+    background = None
+    if pathway is not None:
+        background = pathway.find(f".//{svg_ns}rect")
+    if background is not None:
+        extent = max(
+            get_length(background.get("width")),
+            get_length(background.get("height"))
+        )
+        if extent > 0:
+            scale = size / extent
+    min_size = lod_min_pixels / scale
+    precision = max(0, min(number_precision, math.ceil(math.log10(4 * scale))))
+
+    styles = list(root.iter(svg_ns + "style"))
+    css = "".join(style.text or "" for style in styles)
+    match = default_text_size_regex.search(css)
+    default_font_size = get_length(match.group(1) if match else "16px")
+    drop_small_elements(
+        root, min_size, lod_min_text_pixels / scale, default_font_size
+    )
+
+    # Markers are sized in stroke widths, which are about 1 in pathways
+    for marker in list(root.iter(svg_ns + "marker")):
+        marker_size = max(
+            get_length(marker.get("markerWidth"), 3),
+            get_length(marker.get("markerHeight"), 3)
+        )
+        if marker_size < min_size:
+            marker.getparent().remove(marker)
+
+    # Drop definitions until all left are referenced, as some reference
+    # others
+    definition_tags = [svg_ns + tag for tag in lod_definition_tags]
+    while True:
+        references = get_references(etree.tostring(root, encoding="unicode"))
+        unreferenced = [
+            element for element in root.iter(*definition_tags)
+            if element.get("id") not in references
+        ]
+        if len(unreferenced) == 0:
+            break
+        for element in unreferenced:
+            element.getparent().remove(element)
+
+    # Markers of dropped markers, or of ones that never existed, e.g. the
+    # default CSS's, are none
+    ids = set(root.xpath("//@id"))
+    resolve_markers = lambda match: resolve_marker_reference(match, ids)
+    for style in styles:
+        style.text = minify_css(
+            marker_reference_regex.sub(resolve_markers, style.text or "")
+        )
+    css = "".join(style.text or "" for style in styles)
+    is_marker_end_none = bool(path_marker_end_none_regex.search(css))
+    for element in root.iter(etree.Element):
+        for name in ["marker-start", "marker-mid", "marker-end"]:
+            match = url_regex.fullmatch(element.get(name, ""))
+            if match and match.group(1) not in ids:
+                element.set(name, "none")
+        style = element.get("style")
+        if style is None or "marker" not in style:
+            continue
+        style = marker_reference_regex.sub(resolve_markers, style)
+        if is_marker_end_none and element.tag == svg_ns + "path":
+            style = ";".join(
+                declaration for declaration in style.split(";")
+                if declaration.replace(" ", "") != "marker-end:none"
+            )
+        if style:
+            element.set("style", style)
+        else:
+            del element.attrib["style"]
+
+    for element in list(root.iter(svg_ns + "desc", svg_ns + "title")):
+        element.getparent().remove(element)
+    css_classes = set(css_class_regex.findall(css))
+    for element in root.iter(etree.Element):
+        for name in ["name", "prefix"]:
+            element.attrib.pop(name, None)
+        id = element.get("id")
+        if id is not None and id not in references:
+            del element.attrib["id"]
+        if "class" in element.attrib:
+            classes = [
+                name for name in element.get("class").split()
+                if name in css_classes
+            ]
+            if classes:
+                element.set("class", " ".join(classes))
+            else:
+                del element.attrib["class"]
+        transform = element.get("transform")
+        if transform == "":
+            del element.attrib["transform"]
+        elif transform:
+            element.set("transform", translate_regex.sub(
+                lambda match: "translate(" + " ".join(
+                    format_length(get_length(offset), precision)
+                    for offset in re.split(r"[\s,]+", match.group(1).strip())
+                ) + ")",
+                transform
+            ))
+        for name in coordinate_list_attributes:
+            if name in element.attrib:
+                element.set(
+                    name, joined_number_regex.sub(r"\1 ", element.get(name))
+                )
+
+    collapse_groups(root, precision)
+
+    lod_svg = etree.tostring(root, encoding="unicode")
+    lod_svg = '<?xml version="1.0" encoding="UTF-8"?>\n' + lod_svg
+    return compact_numbers(lod_svg, precision, lod_numeric_attributes)
+
+def write_lod_svgs(svg, pwid, output_dir, sizes):
+    """Write a level-of-detail variant of optimized SVG for each size, e.g.
+    WP554.lod200.svg for 200
+    """
+    for size in sizes:
+        lod_svg = make_lod_svg(svg, pwid, size)
+        write_atomically(output_dir + pwid + get_lod_suffix(size), lod_svg)
+
+def compress_svg(svg_path):
+    """Write gzip and Brotli sidecars for an optimized SVG file
+
+    Both use maximum compression, as they're made once and served many times,
+    e.g. by nginx's `gzip_static` and `brotli_static`.  This is a module-level
+    function so it can run in process pool workers.  Returns the SHA-256 of the
+    SVG that was compressed.
+    """
+    with open(svg_path, "rb") as f:
+        svg = f.read()
+
+    # Omit the timestamp from the gzip header, so output depends only on input
+    gzipped_svg = gzip.compress(svg, compresslevel=9, mtime=0)
+    brotli_svg = brotli.compress(
+        svg, mode=brotli.MODE_TEXT, quality=11, lgwin=24
+    )
+    write_atomically(svg_path + ".gz", gzipped_svg)
+    write_atomically(svg_path + ".br", brotli_svg)
+
+    return get_hash(svg)
+
+# Sprite sheet of icon symbols shared by optimized SVGs, beside them, and
+# the key of its entry in the manifest, among pathway IDs
+sprite_name = "sprite.svg"
+sprite_manifest_key = "sprite"
+
+# E.g. <symbol id="Ellipse" ...>...</symbol>, or <symbol id="Empty"/>.
+# Symbols don't nest, and serialized attribute values escape ">".
+symbol_regex = re.compile(
+    r'<symbol(\s[^>]*?)?(?:/>|(?<!/)>.*?</symbol>)', re.S
+)
+
+# E.g. href="sprite.svg#Ellipse" -> Ellipse
+sprite_reference_regex = re.compile(
+    'href="' + re.escape(sprite_name) + '#([^"]*)"'
+)
+
+def get_symbols(svg):
+    """Get markup of symbols with IDs in SVG markup, by ID
+    """
+    symbols = {}
+    for match in symbol_regex.finditer(svg):
+        id_match = id_attribute_regex.search(match.group(1) or "")
+        if id_match and id_match.group(1):
+            symbols[id_match.group(1)] = match.group()
+    return symbols
+
+def get_sprite_svg(symbols):
+    """Get markup of a sprite sheet with symbols, given by ID
+    """
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n' +
+        '<svg xmlns="http://www.w3.org/2000/svg"><defs>' +
+        "".join(symbols[id] for id in sorted(symbols)) +
+        "</defs></svg>"
+    )
+
+def hoist_symbols(svg, sprite_symbols):
+    """Move symbols out of SVG markup, referring to them in the sprite sheet
+
+    `sprite_symbols` maps ID to markup of symbols in the sprite sheet, and
+    gets symbols new to it.  A symbol that differs from the sprite sheet's
+    symbol of the same ID stays inline.
+
+    Markers stay inline too, as browsers other than Firefox don't resolve
+    `marker-end: url(...)` to another document, unlike `<use href>`.
+    """
+    for id, symbol in get_symbols(svg).items():
+        if sprite_symbols.setdefault(id, symbol) != symbol:
+            continue
+        svg = svg.replace(symbol, "")
+        svg = svg.replace(f'href="#{id}"', f'href="{sprite_name}#{id}"')
     return svg
 
+def get_unresolved_references(svg, sprite_ids):
+    """Get references in SVG markup to IDs not in it or in the sprite sheet
+    """
+    ids = set(re.findall(r' id="([^"]*)"', svg))
+    unresolved = {"#" + id for id in get_references(svg) - ids}
+    unresolved.update(
+        sprite_name + "#" + id
+        for id in set(sprite_reference_regex.findall(svg)) - set(sprite_ids)
+    )
+    return unresolved
+
+# Header of a pathway pack: magic number, then offset and size of the index
+pack_magic = b"WPPACK1\0"
+pack_header_format = "<8sQQ"
+
+class PathwayPack():
+    """Read pathways from a pack written by `WikiPathwaysCache.write_pack`
+
+    A pack is one file per organism: a header, each pathway's optimized SVG as
+    a Brotli blob, then a JSON index of each pathway's offset, size and SVG
+    SHA-256.  The file is memory-mapped, so getting a pathway reads only its
+    blob, and `get_compressed` slices it without copying.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_size = struct.unpack_from(
+            pack_header_format, self.mmap
+        )
+        if magic != pack_magic:
+            raise ValueError(f"Not a pathway pack: {path}")
+        index = json.loads(self.mmap[index_offset:index_offset + index_size])
+        self.encoding = index["encoding"]
+        self.entries = index["pathways"]
+
+    def get_pwids(self):
+        return list(self.entries)
+
+    def get_sha256(self, pwid):
+        """Get SHA-256 of a pathway's optimized SVG, e.g. for an ETag
+        """
+        return self.entries[pwid][2]
+
+    def get_compressed(self, pwid):
+        """Get a pathway's Brotli-compressed SVG, as a view into the pack
+
+        Release the view before closing the pack.
+        """
+        offset, size, sha256 = self.entries[pwid]
+        return memoryview(self.mmap)[offset:offset + size]
+
+    def get_svg(self, pwid):
+        """Get a pathway's optimized SVG markup
+        """
+        with self.get_compressed(pwid) as blob:
+            return brotli.decompress(blob).decode("utf-8")
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+class PathwayIndex():
+    """An inverted index from identifiers and labels to pathways, in SQLite
+
+    There's one index per organism, updated by `WikiPathwaysCache` as each
+    pathway is optimized.  Terms are from `get_index_terms`, and each maps
+    to the pathways that mention it, and the IDs of the elements that do.
+    Each pathway's terms are replaced whole, so updating one pathway doesn't
+    touch the others.  Pathway IDs are stored as their numbers, to keep the
+    index compact.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS pathways (
+                pwid INTEGER PRIMARY KEY,
+                input_sha256 TEXT
+            );
+            CREATE TABLE IF NOT EXISTS terms (
+                term TEXT,
+                pwid INTEGER,
+                element_id TEXT,
+                PRIMARY KEY (term, pwid, element_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS terms_by_pwid ON terms (pwid);
+        """)
+
+    def get_input_hash(self, pwid):
+        """Get the SHA-256 of the raw SVG a pathway was indexed from, if any
+        """
+        row = self.connection.execute(
+            "SELECT input_sha256 FROM pathways WHERE pwid = ?",
+            (int(pwid[2:]),)
+        ).fetchone()
+        return row and row[0]
+
+    def update(self, pwid, input_hash, terms):
+        """Replace a pathway's (term, element ID) pairs.  Call `commit` after.
+        """
+        number = int(pwid[2:]) # E.g. "WP231" -> 231
+        self.connection.execute("DELETE FROM terms WHERE pwid = ?", (number,))
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO terms VALUES (?, ?, ?)",
+            [(term, number, element_id) for term, element_id in terms]
+        )
+        self.connection.execute(
+            "INSERT OR REPLACE INTO pathways VALUES (?, ?)",
+            (number, input_hash)
+        )
+
+    def lookup(self, term):
+        """Get the pathways that mention a term, as a dict of the IDs of the
+        elements that do by pathway ID
+
+        E.g. `lookup("TP53")` or `lookup("CHEBI:15422")`.  Case and extra
+        whitespace in the term are ignored.
+        """
+        term = " ".join(term.split()).lower()
+        element_ids_by_pwid = {}
+        rows = self.connection.execute(
+            "SELECT pwid, element_id FROM terms WHERE term = ?", (term,)
+        )
+        for number, element_id in rows:
+            pwid = f"WP{number}"
+            element_ids_by_pwid.setdefault(pwid, []).append(element_id)
+        return element_ids_by_pwid
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+def lookup_pathways(term, output_dir="data/"):
+    """Look up a term in the index of each organism in `output_dir`, as by
+    `PathwayIndex.lookup`
+    """
+    element_ids_by_pwid = {}
+    for path in sorted(glob.glob(output_dir + "*.index.sqlite")):
+        index = PathwayIndex(path)
+        try:
+            element_ids_by_pwid.update(index.lookup(term))
+        finally:
+            index.close()
+    return element_ids_by_pwid
+
+def download_chunks(session, url, path, chunk_size=1024 * 1024):
+    """Yield chunks of a remote file as they arrive, also saving it to `path`
+
+    The file is only moved to `path` once fully downloaded.
+    """
+    dir = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            with session.get(url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    yield chunk
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def read_chunks(path, chunk_size=1024 * 1024):
+    """Yield chunks of a local file
+    """
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class ChunkReader():
+    """Read exact byte counts from an iterable of byte chunks
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        # Deleting from the front of a bytearray doesn't copy the rest
+        self.buffer = bytearray()
+
+    def fill(self):
+        """Append the next chunk to the buffer; return False at end of input
+        """
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buffer += chunk
+        return True
+
+    def read(self, size):
+        """Read `size` bytes, or fewer only at end of input
+        """
+        while len(self.buffer) < size and self.fill():
+            pass
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read_deflated(self):
+        """Read and inflate one raw deflate stream of unknown length
+        """
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        parts = []
+        while not decompressor.eof:
+            if not self.buffer and not self.fill():
+                raise zipfile.BadZipFile("Truncated deflate stream")
+            parts.append(decompressor.decompress(self.buffer))
+            self.buffer = bytearray(decompressor.unused_data)
+        return b"".join(parts)
+
+
+def iter_zip_members(chunks):
+    """Yield (name, content) for each file in a zip archive, from its bytes
+
+    Unlike `zipfile`, this reads local file headers in archive order, so it
+    needs neither the central directory at the end of the archive nor random
+    access.  Members can thus be processed while the archive downloads, and
+    only one member is in memory at a time.
+    """
+    reader = ChunkReader(chunks)
+    while True:
+        signature = reader.read(4)
+        if signature != b"PK\x03\x04":
+            # Central directory, or end of archive.  Consume remaining input,
+            # so e.g. a download teeing chunks to disk can complete.
+            for chunk in reader.chunks:
+                pass
+            return
+
+        header = reader.read(26)
+        (
+            version, flags, method, mtime, mdate, crc, compressed_size, size,
+            name_length, extra_length
+        ) = struct.unpack("<HHHHHIIIHH", header)
+        name = reader.read(name_length).decode(
+            "utf-8" if flags & 0x800 else "cp437"
+        )
+        extra = reader.read(extra_length)
+
+        # Zip64 archives put large sizes in an extra field
+        zip64 = False
+        while len(extra) >= 4:
+            field_id, field_length = struct.unpack("<HH", extra[:4])
+            if field_id == 0x0001 and field_length >= 16:
+                size, compressed_size = struct.unpack("<QQ", extra[4:20])
+                zip64 = True
+            extra = extra[4 + field_length:]
+
+        has_descriptor = flags & 0x08
+        if method == 8 and has_descriptor:
+            content = reader.read_deflated()
+        elif method == 8:
+            compressed = reader.read(compressed_size)
+            content = zlib.decompress(compressed, -zlib.MAX_WBITS)
+        elif method == 0 and not has_descriptor:
+            content = reader.read(compressed_size)
+        else:
+            raise zipfile.BadZipFile(
+                f"Unsupported compression for streaming {name}"
+            )
+
+        if has_descriptor:
+            # Data descriptor, with optional signature
+            descriptor = reader.read(4)
+            if descriptor == b"PK\x07\x08":
+                descriptor = reader.read(4)
+            crc = struct.unpack("<I", descriptor)[0]
+            reader.read(16 if zip64 else 8)
+
+        if zlib.crc32(content) != crc:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for {name}")
+
+        if not name.endswith("/"):
+            yield name, content
+
+
+class RateLimiter():
+    """Space out requests across threads, to stay polite to a server
+
+    `clock` and `sleep` can be replaced, e.g. by a simulated clock in tests.
+    """
+
+    def __init__(self, requests_per_second, clock=monotonic, sleep=sleep):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.clock = clock
+        self.sleep = sleep
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next request is allowed
+        """
+        with self.lock:
+            now = self.clock()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            self.sleep(wait_time)
+
+
+class SeleniumFetcher():
+    """Fetch pathway SVGs by rendering WikiPathways widget pages in Chrome
+
+    WebDriver sessions aren't thread-safe, so each fetch worker thread gets its
+    own browser.  Point `url_template` at a local server to fetch offline.
+    """
+
+    def __init__(
+        self, url_template=pathway_url_template, timeout=10,
+        requests_per_second=1
+    ):
+        self.url_template = url_template
+        self.timeout = timeout # seconds
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.local = threading.local()
+        self.drivers = []
+        self.driver_path = None
+        self.lock = threading.Lock()
+
+    def get_driver(self):
+        """Get this thread's browser, starting it on first use
+        """
+        from selenium import webdriver
+        from webdriver_manager.chrome import ChromeDriverManager
+
+        driver = getattr(self.local, "driver", None)
+        if driver is None:
+            with self.lock:
+                if self.driver_path is None:
+                    self.driver_path = ChromeDriverManager().install()
+            driver = webdriver.Chrome(self.driver_path)
+            self.local.driver = driver
+            with self.lock:
+                self.drivers.append(driver)
+        return driver
+
+    def fetch(self, id, organism):
+        """Get outer HTML of the rendered diagram for a pathway
+        """
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        driver = self.get_driver()
+        self.rate_limiter.wait()
+        driver.get(self.url_template.format(id=id))
+
+        # Wait for the diagram to render, rather than for a fixed time
+        selector = (By.CSS_SELECTOR, "svg.Diagram")
+        wait = WebDriverWait(driver, self.timeout)
+        raw_content = wait.until(
+            expected_conditions.presence_of_element_located(selector)
+        )
+        return raw_content.get_attribute("outerHTML")
+
+    def close(self):
+        """Quit all browsers started by this fetcher
+        """
+        with self.lock:
+            for driver in self.drivers:
+                driver.quit()
+            self.drivers = []
+        self.local = threading.local()
+
+
+class ZipArchiveFetcher():
+    """Fetch pathway SVGs from WikiPathways' per-organism SVG zip archives
+
+    This needs only plain HTTP, not a browser.  Each archive is streamed to
+    disk in chunks over a pooled session, then SVGs are extracted one member
+    at a time as fetch workers request them.
+
+    Organisms populating concurrently share one fetcher, so the lock only
+    guards lookups of archives.  Each archive is downloaded and opened by the
+    first worker to ask for it, while workers for other organisms go on.
+    """
+
+    def __init__(
+        self, archive_dir="tmp/", requests_per_second=1, pool_size=1,
+        get_url=get_svg_zip_url
+    ):
+        self.archive_dir = archive_dir
+        self.get_url = get_url
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = get_session(pool_size)
+        # Futures of (archive, member names by pathway ID), by organism
+        self.archives = {}
+        self.lock = threading.Lock()
+
+    def download(self, url, path):
+        """Stream a remote file to disk, without holding it all in memory
+        """
+        print(f"Downloading {url}")
+        self.rate_limiter.wait()
+        for chunk in download_chunks(self.session, url, path):
+            pass
+
+    def open_archive(self, organism):
+        """Open an organism's SVG zip archive, downloading it if needed, and
+        get it with the names of its SVG members by pathway ID
+        """
+        url = self.get_url(organism)
+        path = self.archive_dir + url.split("/")[-1]
+        if not os.path.exists(path):
+            self.download(url, path)
+
+        archive = zipfile.ZipFile(path)
+        member_names = {}
+        for name in archive.namelist():
+            match = re.search(r"WP\d+", name.split("/")[-1])
+            if name.endswith(".svg") and match:
+                member_names[match.group()] = name
+        return archive, member_names
+
+    def get_archive(self, organism):
+        """Get an organism's opened SVG zip archive and the names of its SVG
+        members by pathway ID, waiting for any download in progress
+        """
+        with self.lock:
+            future = self.archives.get(organism)
+            is_opener = future is None
+            if is_opener:
+                future = Future()
+                self.archives[organism] = future
+
+        if is_opener:
+            try:
+                future.set_result(self.open_archive(organism))
+            except BaseException as e:
+                # Let a later fetch try again
+                with self.lock:
+                    self.archives.pop(organism, None)
+                future.set_exception(e)
+        return future.result()
+
+    def fetch(self, id, organism):
+        """Get SVG markup for a pathway
+        """
+        archive, member_names = self.get_archive(organism)
+        name = member_names.get(id)
+        if name is None:
+            raise KeyError(f"No SVG for {id} in archive for {organism}")
+        # Reads of one ZipFile are safe across threads
+        return archive.read(name).decode("utf-8")
+
+    def close(self):
+        """Close opened archives and pooled connections
+        """
+        with self.lock:
+            futures = list(self.archives.values())
+            self.archives = {}
+        for future in futures:
+            if future.done() and future.exception() is None:
+                future.result()[0].close()
+        self.session.close()
+
 
 class WikiPathwaysCache():
 
-    def __init__(self, output_dir="data/", reuse=False):
+    def __init__(
+        self, output_dir="data/", reuse=False, workers=1,
+        fetch_workers=1, requests_per_second=1, fetcher="selenium",
+        stream=False, force=False, profile_path=None,
+        compress=True, pack=False, sprite=False, org_workers=None,
+        low_memory=False, index=False, xrefs=False, lod=None
+    ):
         self.output_dir = output_dir
         self.tmp_dir = f"tmp/"
         self.reuse = reuse
+        self.workers = workers
+        self.fetch_workers = fetch_workers
+        self.stream = stream
+        self.force = force
+        self.profile_path = profile_path
+        self.compress = compress
+        self.pack = pack
+        self.sprite = sprite
+        self.org_workers = org_workers or len(organisms)
+        self.low_memory = low_memory
+        self.index = index
+        self.xrefs = xrefs
+        self.lod = sorted(set(lod or []))
+        self.requests_per_second = requests_per_second
+
+        # Organisms populate concurrently, in threads that share one pool of
+        # processes for optimizing, and this lock for the state below
+        self.process_pool = None
+        self.lock = threading.Lock()
+
+        # Fetcher can be given by name, or as an object with `fetch` and
+        # `close` methods, e.g. one that reads from a local stand-in server.
+        # Named fetchers and the HTTP session are made on first use, so
+        # optimizing alone doesn't import what they need.
+        self.fetcher = fetcher
+        self.session = None
+        self.pathway_lists = None
 
         if not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
         if not os.path.exists(self.tmp_dir):
             os.makedirs(self.tmp_dir)
 
-    def fetch_svgs(self, ids_and_names, org_dir):
-
+        # Records hashes of each pathway's raw input and optimized output, and
+        # the optimizer that made it, so unchanged pathways can be skipped
+        self.pipeline_version = get_pipeline_version()
+        if sprite:
+            self.pipeline_version += "-sprite"
+        if low_memory:
+            self.pipeline_version += "-low-memory"
+        if xrefs:
+            self.pipeline_version += "-xrefs"
+        if self.lod:
+            self.pipeline_version += "-lod" + "-".join(map(str, self.lod))
+        self.manifest_path = self.output_dir + "manifest.json"
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+        # Measurements of each optimize stage, also written as JSON Lines to
+        # `profile_path` as pathways finish
+        self.stages = []
+        if profile_path:
+            open(profile_path, "w").close()
+
+        # Symbols in the sprite sheet, by ID.  Symbols are only ever added, as
+        # pathways optimized in earlier runs may still refer to them.
+        self.sprite_path = self.output_dir + sprite_name
+        self.sprite_symbols = {}
+        if sprite and os.path.exists(self.sprite_path):
+            with open(self.sprite_path) as f:
+                self.sprite_symbols = get_symbols(f.read())
+
+    def get_fetcher(self):
+        """Get the fetcher, making a named one on first use
+        """
+        with self.lock:
+            if self.fetcher == "selenium":
+                self.fetcher = SeleniumFetcher(
+                    requests_per_second=self.requests_per_second
+                )
+            elif self.fetcher == "zip":
+                self.fetcher = ZipArchiveFetcher(
+                    self.tmp_dir, self.requests_per_second, self.fetch_workers
+                )
+            return self.fetcher
+
+    def open_session(self):
+        """Get the HTTP session for pathway lists and archives, opening it on
+        first use
+        """
+        with self.lock:
+            if self.session is None:
+                self.session = get_session()
+                self.pathway_lists = PathwayListClient(
+                    self.tmp_dir, self.session
+                )
+            return self.session
+
+    def fetch_svgs(self, ids_and_names, org_dir, organism, fetched=None):
+        """Fetch raw SVGs for pathways, across concurrent fetch workers
+
+        When reusing the cache, pathways already fetched or that previously
+        failed are skipped, so an interrupted run resumes where it stopped.
+        Paths of raw SVGs, fetched or reused, are put in the `fetched` queue
+        as they're ready, if given.
+        """
         prev_error_wpids = []
         error_wpids = []
 
@@ -631,7 +3051,9 @@ class WikiPathwaysCache():
             with open(error_path) as f:
                 prev_error_wpids = f.read().split(",")
                 error_wpids = prev_error_wpids
+        error_lock = threading.Lock()
 
+        ids = []
         for i_n in ids_and_names:
             id = i_n[0]
             svg_path = org_dir + id + ".svg"
@@ -639,149 +3061,837 @@ class WikiPathwaysCache():
             if self.reuse:
                 if os.path.exists(svg_path):
                     print(f"Found cache; skip processing {id}")
+                    if fetched is not None:
+                        fetched.put(svg_path)
                     continue
                 elif id in prev_error_wpids:
                     print(f"Found previous error; skip processing {id}")
                     continue
 
-            url = f"https://www.wikipathways.org/index.php/Pathway:{id}?view=widget"
-            try:
-                driver = self.driver
-            except AttributeError:
-                # Only initializes once, and if not reusing populated cache
-                self.driver = webdriver.Chrome(ChromeDriverManager().install())
-                self.driver.implicitly_wait(3) # seconds
-                driver = self.driver
-            driver.get(url)
+            ids.append(id)
+
+        fetcher = self.get_fetcher()
+
+        def fetch_svg(id):
+            svg_path = org_dir + id + ".svg"
 
             try:
-                sleep(1)
-                selector = "svg.Diagram"
-                raw_content = self.driver.find_element_by_css_selector(selector)
-                content = raw_content.get_attribute("outerHTML")
+                content = fetcher.fetch(id, organism)
             except Exception as e:
                 print(f"Encountered error when stringifying SVG for {id}")
-                error_wpids.append(id)
-                with open(error_path, "w") as f:
-                    f.write(",".join(error_wpids))
-                sleep(0.5)
-                continue
-
-            svg = content.replace(
-                'typeof="Diagram" xmlns:xlink="http://www.w3.org/1999/xlink"',
-                'typeof="Diagram"'
-            )
+                with error_lock:
+                    error_wpids.append(id)
+                    write_atomically(error_path, ",".join(error_wpids))
+                return
 
             print("Preparing and writing " + svg_path)
 
-            svg = '<?xml version="1.0" encoding="UTF-8"?>\n' + svg
-
-            with open(svg_path, "w") as f:
-                f.write(svg)
-            sleep(1)
-
-    def optimize_svgs(self, org_dir):
-        for svg_path in glob.glob(f'{org_dir}*.svg'):
-        # for svg_path in ["tmp/homo-sapiens/WP231.svg"]: # debug
-            with open(svg_path, 'r') as f:
-                svg = f.read()
-
-            svg = re.sub("fill-opacity:inherit;", "", svg)
-            # print('clean_svg')
-            # print(clean_svg)
-            original_name = svg_path.split("/")[-1]
-            name = original_name.split(".svg")[0]
-            pwid = re.search(r"WP\d+", name).group() # pathway ID
-            optimized_svg_path = self.output_dir + pwid + ".svg"
-            print(f"Optimizing to create: {optimized_svg_path}")
-
-            scour_options = scour.sanitizeOptions()
-            scour_options.remove_metadata = False
-            scour_options.newlines = False
-            scour_options.strip_comments = True
-            scour_options.strip_ids = False
-            scour_options.shorten_ids = False
-            scour_options.strip_xml_space_attribute = True
-            scour_options.keep_defs = True
+            svg = prepare_raw_svg(content)
 
-            try:
-                clean_svg = scour.scourString(svg, options=scour_options)
-            except Exception as e:
-                print(f"Encountered error while optimizing SVG for {pwid}")
+            write_atomically(svg_path, svg)
+            if fetched is not None:
+                fetched.put(svg_path)
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            # Consume results, to raise any unexpected errors
+            list(executor.map(fetch_svg, ids))
+
+    def optimize_svgs(self, org_dir, fetched=None):
+        """Optimize raw SVGs for an organism, optionally across processes
+
+        Each file is optimized independently, so a failure in one pathway
+        doesn't stop the others.  Returns a dict mapping pathway ID to error
+        message, which is None for successfully optimized pathways.
+
+        With a `fetched` queue, raw SVGs are optimized as their paths arrive
+        from `fetch_svgs`, until it gets None, while the rest are fetched.
+        Then any others in `org_dir`, e.g. from earlier runs, are optimized.
+        """
+        def get_svg_paths():
+            queued_paths = set()
+            if fetched is not None:
+                for path in iter(fetched.get, None):
+                    queued_paths.add(path)
+                    yield path
+            for path in sorted(glob.glob(f'{org_dir}*.svg')):
+                if path not in queued_paths:
+                    yield path
+        # svg_paths = ["tmp/homo-sapiens/WP231.svg"] # debug
+
+        def get_tasks():
+            for path in get_svg_paths():
+                pwid = get_pwid(path)
+                input_hash = get_file_hash(path)
+                if self.low_memory:
+                    args = (
+                        path, pwid, self.output_dir, self.index, self.xrefs,
+                        self.lod
+                    )
+                    yield pwid, input_hash, stream_optimize_svg, args
+                    continue
+                args = (
+                    path, self.output_dir, self.profile_path is not None,
+                    self.index, self.xrefs, self.lod
+                )
+                yield pwid, input_hash, optimize_svg_file, args
+
+        # E.g. "tmp/homo-sapiens/" -> "homo-sapiens"
+        pack_name = org_dir.rstrip("/").split("/")[-1]
+        return self.run_optimizations(get_tasks(), org_dir, pack_name)
+
+    def is_unchanged(self, pwid, input_hash):
+        """Whether a pathway's output is current for its input and pipeline
+        """
+        entry = self.manifest.get(pwid)
+        if (
+            self.force or entry is None or
+            entry["input_sha256"] != input_hash or
+            entry["pipeline_version"] != self.pipeline_version
+        ):
+            return False
+
+        # Guard against outputs deleted or edited since the last run
+        optimized_svg_path = self.output_dir + pwid + ".svg"
+        if not os.path.exists(optimized_svg_path):
+            return False
+        return get_file_hash(optimized_svg_path) == entry["output_sha256"]
+
+    def record_in_manifest(self, pwid, input_hash):
+        """Note hashes for a successfully optimized pathway in the manifest
+        """
+        output_hash = get_file_hash(self.output_dir + pwid + ".svg")
+        # Keep what else is noted, e.g. which output the sidecars compress
+        with self.lock:
+            entry = self.manifest.setdefault(pwid, {})
+            entry.update({
+                "input_sha256": input_hash,
+                "pipeline_version": self.pipeline_version,
+                "output_sha256": output_hash
+            })
+
+    def record_stages(self, stages):
+        """Note a pathway's stage measurements, and append them to the profile
+        """
+        with self.lock:
+            self.stages.extend(stages)
+            with open(self.profile_path, "a") as f:
+                for stage in stages:
+                    f.write(json.dumps(stage) + "\n")
+
+    def has_current_sidecars(self, pwid):
+        """Whether compressed sidecars exist for a pathway's current output
+
+        Sidecars are addressed by the hash of the SVG they compress, so
+        re-optimizing a pathway to identical output doesn't remake them.
+        """
+        entry = self.manifest.get(pwid, {})
+        svg_path = self.output_dir + pwid + ".svg"
+        return (
+            "output_sha256" in entry and
+            entry.get("compressed_sha256") == entry["output_sha256"] and
+            os.path.exists(svg_path + ".gz") and
+            os.path.exists(svg_path + ".br")
+        )
+
+    def compress_svgs(self, pwids):
+        """Write gzip and Brotli sidecars for optimized SVGs, across processes
+
+        Pathways whose sidecars are current are skipped.  With `xrefs`, xref
+        sidecars are compressed too, and with `lod`, level-of-detail
+        variants, unless their Brotli variant is newer.  These can change
+        while the SVG doesn't, so they aren't tracked by the SVG's hash.
+        """
+        # Paths of xref sidecars and LOD variants to compress, by kind
+        other_paths = {}
+        if self.xrefs:
+            other_paths["xref sidecars"] = [xrefs_suffix]
+        if self.lod:
+            other_paths["LOD SVGs"] = [
+                get_lod_suffix(size) for size in self.lod
+            ]
+        for kind, suffixes in other_paths.items():
+            kind_paths = []
+            for pwid in pwids:
+                for suffix in suffixes:
+                    path = self.output_dir + pwid + suffix
+                    if os.path.exists(path) and not (
+                        os.path.exists(path + ".br") and
+                        os.path.getmtime(path + ".br") >=
+                        os.path.getmtime(path)
+                    ):
+                        kind_paths.append(path)
+            other_paths[kind] = kind_paths
+        pwids = [pwid for pwid in pwids if not self.has_current_sidecars(pwid)]
+        paths = [self.output_dir + pwid + ".svg" for pwid in pwids]
+        unhashed_paths = sum(other_paths.values(), [])
+
+        # Brotli holds the GIL, so use processes rather than threads
+        if self.workers > 1 and len(paths + unhashed_paths) > 1:
+            with self.get_process_pool() as executor:
+                svg_hashes = list(executor.map(compress_svg, paths))
+                list(executor.map(compress_svg, unhashed_paths))
+        else:
+            svg_hashes = [compress_svg(path) for path in paths]
+            for path in unhashed_paths:
+                compress_svg(path)
+
+        with self.lock:
+            for pwid, svg_hash in zip(pwids, svg_hashes):
+                self.manifest[pwid]["compressed_sha256"] = svg_hash
+        print(f"Compressed {len(pwids)} SVGs")
+        for kind, kind_paths in other_paths.items():
+            print(f"Compressed {len(kind_paths)} {kind}")
+
+    def write_size_report(self):
+        """Write sizes of optimized SVGs and their sidecars to `output_dir`
+
+        Also prints total sizes, across all pathways in the manifest.  With
+        `lod`, sizes of each level-of-detail variant are written and printed
+        too, compared to the full SVGs of pathways that have that variant.
+        """
+        header = "pwid,svg_bytes,gzip_bytes,brotli_bytes"
+        for size in self.lod:
+            header += f",lod{size}_bytes,lod{size}_brotli_bytes"
+        rows = [header]
+        totals = [0, 0, 0]
+
+        # Pathways with each LOD variant, and total bytes of their full SVGs
+        # and variants, uncompressed and with Brotli
+        lod_totals = {size: [0, 0, 0, 0, 0] for size in self.lod}
+        with self.lock:
+            pwids = sorted(set(self.manifest) - {sprite_manifest_key})
+        for pwid in pwids:
+            if not self.has_current_sidecars(pwid):
                 continue
+            svg_path = self.output_dir + pwid + ".svg"
+            paths = [svg_path, svg_path + ".gz", svg_path + ".br"]
+            sizes = [os.path.getsize(path) for path in paths]
+            totals = [total + size for total, size in zip(totals, sizes)]
+            row = [pwid] + [str(size) for size in sizes]
+            for size in self.lod:
+                lod_path = self.output_dir + pwid + get_lod_suffix(size)
+                lod_sizes = [
+                    os.path.getsize(path) if os.path.exists(path) else 0
+                    for path in [lod_path, lod_path + ".br"]
+                ]
+                if all(lod_sizes):
+                    level_sizes = [1, sizes[0], sizes[2]] + lod_sizes
+                    lod_totals[size] = [
+                        total + level_size for total, level_size
+                        in zip(lod_totals[size], level_sizes)
+                    ]
+                row += [str(lod_size) for lod_size in lod_sizes]
+            rows.append(",".join(row))
+
+        report_path = self.output_dir + "sizes.csv"
+        write_atomically(report_path, "\n".join(rows) + "\n")
+
+        svg_bytes, gzip_bytes, brotli_bytes = totals
+        if svg_bytes > 0:
+            print(
+                f"Sizes of {len(rows) - 1} SVGs: {svg_bytes} bytes, " +
+                f"{gzip_bytes} gzipped ({gzip_bytes / svg_bytes:.1%}), " +
+                f"{brotli_bytes} with Brotli " +
+                f"({brotli_bytes / svg_bytes:.1%}); details in {report_path}"
+            )
+        for size, level_totals in lod_totals.items():
+            count, svg_bytes, brotli_bytes, lod_bytes, lod_brotli_bytes = (
+                level_totals
+            )
+            if count == 0:
+                continue
+            print(
+                f"Sizes of {count} LOD SVGs for {size} pixels: " +
+                f"{lod_bytes} bytes ({lod_bytes / svg_bytes:.1%} of full " +
+                f"SVGs), {lod_brotli_bytes} with Brotli " +
+                f"({lod_brotli_bytes / brotli_bytes:.1%})"
+            )
 
-            repo_url = "https://github.com/eweitz/cachome/tree/main/"
-            code_url = f"{repo_url}src/wikipathways.py"
-            data_url = f"{repo_url}{optimized_svg_path}"
-            wp_url = f"https://www.wikipathways.org/index.php/Pathway:{pwid}"
-            provenance = "\n".join([
-                "<!--",
-                f"  WikiPathways page: {wp_url}",
-                f"  URL for this compressed file: {data_url}",
-                # f"  Uncompressed SVG file: {original_name}",
-                # f"  From upstream ZIP archive: {url}",
-                f"  Source code for compression: {code_url}",
-                "-->"
-            ])
-
-            clean_svg = clean_svg.replace(
-                '<?xml version="1.0" encoding="UTF-8"?>',
-                '<?xml version="1.0" encoding="UTF-8"?>\n' + provenance
+    def write_pack(self, name, pwids):
+        """Write optimized SVGs for pathways to one file, with an index
+
+        Blobs are the Brotli sidecars where current, to not compress twice.
+        They're streamed into the pack one by one, so memory doesn't grow
+        with the number of pathways.  See `PathwayPack` for the format and
+        reading.
+        """
+        header_size = struct.calcsize(pack_header_format)
+        pack_path = self.output_dir + name + ".pack"
+        with open_atomically(pack_path) as pack:
+            pack.seek(header_size)
+            entries = {}
+            for pwid in pwids:
+                svg_path = self.output_dir + pwid + ".svg"
+                if self.has_current_sidecars(pwid):
+                    with open(svg_path + ".br", "rb") as f:
+                        blob = f.read()
+                else:
+                    with open(svg_path, "rb") as f:
+                        blob = brotli.compress(
+                            f.read(), mode=brotli.MODE_TEXT, quality=11,
+                            lgwin=24
+                        )
+                entries[pwid] = [
+                    pack.tell(), len(blob),
+                    self.manifest[pwid]["output_sha256"]
+                ]
+                pack.write(blob)
+
+            index = json.dumps({"encoding": "br", "pathways": entries})
+            index_offset = pack.tell()
+            pack.write(index.encode("utf-8"))
+            pack.seek(0)
+            pack.write(struct.pack(
+                pack_header_format, pack_magic, index_offset, len(index)
+            ))
+        print(f"Packed {len(pwids)} SVGs into {pack_path}")
+
+    def hoist_shared_defs(self, pwid):
+        """Move icon symbols from a pathway's optimized SVG to the sprite sheet
+
+        The SVG is kept as is if that would leave any reference unresolved.
+        """
+        svg_path = self.output_dir + pwid + ".svg"
+        with open(svg_path) as f:
+            svg = f.read()
+        with self.lock:
+            hoisted_svg = hoist_symbols(svg, self.sprite_symbols)
+            sprite_ids = set(self.sprite_symbols)
+        if hoisted_svg == svg:
+            return
+
+        broken = (
+            get_unresolved_references(hoisted_svg, sprite_ids) -
+            get_unresolved_references(svg, sprite_ids)
+        )
+        if len(broken) > 0:
+            print(
+                f"Kept symbols inline in {pwid}, as hoisting them would " +
+                "break references: " + ",".join(sorted(broken))
             )
+            return
+        write_atomically(svg_path, hoisted_svg)
 
+    def write_sprite(self):
+        """Write the sprite sheet of hoisted symbols, if it has changed
 
+        Its hashes are noted in the manifest as a pathway's are, so servers
+        know when it and its sidecars change.
+        """
+        with self.lock:
+            sprite_svg = get_sprite_svg(self.sprite_symbols)
+            num_symbols = len(self.sprite_symbols)
+            sprite_hash = get_hash(sprite_svg.encode("utf-8"))
+            entry = self.manifest.setdefault(sprite_manifest_key, {})
+            is_changed = True
+            if os.path.exists(self.sprite_path):
+                with open(self.sprite_path) as f:
+                    is_changed = f.read() != sprite_svg
+            if is_changed:
+                write_atomically(self.sprite_path, sprite_svg)
+            entry["output_sha256"] = sprite_hash
+            if self.compress and (
+                is_changed or entry.get("compressed_sha256") != sprite_hash
+            ):
+                entry["compressed_sha256"] = compress_svg(self.sprite_path)
+        if is_changed:
+            print(f"Wrote {num_symbols} symbols to {self.sprite_path}")
+
+    def save_manifest(self):
+        """Write the manifest to `output_dir`
+        """
+        with self.lock:
+            manifest_json = json.dumps(self.manifest, indent=2, sort_keys=True)
+            write_atomically(self.manifest_path, manifest_json + "\n")
 
-            # clean_svg = re.sub('tspan x="0" y="0"', 'tspan', clean_svg)
-            clean_svg = custom_lossless_optimize_svg(clean_svg, pwid)
-            clean_svg = custom_lossy_optimize_svg(clean_svg)
+    def get_process_pool(self):
+        """Get a pool of `workers` processes, for use in a `with` statement
 
-            with open(optimized_svg_path, "w") as f:
-                f.write(clean_svg)
+        While `populate` runs, this is the pool its organisms share, which
+        stays open after the `with`.  Otherwise, it's a new pool.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        if self.process_pool:
+            return nullcontext(self.process_pool)
+        return ProcessPoolExecutor(max_workers=self.workers)
+
+    def run_optimizations(self, tasks, source, pack_name=None):
+        """Run (pwid, input_hash, function, args) optimization tasks
+
+        Tasks whose input and pipeline are unchanged since they were last
+        optimized, per the manifest in `output_dir`, are skipped.  Functions
+        return the pathway ID, an error message, any stage measurements, and
+        any terms to index the pathway by.
+
+        With `sprite`, icon symbols are moved from each optimized SVG to a
+        shared sprite sheet.  With `index`, each pathway's terms replace its
+        old ones in the `PathwayIndex` named `pack_name`, and pathways not in
+        the index aren't skipped.  Then, unless disabled, optimized SVGs get
+        compressed sidecars.  With `pack`, they're also written to one pack
+        file named `pack_name`.
+
+        With multiple workers, only a few tasks per worker are submitted ahead
+        of time, so tasks generated lazily (e.g. from a downloading archive)
+        are consumed at the pace they're optimized.
+        """
+        errors_by_pwid = {}
+        input_hashes = {}
+        unchanged_wpids = []
+
+        index = None
+        if self.index and pack_name:
+            index_path = self.output_dir + pack_name + ".index.sqlite"
+            index = PathwayIndex(index_path)
+
+        def get_changed_tasks():
+            for pwid, input_hash, function, args in tasks:
+                if self.is_unchanged(pwid, input_hash) and (
+                    index is None or index.get_input_hash(pwid) == input_hash
+                ):
+                    print(f"Found unchanged input; skip optimizing {pwid}")
+                    unchanged_wpids.append(pwid)
+                    continue
+                input_hashes[pwid] = input_hash
+                yield pwid, function, args
+
+        def finish(pwid, error, stages, terms):
+            errors_by_pwid[pwid] = error
+            if stages:
+                self.record_stages(stages)
+            if error is None:
+                if self.sprite:
+                    self.hoist_shared_defs(pwid)
+                self.record_in_manifest(pwid, input_hashes[pwid])
+                if index:
+                    index.update(pwid, input_hashes[pwid], terms)
+
+        try:
+            if self.workers > 1:
+                with self.get_process_pool() as executor:
+                    pending = {}
+
+                    def collect(futures):
+                        for future in futures:
+                            try:
+                                pwid, error, stages, terms = future.result()
+                            except Exception as e:
+                                # E.g. a worker process died
+                                pwid, error = pending[future], repr(e)
+                                stages, terms = None, None
+                            finish(pwid, error, stages, terms)
+                            del pending[future]
+
+                    for pwid, function, args in get_changed_tasks():
+                        if len(pending) >= 2 * self.workers:
+                            done, not_done = wait(
+                                pending, return_when=FIRST_COMPLETED
+                            )
+                            collect(done)
+                        pending[executor.submit(function, *args)] = pwid
+                    collect(list(as_completed(pending)))
+            else:
+                for pwid, function, args in get_changed_tasks():
+                    finish(*function(*args))
+        finally:
+            # Keep progress even if interrupted
+            if self.sprite:
+                self.write_sprite()
+            self.save_manifest()
+            if index:
+                index.commit()
+                index.close()
+
+        error_wpids = sorted([
+            pwid for pwid, error in errors_by_pwid.items() if error
+        ])
+        num_ok = len(errors_by_pwid) - len(error_wpids)
+        print(f"Optimized {num_ok} of {len(errors_by_pwid)} SVGs in {source}")
+        if len(unchanged_wpids) > 0:
+            print(f"Skipped {len(unchanged_wpids)} unchanged SVGs")
+        if len(error_wpids) > 0:
+            print("Failed to optimize: " + ",".join(error_wpids))
+        if index:
+            print(f"Indexed {num_ok} pathways in {index_path}")
+
+        ok_wpids = [
+            pwid for pwid, error in errors_by_pwid.items() if not error
+        ]
+        if self.compress:
+            try:
+                self.compress_svgs(ok_wpids + unchanged_wpids)
+            finally:
+                self.save_manifest()
+            self.write_size_report()
+        if self.pack and pack_name:
+            self.write_pack(pack_name, sorted(ok_wpids + unchanged_wpids))
+
+        return errors_by_pwid
+
+    def stream_svg_zip(self, organism):
+        """Optimize SVGs from an organism's zip archive while it downloads
+
+        Members are read in archive order and optimized one by one, so peak
+        memory stays bounded by the largest SVG rather than the archive, and
+        no raw SVG files are written.  The archive itself is saved, so later
+        runs with `reuse` read it from disk.
+        """
+        url = get_svg_zip_url(organism)
+        path = self.tmp_dir + url.split("/")[-1]
+        if self.reuse and os.path.exists(path):
+            print(f"Found cache; reading {path}")
+            chunks = read_chunks(path)
+        else:
+            print(f"Streaming {url}")
+            chunks = download_chunks(self.open_session(), url, path)
 
+        def get_tasks():
+            for name, content in iter_zip_members(chunks):
+                match = re.search(r"WP\d+", name.split("/")[-1])
+                if not name.endswith(".svg") or not match:
+                    continue
+                input_hash = get_hash(content)
+                svg = prepare_raw_svg(content.decode("utf-8"))
+                if self.low_memory:
+                    yield match.group(), input_hash, stream_optimize_svg, (
+                        svg.encode("utf-8"), match.group(), self.output_dir,
+                        self.index, self.xrefs, self.lod
+                    )
+                    continue
+                yield match.group(), input_hash, optimize_svg, (
+                    svg, match.group(), self.output_dir,
+                    self.profile_path is not None, self.index, self.xrefs,
+                    self.lod
+                )
 
-    def populate_by_org(self, organism):
-        """Fill caches for a configured organism
+        pack_name = organism.lower().replace(" ", "-")
+        return self.run_optimizations(get_tasks(), url, pack_name)
+
+    def get_org_dir(self, organism):
+        """Get the directory of an organism's raw SVGs, making it if need be
         """
         org_dir = self.tmp_dir + organism.lower().replace(" ", "-") + "/"
         if not os.path.exists(org_dir):
             os.makedirs(org_dir)
+        return org_dir
+
+    def fetch_by_org(self, organism):
+        """Fetch raw SVGs for a configured organism, without optimizing them
+        """
+        org_dir = self.get_org_dir(organism)
+        self.open_session()
+        ids_and_names = get_pathway_ids_and_names(
+            organism, self.pathway_lists
+        )
+        self.fetch_svgs(ids_and_names, org_dir, organism)
+
+    def optimize_by_org(self, organism):
+        """Optimize a configured organism's fetched raw SVGs, without fetching
+        """
+        org_dir = self.get_org_dir(organism)
+        self.optimize_svgs(org_dir)
 
-        ids_and_names = get_pathway_ids_and_names(organism)
+    def populate_by_org(self, organism):
+        """Fill caches for a configured organism
+        """
+        org_dir = self.get_org_dir(organism)
+
+        if self.stream:
+            self.stream_svg_zip(organism)
+            return
+
+        self.open_session()
+        ids_and_names = get_pathway_ids_and_names(
+            organism, self.pathway_lists
+        )
         # ids_and_names = [["WP231", "test"]]
         # print("ids_and_names", ids_and_names)
-        self.fetch_svgs(ids_and_names, org_dir)
-        self.optimize_svgs(org_dir)
+
+        # Optimize SVGs as they're fetched, rather than after all are.  The
+        # queue holds only paths, and `run_optimizations` bounds how many
+        # SVGs are read ahead of optimizing, so it needn't be bounded.
+        fetched = queue.Queue()
+
+        def fetch_svgs():
+            try:
+                self.fetch_svgs(ids_and_names, org_dir, organism, fetched)
+            finally:
+                fetched.put(None)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            fetching = executor.submit(fetch_svgs)
+            self.optimize_svgs(org_dir, fetched)
+            # Raise any unexpected error from fetching
+            fetching.result()
 
     def populate(self):
         """Fill caches for all configured organisms
 
-        Consider parallelizing this.
+        Up to `org_workers` organisms populate concurrently.  They share the
+        fetcher, with its rate limit, and a pool of `workers` processes for
+        optimizing, so CPU-bound optimizing of one organism's pathways
+        overlaps network-bound fetching of the others.
+        """
+        self.run_by_org(self.populate_by_org)
+
+    def fetch(self):
+        """Fetch raw SVGs for all configured organisms, to optimize later
         """
-        for organism in organisms:
-            self.populate_by_org(organism)
+        self.run_by_org(self.fetch_by_org)
+
+    def optimize(self):
+        """Optimize raw SVGs already fetched for all configured organisms
+
+        This needs no network, nor imports anything only fetching needs.
+        """
+        self.run_by_org(self.optimize_by_org)
+
+    def run_by_org(self, function):
+        """Call a function with each configured organism, concurrently as
+        `populate` does
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        try:
+            if self.workers > 1:
+                self.process_pool = ProcessPoolExecutor(
+                    max_workers=self.workers
+                )
+            with ThreadPoolExecutor(max_workers=self.org_workers) as executor:
+                # Consume results, to raise any unexpected errors
+                list(executor.map(function, organisms))
+        finally:
+            if self.process_pool:
+                self.process_pool.shutdown()
+                self.process_pool = None
+            if not isinstance(self.fetcher, str):
+                self.fetcher.close()
+            if self.profile_path:
+                self.print_profile()
+
+    def print_profile(self):
+        """Summarize time and bytes saved per optimize stage, across pathways
+        """
+        print(f"Optimize stages, per pathway; details in {self.profile_path}")
+        if len(self.stages) == 0:
+            print("No SVGs optimized")
+            return
+        for row in summarize_stages(self.stages):
+            print(row)
 
 # Command-line handler
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description=__doc__,
-        formatter_class=argparse.RawDescriptionHelpFormatter
-    )
-    parser.add_argument(
+    # Options by the commands that use them; `populate` uses them all
+    fetch_options = argparse.ArgumentParser(add_help=False)
+    optimize_options = argparse.ArgumentParser(add_help=False)
+    org_options = argparse.ArgumentParser(add_help=False)
+
+    optimize_options.add_argument(
         "--output-dir",
         help=(
-            "Directory to put outcome data.  (default: %(default))"
+            "Directory to put outcome data.  (default: %(default)s)"
         ),
         default="data/"
     )
-    parser.add_argument(
+    fetch_options.add_argument(
         "--reuse",
         help=(
             "Whether to use previously-downloaded raw SVG zip archives"
         ),
         action="store_true"
     )
-    args = parser.parse_args()
-    output_dir = args.output_dir
-    reuse = args.reuse
+    optimize_options.add_argument(
+        "--workers",
+        help=(
+            "Number of processes to use when optimizing SVGs.  (default: 1)"
+        ),
+        type=int,
+        default=1
+    )
+    fetch_options.add_argument(
+        "--fetch-workers",
+        help=(
+            "Number of browsers to fetch SVGs with concurrently.  (default: 1)"
+        ),
+        type=int,
+        default=1
+    )
+    fetch_options.add_argument(
+        "--rate",
+        help=(
+            "Maximum pathway page requests per second, across all fetch " +
+            "workers.  (default: 1)"
+        ),
+        type=float,
+        default=1
+    )
+    fetch_options.add_argument(
+        "--fetcher",
+        help=(
+            "How to fetch raw SVGs: by rendering pathway pages in a browser " +
+            "(selenium), or from per-organism SVG zip archives over plain " +
+            "HTTP (zip).  (default: selenium)"
+        ),
+        choices=["selenium", "zip"],
+        default="selenium"
+    )
+    optimize_options.add_argument(
+        "--force",
+        help=(
+            "Re-optimize SVGs even if their input and the optimizer are " +
+            "unchanged since the last run"
+        ),
+        action="store_true"
+    )
+    optimize_options.add_argument(
+        "--low-memory",
+        help=(
+            "Optimize each SVG in chunks streamed through Scour and the " +
+            "DOM passes, so peak memory doesn't grow with diagram size.  " +
+            "Ignores --profile."
+        ),
+        action="store_true"
+    )
+    optimize_options.add_argument(
+        "--profile",
+        help=(
+            "Record wall time, CPU time and output size after each optimize " +
+            "stage for each pathway to this JSON Lines file, and summarize " +
+            "them at the end"
+        ),
+        metavar="PATH"
+    )
+    optimize_options.add_argument(
+        "--no-compress",
+        help=(
+            "Don't write gzip and Brotli sidecars for optimized SVGs"
+        ),
+        action="store_true"
+    )
+    optimize_options.add_argument(
+        "--pack",
+        help=(
+            "Also write each organism's optimized SVGs to one file, with an " +
+            "index for random access"
+        ),
+        action="store_true"
+    )
+    optimize_options.add_argument(
+        "--index",
+        help=(
+            "Index pathways by the gene and metabolite identifiers and " +
+            "labels in them, in ORGANISM.index.sqlite in the output " +
+            "directory, e.g. to find which pathways mention TP53"
+        ),
+        action="store_true"
+    )
+    optimize_options.add_argument(
+        "--xrefs",
+        help=(
+            "Write data that lossy optimization removes (xrefs, links, " +
+            f"RDFa) by element ID to a sidecar, e.g. WP554{xrefs_suffix}, " +
+            "that clients can fetch when a user interacts with a diagram"
+        ),
+        action="store_true"
+    )
+    optimize_options.add_argument(
+        "--lod",
+        help=(
+            "Also write a level-of-detail variant of each optimized SVG " +
+            "for rendering at most this many pixels wide or high, e.g. " +
+            "WP554.lod200.svg for thumbnails, without shapes and text too " +
+            "small to see.  Takes one or more sizes."
+        ),
+        metavar="PIXELS",
+        type=int,
+        nargs="+"
+    )
+    optimize_options.add_argument(
+        "--sprite",
+        help=(
+            "Move icon symbols from optimized SVGs to a shared sprite sheet, " +
+            f"{sprite_name}, which browsers can cache once"
+        ),
+        action="store_true"
+    )
+    org_options.add_argument(
+        "--org-workers",
+        help=(
+            "Number of organisms to process concurrently.  " +
+            "(default: all configured organisms)"
+        ),
+        type=int
+    )
 
-    WikiPathwaysCache(output_dir, reuse).populate()
+    parser = argparse.ArgumentParser(
+        description=(
+            "Fetch WikiPathways SVGs, and optimize them for the web.  " +
+            "Without a command, runs populate."
+        )
+    )
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    commands.add_parser(
+        "fetch",
+        help="Fetch raw SVGs into tmp/, without optimizing them",
+        parents=[fetch_options, org_options]
+    )
+    commands.add_parser(
+        "optimize",
+        help=(
+            "Optimize raw SVGs fetched into tmp/ earlier, without any " +
+            "network requests"
+        ),
+        parents=[optimize_options, org_options]
+    )
+    populate_parser = commands.add_parser(
+        "populate",
+        help=(
+            "Fetch raw SVGs and optimize them as they arrive.  (default)"
+        ),
+        parents=[fetch_options, optimize_options, org_options]
+    )
+    populate_parser.add_argument(
+        "--stream",
+        help=(
+            "Optimize SVGs from per-organism zip archives as they download, " +
+            "without writing raw SVG files"
+        ),
+        action="store_true"
+    )
+
+    # Options alone, as before there were commands, still mean `populate`
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in commands.choices and argv[0] not in [
+        "-h", "--help"
+    ]:
+        argv = ["populate"] + argv
+    args = parser.parse_args(argv)
+    output_dir = getattr(args, "output_dir", "data/")
+    reuse = getattr(args, "reuse", False)
+    workers = getattr(args, "workers", 1)
+    fetch_workers = getattr(args, "fetch_workers", 1)
+    rate = getattr(args, "rate", 1)
+    fetcher = getattr(args, "fetcher", "selenium")
+    stream = getattr(args, "stream", False)
+    force = getattr(args, "force", False)
+    profile_path = getattr(args, "profile", None)
+    compress = not getattr(args, "no_compress", False)
+    pack = getattr(args, "pack", False)
+    sprite = getattr(args, "sprite", False)
+    org_workers = args.org_workers
+    low_memory = getattr(args, "low_memory", False)
+    index = getattr(args, "index", False)
+    xrefs = getattr(args, "xrefs", False)
+    lod = getattr(args, "lod", None)
+
+    cache = WikiPathwaysCache(
+        output_dir, reuse, workers, fetch_workers, rate, fetcher, stream, force,
+        profile_path, compress, pack, sprite, org_workers,
+        low_memory, index, xrefs, lod
+    )
+    if args.command == "fetch":
+        cache.fetch()
+    elif args.command == "optimize":
+        cache.optimize()
+    else:
+        cache.populate()
@@ -0,0 +1,112 @@
+from functools import partial
+import http.client
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import os
+import shutil
+import sys
+import threading
+
+import pytest
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+fixtures_dir = os.path.join(tests_dir, "fixtures", "")
+
+sys.path.insert(0, os.path.join(tests_dir, "..", "src"))
+
+# Raw SVGs in tests/fixtures/, by pathway ID
+fixture_pwids = ["WP106", "WP4925"]
+
+def read_fixture(name, mode="r"):
+    """Read a file in tests/fixtures/
+    """
+    with open(fixtures_dir + name, mode) as f:
+        return f.read()
+
+class QuietFileHandler(SimpleHTTPRequestHandler):
+    """Serve files from a directory, without logging each request
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def output_dir(tmp_path):
+    """An empty directory, as a path ending in a slash like `output_dir`s
+    """
+    return os.path.join(str(tmp_path), "")
+
+@pytest.fixture
+def optimize_fixtures(tmp_path, monkeypatch):
+    """Optimize the fixture SVGs as a fetched organism's, in a temporary
+    working directory, with options for `WikiPathwaysCache`
+
+    Returns the cache, whose output is in data/.
+    """
+    import wikipathways
+
+    monkeypatch.chdir(tmp_path)
+    org_dir = "tmp/homo-sapiens/"
+
+    def optimize(**options):
+        os.makedirs(org_dir, exist_ok=True)
+        for pwid in fixture_pwids:
+            shutil.copy(fixtures_dir + pwid + ".svg", org_dir)
+        cache = wikipathways.WikiPathwaysCache("data/", **options)
+        cache.optimize_svgs(org_dir)
+        return cache
+
+    return optimize
+
+@pytest.fixture
+def start_server():
+    """Start local HTTP servers in threads, stopped after the test
+
+    Call with a request handler class, or a directory to serve files from.
+    Returns the server's base URL, e.g. "http://127.0.0.1:8000/".
+    """
+    servers = []
+
+    def start(handler):
+        if isinstance(handler, str):
+            handler = partial(QuietFileHandler, directory=handler)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}/"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def serve_data():
+    """Serve a data directory with `serve.py`, stopped after the test
+
+    Call with the directory.  Returns a function that requests a path, with
+    any headers, and gets the response and its body.
+    """
+    import serve
+
+    servers = []
+
+    def start(data_dir):
+        server = serve.make_server(data_dir, port=0, check_interval=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+
+        def get(path, headers={}):
+            connection = http.client.HTTPConnection(*server.server_address)
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+            connection.close()
+            return response, body
+
+        return get
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
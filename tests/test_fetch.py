@@ -0,0 +1,236 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import os
+import shutil
+import threading
+import zipfile
+
+import pytest
+
+from conftest import QuietFileHandler, fixture_pwids, read_fixture
+import wikipathways
+
+def get_member_name(pwid):
+    """Get a name like those of SVGs in WikiPathways' zip archives
+    """
+    return f"wikipathways-20211110-svg-Homo_sapiens/Hs_Pathway_{pwid}_1.svg"
+
+def make_zip(members, stream=False):
+    """Make zip archive bytes of (name, content, compression) members
+
+    Written to a non-seekable stream, members get data descriptors after
+    their content, as some archivers write them.
+    """
+    f = io.BytesIO()
+    target = f
+    if stream:
+        class Unseekable(io.RawIOBase):
+            def writable(self):
+                return True
+
+            def write(self, data):
+                return f.write(data)
+
+        target = Unseekable()
+    with zipfile.ZipFile(target, "w") as archive:
+        for name, content, compression in members:
+            archive.writestr(name, content, compress_type=compression)
+    return f.getvalue()
+
+def get_fixture_members(compressions=None):
+    """Get members for `make_zip` of the fixture SVGs then a directory, by
+    default deflated, uncompressed and uncompressed
+    """
+    compressions = compressions or [
+        zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED, zipfile.ZIP_STORED
+    ]
+    names = [get_member_name(pwid) for pwid in fixture_pwids]
+    contents = [read_fixture(pwid + ".svg") for pwid in fixture_pwids]
+    names.append("wikipathways-20211110-svg-Homo_sapiens/")
+    contents.append("")
+    return list(zip(names, contents, compressions))
+
+def split_chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+class FakeClock():
+    """A clock that only advances when slept on
+    """
+
+    def __init__(self, now=100.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+def test_rate_limiter_spaces_out_requests():
+    clock = FakeClock()
+    limiter = wikipathways.RateLimiter(4, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        limiter.wait()
+    assert clock.sleeps == [0.25, 0.25]
+
+    # Time already passed counts toward the interval
+    clock.now += 0.1
+    limiter.wait()
+    assert clock.sleeps[2:] == [pytest.approx(0.15)]
+
+    # Idle time isn't banked for later bursts
+    clock.now += 10
+    limiter.wait()
+    limiter.wait()
+    assert clock.sleeps[3:] == [0.25]
+
+def test_rate_limiter_without_limit_never_sleeps():
+    clock = FakeClock()
+    limiter = wikipathways.RateLimiter(0, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        limiter.wait()
+    assert clock.sleeps == []
+
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 29, 30, 31, 4096])
+def test_iter_zip_members_across_chunk_boundaries(stream, chunk_size):
+    # Chunks this small split signatures, local file headers, names and
+    # data descriptors across chunk boundaries.  Uncompressed members can't
+    # have data descriptors, as their end couldn't be found.
+    members = get_fixture_members(
+        [zipfile.ZIP_DEFLATED] * 3 if stream else None
+    )
+    data = make_zip(members, stream)
+    chunks = split_chunks(data, chunk_size)
+
+    extracted = list(wikipathways.iter_zip_members(chunks))
+    assert extracted == [
+        (name, content.encode("utf-8"))
+        for name, content, _ in members if not name.endswith("/")
+    ]
+
+def test_iter_zip_members_rejects_uncompressed_members_of_unknown_size():
+    members = get_fixture_members([zipfile.ZIP_STORED] * 3)
+    with pytest.raises(zipfile.BadZipFile):
+        list(wikipathways.iter_zip_members([make_zip(members, stream=True)]))
+
+def test_iter_zip_members_checks_crc():
+    data = bytearray(make_zip(get_fixture_members()))
+    # Corrupt a byte of the uncompressed member's content
+    name = get_member_name("WP4925").encode("utf-8")
+    data[data.index(name) + len(name) + 100] ^= 0x01
+    with pytest.raises(zipfile.BadZipFile):
+        list(wikipathways.iter_zip_members([bytes(data)]))
+
+def test_zip_archive_fetcher(start_server, tmp_path):
+    served_dir = tmp_path / "served"
+    served_dir.mkdir()
+    archive_dir = os.path.join(str(tmp_path), "")
+    name = "wikipathways-20211110-svg-Homo_sapiens.zip"
+    (served_dir / name).write_bytes(make_zip(get_fixture_members()))
+    base_url = start_server(str(served_dir))
+
+    fetcher = wikipathways.ZipArchiveFetcher(
+        archive_dir, requests_per_second=0,
+        get_url=lambda organism: base_url + name
+    )
+    try:
+        for pwid in fixture_pwids:
+            svg = fetcher.fetch(pwid, "Homo sapiens")
+            assert svg == read_fixture(pwid + ".svg")
+        with pytest.raises(KeyError):
+            fetcher.fetch("WP1", "Homo sapiens")
+    finally:
+        fetcher.close()
+
+    assert os.path.exists(archive_dir + name)
+
+def has_chrome():
+    return any(
+        shutil.which(name) for name in
+        ["google-chrome", "chromium", "chromium-browser", "chrome"]
+    )
+
+@pytest.mark.skipif(not has_chrome(), reason="needs Chrome")
+def test_selenium_fetcher(start_server, tmp_path):
+    pytest.importorskip("selenium")
+    pytest.importorskip("webdriver_manager")
+
+    # Widget pages, with a diagram that renders a moment after loading
+    for pwid in fixture_pwids:
+        svg = read_fixture(pwid + ".svg").split("?>", 1)[1]
+        (tmp_path / f"{pwid}.html").write_text(
+            "<html><body><div id='diagram'></div><script>" +
+            "setTimeout(function () {" +
+            "document.getElementById('diagram').innerHTML = " +
+            json.dumps(svg) + ";" +
+            "}, 200);</script></body></html>"
+        )
+    base_url = start_server(str(tmp_path))
+
+    fetcher = wikipathways.SeleniumFetcher(
+        base_url + "{id}.html", timeout=10, requests_per_second=0
+    )
+    try:
+        for pwid in fixture_pwids:
+            svg = fetcher.fetch(pwid, "Homo sapiens")
+            assert svg.startswith("<svg")
+            assert 'class="Diagram"' in svg
+    finally:
+        fetcher.close()
+
+def test_zip_archive_fetcher_downloads_organisms_concurrently(
+    start_server, tmp_path
+):
+    served_dir = tmp_path / "served"
+    served_dir.mkdir()
+    archive_dir = os.path.join(str(tmp_path), "")
+    archive = make_zip(get_fixture_members())
+    for organism in ["Homo_sapiens", "Mus_musculus"]:
+        (served_dir / f"{organism}.zip").write_bytes(archive)
+
+    # Mouse downloads stall until released
+    release = threading.Event()
+    requests = []
+
+    class Handler(QuietFileHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=str(served_dir), **kwargs)
+
+        def do_GET(self):
+            requests.append(self.path)
+            if "Mus" in self.path:
+                release.wait(10)
+            super().do_GET()
+
+    base_url = start_server(Handler)
+    fetcher = wikipathways.ZipArchiveFetcher(
+        archive_dir, requests_per_second=0, pool_size=4,
+        get_url=lambda organism: (
+            base_url + organism.replace(" ", "_") + ".zip"
+        )
+    )
+    try:
+        with ThreadPoolExecutor(4) as executor:
+            mouse_svgs = [
+                executor.submit(fetcher.fetch, pwid, "Mus musculus")
+                for pwid in fixture_pwids
+            ]
+            # Human fetches don't wait for the mouse download
+            human_svg = executor.submit(fetcher.fetch, "WP106", "Homo sapiens")
+            assert human_svg.result(5) == read_fixture("WP106.svg")
+            assert not any(future.done() for future in mouse_svgs)
+
+            release.set()
+            assert [future.result(5) for future in mouse_svgs] == [
+                read_fixture(pwid + ".svg") for pwid in fixture_pwids
+            ]
+    finally:
+        release.set()
+        fetcher.close()
+
+    # Each archive was downloaded once, however many fetches wanted it
+    assert sorted(requests) == ["/Homo_sapiens.zip", "/Mus_musculus.zip"]
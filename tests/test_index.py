@@ -0,0 +1,32 @@
+import pytest
+
+from conftest import fixtures_dir, read_fixture
+import wikipathways
+
+# Labels whose markup has entities, by the pathway and element they're in
+labels = [
+    ("WP106", "f52d0", "Glycolysis & gluconeogenesis"),
+    ("WP4925", "d97f7", "IRE1\U000f2c97"),
+]
+
+@pytest.mark.parametrize("pwid, element_id, label", labels)
+def test_index_terms_are_unescaped_in_every_mode(
+    output_dir, pwid, element_id, label
+):
+    terms = wikipathways.optimize_svg(
+        read_fixture(pwid + ".svg"), pwid, output_dir, index=True
+    )[3]
+    stream_terms = wikipathways.stream_optimize_svg(
+        fixtures_dir + pwid + ".svg", pwid, output_dir, index=True
+    )[3]
+    assert (label.lower(), element_id) in terms
+    assert stream_terms == terms
+
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_lookup_finds_labels_with_entities(optimize_fixtures, low_memory):
+    cache = optimize_fixtures(index=True, low_memory=low_memory)
+    for pwid, element_id, label in labels:
+        element_ids_by_pwid = wikipathways.lookup_pathways(
+            label, cache.output_dir
+        )
+        assert element_id in element_ids_by_pwid[pwid]
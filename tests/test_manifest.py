@@ -0,0 +1,122 @@
+import json
+import os
+
+import pytest
+
+from conftest import fixture_pwids, read_fixture
+import wikipathways
+
+class FixtureFetcher():
+    """Fetch raw SVGs from a dict by pathway ID, as a stand-in for
+    WikiPathways
+    """
+
+    def __init__(self, svgs):
+        self.svgs = svgs
+
+    def fetch(self, id, organism):
+        return self.svgs[id]
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def populate(tmp_path, monkeypatch):
+    """Populate the cache for one organism, with the fixture pathways, and
+    get the manifest
+
+    Call with a dict of raw SVG by pathway ID, which the test can change
+    between calls.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(wikipathways, "organisms", ["Homo sapiens"])
+
+    def populate(svgs):
+        monkeypatch.setattr(
+            wikipathways, "get_pathway_ids_and_names",
+            lambda organism, client=None: [[pwid, ""] for pwid in svgs]
+        )
+        cache = wikipathways.WikiPathwaysCache(
+            "data/", fetcher=FixtureFetcher(svgs)
+        )
+        cache.populate()
+        with open(cache.manifest_path) as f:
+            return json.load(f)
+
+    return populate
+
+def get_inode(pwid):
+    # Outputs are replaced whole when written, so get a new inode
+    return os.stat(f"data/{pwid}.svg").st_ino
+
+def test_populate_skips_unchanged_pathways(populate, capsys):
+    svgs = {pwid: read_fixture(pwid + ".svg") for pwid in fixture_pwids}
+    manifest = populate(svgs)
+    assert set(fixture_pwids) <= set(manifest)
+    inodes = {pwid: get_inode(pwid) for pwid in fixture_pwids}
+    capsys.readouterr()
+
+    svgs["WP4925"] = svgs["WP4925"].replace(
+        "</svg>", "<!-- Edited upstream --></svg>"
+    )
+    new_manifest = populate(svgs)
+    out = capsys.readouterr().out
+
+    assert "skip optimizing WP106" in out
+    assert get_inode("WP106") == inodes["WP106"]
+    assert new_manifest["WP106"] == manifest["WP106"]
+
+    assert "skip optimizing WP4925" not in out
+    assert get_inode("WP4925") != inodes["WP4925"]
+    assert (
+        new_manifest["WP4925"]["input_sha256"] !=
+        manifest["WP4925"]["input_sha256"]
+    )
+
+def get_sidecar_inodes():
+    # Sidecars are also replaced whole when written
+    return {
+        pwid + suffix: os.stat(f"data/{pwid}.svg{suffix}").st_ino
+        for pwid in fixture_pwids for suffix in [".gz", ".br"]
+    }
+
+def test_populate_remakes_only_missing_or_stale_sidecars(populate, capsys):
+    svgs = {pwid: read_fixture(pwid + ".svg") for pwid in fixture_pwids}
+    manifest = populate(svgs)
+    for pwid in fixture_pwids:
+        entry = manifest[pwid]
+        assert entry["compressed_sha256"] == entry["output_sha256"]
+    inodes = get_sidecar_inodes()
+    capsys.readouterr()
+
+    # A comment changes the input, but not the output it optimizes to
+    svgs["WP4925"] = svgs["WP4925"].replace(
+        "</svg>", "<!-- Edited upstream --></svg>"
+    )
+    populate(svgs)
+    assert "Compressed 0 SVGs" in capsys.readouterr().out
+    assert get_sidecar_inodes() == inodes
+
+    os.remove("data/WP106.svg.gz")
+    populate(svgs)
+    assert "Compressed 1 SVGs" in capsys.readouterr().out
+    new_inodes = get_sidecar_inodes()
+    for name in inodes:
+        if name.startswith("WP106"):
+            assert new_inodes[name] != inodes[name]
+        else:
+            assert new_inodes[name] == inodes[name]
+
+def test_pipeline_version_follows_rule_tables(monkeypatch):
+    version = wikipathways.get_pipeline_version()
+    monkeypatch.setattr(
+        wikipathways, "lossy_attribute_rules",
+        wikipathways.lossy_attribute_rules + [('data-x="[^"]*"', '')]
+    )
+    wikipathways.get_pipeline_version.cache_clear()
+    try:
+        assert wikipathways.get_pipeline_version() != version
+    finally:
+        monkeypatch.undo()
+        wikipathways.get_pipeline_version.cache_clear()
+    assert wikipathways.get_pipeline_version() == version
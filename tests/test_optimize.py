@@ -0,0 +1,114 @@
+import os
+
+from lxml import etree
+import pytest
+
+from conftest import fixture_pwids, fixtures_dir, read_fixture
+import wikipathways
+
+def read_canonical(path):
+    """Read an SVG file as canonical XML, which ignores e.g. attribute order
+    and whitespace within tags
+    """
+    return etree.tostring(etree.parse(path), method="c14n")
+
+# Fixtures fit in one default batch, so smaller batches are also tried
+@pytest.mark.parametrize("batch_size", [
+    wikipathways.stream_batch_size, 4096, 1024
+])
+@pytest.mark.parametrize("pwid", fixture_pwids)
+def test_low_memory_output_matches_default(tmp_path, pwid, batch_size):
+    output_dir = str(tmp_path / "default") + "/"
+    stream_output_dir = str(tmp_path / "stream") + "/"
+    os.makedirs(output_dir)
+    os.makedirs(stream_output_dir)
+
+    wikipathways.optimize_svg(read_fixture(pwid + ".svg"), pwid, output_dir)
+    wikipathways.stream_optimize_svg(
+        fixtures_dir + pwid + ".svg", pwid, stream_output_dir,
+        batch_size=batch_size
+    )
+    svg = read_canonical(output_dir + pwid + ".svg")
+    assert read_canonical(stream_output_dir + pwid + ".svg") == svg
+
+@pytest.mark.parametrize("pwid", fixture_pwids)
+def test_profile_counts_pruned_definitions(output_dir, pwid):
+    pwid, error, stages, terms = wikipathways.optimize_svg(
+        read_fixture(pwid + ".svg"), pwid, output_dir, profile=True
+    )
+    assert error is None
+    dom_stage = [stage for stage in stages if stage["stage"] == "dom"][0]
+    pruned = dom_stage["pruned"]
+    assert set(pruned) == set(wikipathways.pruned_kinds + ["bytes"])
+    assert pruned["markers"] > 0 and pruned["clip_paths"] > 0
+    assert pruned["bytes"] > 0
+
+def test_pruning_is_not_logged(output_dir, capsys):
+    for pwid in fixture_pwids:
+        wikipathways.optimize_svg(
+            read_fixture(pwid + ".svg"), pwid, output_dir
+        )
+        wikipathways.stream_optimize_svg(
+            fixtures_dir + pwid + ".svg", pwid, output_dir
+        )
+    assert "Pruned" not in capsys.readouterr().out
+
+def get_text_sizes(element, font_size):
+    """Get the font size of each text element in an element's content
+    """
+    sizes = []
+    for child in element.iterchildren(etree.Element):
+        child_font_size = wikipathways.get_font_size(child, font_size)
+        if child.tag == wikipathways.svg_ns + "text":
+            sizes.append(child_font_size)
+        else:
+            sizes += get_text_sizes(child, child_font_size)
+    return sizes
+
+@pytest.mark.parametrize("pwid", fixture_pwids)
+def test_lod_svg_drops_detail_and_keeps_geometry(output_dir, pwid):
+    size = 200
+    wikipathways.optimize_svg(
+        read_fixture(pwid + ".svg"), pwid, output_dir, lod=[size]
+    )
+    with open(output_dir + pwid + ".svg", encoding="utf-8") as f:
+        svg = f.read()
+    lod_path = output_dir + pwid + wikipathways.get_lod_suffix(size)
+    with open(lod_path, encoding="utf-8") as f:
+        lod_svg = f.read()
+    root = etree.fromstring(svg.encode("utf-8"))
+    lod_root = etree.fromstring(lod_svg.encode("utf-8"))
+
+    for name in ["viewBox", "width", "height", "preserveAspectRatio"]:
+        assert lod_root.get(name) == root.get(name)
+    view_boxes = {
+        element.get("id"): element.get("viewBox")
+        for element in root.iterfind(".//*[@viewBox]")
+    }
+    for element in lod_root.iterfind(".//*[@viewBox]"):
+        assert element.get("viewBox") == view_boxes[element.get("id")]
+
+    references = wikipathways.get_references(lod_svg)
+    assert references
+    assert references <= set(lod_root.xpath("//@id"))
+
+    # Text too small to read at `size` pixels is dropped, and only that
+    background = root.find(f".//{wikipathways.svg_ns}g[@id='{pwid}']")
+    background = background.find(f".//{wikipathways.svg_ns}rect")
+    scale = size / max(
+        float(background.get("width")), float(background.get("height"))
+    )
+    min_font_size = wikipathways.lod_min_text_pixels / scale
+    css = "".join(root.itertext(wikipathways.svg_ns + "style"))
+    default_font_size = wikipathways.get_length(
+        wikipathways.default_text_size_regex.search(css).group(1)
+    )
+    text_sizes = get_text_sizes(root, default_font_size)
+    lod_text_sizes = get_text_sizes(lod_root, default_font_size)
+    assert min(text_sizes) < min_font_size
+    assert sorted(lod_text_sizes) == sorted(
+        text_size for text_size in text_sizes if text_size >= min_font_size
+    )
+    for tag in ["desc", "title"]:
+        assert lod_root.find(f".//{wikipathways.svg_ns}{tag}") is None
+    assert len(lod_svg) < len(svg)
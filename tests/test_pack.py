@@ -0,0 +1,22 @@
+import pytest
+
+from conftest import fixture_pwids
+import wikipathways
+
+# Without sidecars, pack blobs are compressed when packing
+@pytest.mark.parametrize("compress", [True, False])
+def test_pack_round_trip(optimize_fixtures, compress):
+    cache = optimize_fixtures(pack=True, compress=compress)
+    pack = wikipathways.PathwayPack(cache.output_dir + "homo-sapiens.pack")
+    try:
+        assert sorted(pack.get_pwids()) == sorted(fixture_pwids)
+        assert pack.encoding == "br"
+        for pwid in fixture_pwids:
+            with open(cache.output_dir + pwid + ".svg", "rb") as f:
+                svg = f.read()
+            assert pack.get_svg(pwid) == svg.decode("utf-8")
+            assert pack.get_sha256(pwid) == wikipathways.get_hash(svg)
+        with pytest.raises(KeyError):
+            pack.get_svg("WP1")
+    finally:
+        pack.close()
@@ -0,0 +1,120 @@
+from http.server import BaseHTTPRequestHandler
+import json
+from time import sleep
+
+import pytest
+import requests
+
+import wikipathways
+
+pathways = [
+    {"id": "WP106", "name": "Alanine and aspartate metabolism"},
+    {"id": "WP4925", "name": "Unfolded protein response"},
+]
+
+def start_stub(start_server, responses):
+    """Start a stub listPathways server that gives queued responses
+
+    Each response is a status code, "304 if validated", or "hang", which
+    sleeps past client timeouts.  Returns the URL and the list of requests
+    it gets, as (query, headers).
+    """
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append((self.path.split("?")[1], dict(self.headers)))
+            response = responses.pop(0)
+            if response == "hang":
+                sleep(0.5)
+                response = 200
+            if response == "304 if validated":
+                validated = self.headers.get("If-None-Match") == '"v1"'
+                response = 304 if validated else 200
+
+            body = b""
+            if response == 200:
+                body = json.dumps({"pathways": pathways}).encode("utf-8")
+            self.send_response(response)
+            if response in [200, 304]:
+                self.send_header("ETag", '"v1"')
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return start_server(Handler) + "listPathways", requests_seen
+
+def get_client(url, cache_dir, **kwargs):
+    return wikipathways.PathwayListClient(
+        cache_dir, url=url, backoff=0, timeout=0.2, **kwargs
+    )
+
+def test_gets_and_caches_list(start_server, output_dir):
+    url, requests_seen = start_stub(start_server, [200])
+    client = get_client(url, output_dir)
+
+    assert client.get_pathways("Homo sapiens") == pathways
+    assert len(requests_seen) == 1
+    query, headers = requests_seen[0]
+    assert "organism=Homo+sapiens" in query
+    assert "If-None-Match" not in headers
+
+    with open(client.get_cache_path("Homo sapiens")) as f:
+        cached = json.load(f)
+    assert cached["etag"] == '"v1"'
+    assert cached["data"] == {"pathways": pathways}
+
+def test_uses_cache_within_ttl(start_server, output_dir):
+    url, requests_seen = start_stub(start_server, [200])
+    get_client(url, output_dir).get_pathways("Homo sapiens")
+
+    client = get_client(url, output_dir)
+    assert client.get_pathways("Homo sapiens") == pathways
+    assert len(requests_seen) == 1
+
+def test_revalidates_stale_cache(start_server, output_dir):
+    url, requests_seen = start_stub(
+        start_server, [200, "304 if validated"]
+    )
+    client = get_client(url, output_dir, ttl=0)
+    client.get_pathways("Homo sapiens")
+    with open(client.get_cache_path("Homo sapiens")) as f:
+        fetched_at = json.load(f)["fetched_at"]
+
+    assert client.get_pathways("Homo sapiens") == pathways
+    assert len(requests_seen) == 2
+    assert requests_seen[1][1]["If-None-Match"] == '"v1"'
+
+    # Revalidating refreshes the cache's age
+    with open(client.get_cache_path("Homo sapiens")) as f:
+        cached = json.load(f)
+    assert cached["fetched_at"] > fetched_at
+    assert cached["etag"] == '"v1"'
+    assert cached["data"] == {"pathways": pathways}
+
+def test_retries_server_errors(start_server, output_dir):
+    url, requests_seen = start_stub(start_server, [503, 500, 200])
+    client = get_client(url, output_dir, retries=2)
+
+    assert client.get_pathways("Homo sapiens") == pathways
+    assert len(requests_seen) == 3
+
+@pytest.mark.parametrize("failure", [503, "hang"])
+def test_falls_back_to_stale_cache(start_server, output_dir, failure):
+    url, requests_seen = start_stub(start_server, [200] + [failure] * 3)
+    get_client(url, output_dir).get_pathways("Homo sapiens")
+
+    client = get_client(url, output_dir, ttl=0, retries=2)
+    assert client.get_pathways("Homo sapiens") == pathways
+    assert len(requests_seen) == 4
+
+def test_raises_without_cache_to_fall_back_to(start_server, output_dir):
+    url, requests_seen = start_stub(start_server, [502] * 2)
+    client = get_client(url, output_dir, retries=1)
+
+    with pytest.raises(requests.RequestException):
+        client.get_pathways("Homo sapiens")
+    assert len(requests_seen) == 2
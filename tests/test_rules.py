@@ -0,0 +1,167 @@
+import re
+
+from lxml import etree
+import pytest
+
+from conftest import fixture_pwids, read_fixture
+import wikipathways
+
+# Rule tables, and the passes `compile_rules` made of them
+rule_tables = {
+    "lossless": (
+        wikipathways.lossless_attribute_rules +
+        wikipathways.marker_id_rules +
+        wikipathways.lossless_id_rules,
+        wikipathways.lossless_rules
+    ),
+    "lossy": (
+        wikipathways.lossy_category_rules +
+        [(r'class="[^"]*,[^"]*"', '')] +
+        wikipathways.lossy_xref_rules +
+        wikipathways.lossy_attribute_rules,
+        wikipathways.lossy_rules
+    ),
+}
+
+def apply_one_by_one(rules, svg):
+    """Apply rewrite rules as successive `re.sub` calls, as they're specified
+    """
+    for pattern, replacement in rules:
+        svg = re.sub(pattern, replacement, svg)
+    return svg
+
+def get_rewritten_markup(pwid):
+    """Get markup of a fixture as the lossless and lossy rules get it
+    """
+    svg = wikipathways.scour_svg(read_fixture(pwid + ".svg"))
+    tree, _, _ = wikipathways.get_lossless_tree(svg, pwid)
+    return etree.tostring(tree).decode("utf-8")
+
+@pytest.mark.parametrize("pwid", fixture_pwids)
+@pytest.mark.parametrize("table", rule_tables)
+def test_compiled_rules_match_rules_one_by_one(pwid, table):
+    rules, passes = rule_tables[table]
+    svg = get_rewritten_markup(pwid)
+    if table == "lossy":
+        svg = wikipathways.apply_rules(wikipathways.lossless_rules, svg)
+
+    expected = apply_one_by_one(rules, svg)
+    assert expected != svg
+    assert wikipathways.apply_rules(passes, svg) == expected
+
+def test_merged_literal_rules_replace_matches_that_replacements_make():
+    # Removing "aq" joins "a" and "b", which a later rule replaces
+    rules = [("aq", ""), ("ay", "z"), ("ab", "c")]
+    passes = wikipathways.compile_rules(rules)
+    assert any(isinstance(rewrite_pass, dict) for rewrite_pass in passes)
+
+    svg = "aaqb ay axb ab"
+    expected = apply_one_by_one(rules, svg)
+    assert expected == "c z axb c"
+    assert wikipathways.apply_rules(passes, svg) == expected
+
+def test_icon_rect_rules_keep_one_tag_name():
+    svg = '<rect class="Icon" x="1" color="#000" fill="#000"/>'
+    svg = wikipathways.apply_rules(wikipathways.lossless_rules, svg)
+    assert "rect rect" not in svg
+    assert "#000" not in svg
+    etree.fromstring(svg)
+
+@pytest.mark.parametrize("number, precision, expected", [
+    ("1.005", 2, "1.01"),
+    ("2.675", 2, "2.68"),
+    ("-1.005", 2, "-1.01"),
+    ("1.0049", 2, "1"),
+    ("0.125", 2, ".13"),
+    ("0.45", 1, ".5"),
+    ("12.5", 0, "13"),
+    ("0.29", 2, ".29"),
+])
+def test_compact_numbers_rounds_decimal_halves_away_from_zero(
+    number, precision, expected
+):
+    svg = f'<rect x="{number}"/>'
+    compacted = wikipathways.compact_numbers(svg, precision)
+    assert compacted == f'<rect x="{expected}"/>'
+
+def test_compact_numbers_drops_the_sign_of_zero():
+    svg = (
+        '<path d="M-0.001 2.5-0.004 1.5 -0.0049"/>'
+        '<g transform="translate(1.005 -0.0049)"/>'
+        '<rect x="-0.001"/>'
+    )
+    assert wikipathways.compact_numbers(svg) == (
+        '<path d="M0 2.5 0 1.5 0"/>'
+        '<g transform="translate(1.01 0)"/>'
+        '<rect x="0"/>'
+    )
+
+def test_compact_numbers_leaves_mantissas():
+    svg = '<path d="M1.005e2 3.14159E-3 1.23456e+5 1.23456"/>'
+    assert wikipathways.compact_numbers(svg) == (
+        '<path d="M1.005e2 3.14159E-3 1.23456e+5 1.23"/>'
+    )
+
+def test_compact_numbers_drops_separators_only_in_coordinates():
+    svg = (
+        '<path d="M1.5 .25 0.75,0.125"/>'
+        '<rect x="0.5" y="0.25"/>'
+        '<text style="font-size:1.555px">1.11.1.12 2.005</text>'
+    )
+    assert wikipathways.compact_numbers(svg) == (
+        '<path d="M1.5.25.75.13"/>'
+        '<rect x=".5" y=".25"/>'
+        '<text style="font-size:1.56px">1.11.1.12 2.01</text>'
+    )
+
+@pytest.mark.parametrize("hex_color, expected", [
+    ("aabbcc", "#abc"),
+    ("AABBCC", "#abc"),
+    ("aabbcd", "#aabbcd"),
+    ("ffcc00", "#fc0"),
+    ("ff0000", "red"),
+    ("a52a2a", "brown"),
+    ("808080", "grey"),
+])
+def test_shorten_color(hex_color, expected):
+    assert wikipathways.shorten_color(hex_color) == expected
+
+def test_condense_colors_leaves_longer_hex_and_ids():
+    svg = (
+        '<path fill="#aabbcc" stroke="#aabbcd" color="#aabbccdd"'
+        ' marker-end="url(#mea-ffffff)"/>'
+    )
+    assert wikipathways.condense_colors(svg) == (
+        '<path fill="#abc" stroke="#aabbcd" color="#aabbccdd"'
+        ' marker-end="url(#mea-ffffff)"/>'
+    )
+
+@pytest.mark.parametrize("marker_id, expected", [
+    ("markerendarrow000000white", "mea"),
+    ("markerendarrowff0000white", "meaf00"),
+    ("markerendarrowaabbcdwhite", "meaaabbcd"),
+    ("markerendarrowff0000000000", "meaf00000000"),
+    ("markerendmimconversion00ff00white", "memconversion0f0"),
+    ("markerendmimconversion000000white", "memconversion000"),
+])
+def test_marker_id_rules_shorten_colors(marker_id, expected):
+    svg = f'<marker id="{marker_id}"/><path marker-end="url(#{marker_id})"/>'
+    assert wikipathways.apply_rules(
+        wikipathways.compile_rules(wikipathways.marker_id_rules), svg
+    ) == f'<marker id="{expected}"/><path marker-end="url(#{expected})"/>'
+
+def test_marker_id_rules_keep_distinct_ids_distinct():
+    colors = ["000000", "ff0000", "f00000", "aabbcc", "a52a2a"]
+    backgrounds = ["white", "000000", "ff0000", "ffffff"]
+    marker_ids = [
+        prefix + color + background
+        for prefix in ["markerendarrow", "markerendmimconversion"]
+        for color in colors
+        for background in backgrounds
+    ]
+    svg = " ".join(f'id="{marker_id}"' for marker_id in marker_ids)
+    shortened = wikipathways.apply_rules(
+        wikipathways.compile_rules(wikipathways.marker_id_rules), svg
+    )
+    shortened_ids = re.findall(r'id="([^"]*)"', shortened)
+    assert len(set(shortened_ids)) == len(marker_ids)
@@ -0,0 +1,71 @@
+import brotli
+import pytest
+
+from conftest import fixture_pwids
+import wikipathways
+
+@pytest.fixture
+def sprite_output(optimize_fixtures):
+    """Optimize the fixture SVGs with a sprite sheet, and get the cache
+    """
+    return optimize_fixtures(sprite=True)
+
+@pytest.fixture
+def get(sprite_output, serve_data):
+    """Serve the optimized SVGs, and get a function that requests a path
+    """
+    return serve_data(sprite_output.output_dir)
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def test_serves_sprite_sheet(sprite_output, get):
+    sprite_path = sprite_output.sprite_path
+    sprite_svg = read(sprite_path)
+    assert wikipathways.get_symbols(sprite_svg.decode("utf-8"))
+
+    response, body = get("/" + wikipathways.sprite_name)
+    assert response.status == 200
+    assert response.getheader("Content-Type") == "image/svg+xml"
+    assert body == sprite_svg
+    etag = response.getheader("ETag")
+    assert etag == f'"{wikipathways.get_hash(sprite_svg)}"'
+
+    response, body = get("/sprite.svg", {"Accept-Encoding": "br"})
+    assert response.getheader("Content-Encoding") == "br"
+    assert brotli.decompress(body) == sprite_svg
+
+    response, body = get("/sprite.svg", {"If-None-Match": etag})
+    assert response.status == 304
+
+def test_hoisted_references_resolve_on_server(sprite_output, get):
+    response, body = get("/sprite.svg")
+    sprite_ids = wikipathways.get_symbols(body.decode("utf-8"))
+    for pwid in fixture_pwids:
+        response, body = get(f"/{pwid}.svg")
+        svg = body.decode("utf-8")
+        assert wikipathways.sprite_reference_regex.search(svg)
+        unresolved = wikipathways.get_unresolved_references(svg, sprite_ids)
+        assert not any(
+            reference.startswith(wikipathways.sprite_name)
+            for reference in unresolved
+        )
+
+def test_rewritten_sprite_sheet_replaces_cached_one(sprite_output, get):
+    response, old_body = get("/sprite.svg")
+    old_etag = response.getheader("ETag")
+
+    symbol = '<symbol id="Added" viewBox="0 0 1 1"/>'
+    sprite_output.sprite_symbols["Added"] = symbol
+    sprite_output.write_sprite()
+    sprite_output.save_manifest()
+
+    response, body = get("/sprite.svg", {"Accept-Encoding": "br"})
+    assert response.getheader("ETag") != old_etag
+    assert symbol.encode("utf-8") in brotli.decompress(body)
+
+def test_unknown_files_are_not_found(get):
+    for path in ["/sprite.xrefs.json", "/manifest.json", "/WP1.svg"]:
+        response, body = get(path)
+        assert response.status == 404
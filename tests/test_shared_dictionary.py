@@ -0,0 +1,79 @@
+import base64
+import os
+import shutil
+
+import pytest
+
+from conftest import fixture_pwids, fixtures_dir, read_fixture
+import shared_dictionary
+
+@pytest.fixture
+def data_dir(output_dir):
+    """A data directory with the fixture SVGs, a level-of-detail variant,
+    a sprite sheet and a dictionary
+    """
+    for pwid in fixture_pwids:
+        shutil.copy(fixtures_dir + pwid + ".svg", output_dir)
+    shutil.copy(fixtures_dir + "WP106.svg", output_dir + "WP106.lod200.svg")
+    shutil.copy(fixtures_dir + "WP4925.svg", output_dir + "sprite.svg")
+
+    # Any bytes make a raw-content dictionary, which needs no training
+    content = read_fixture("WP106.svg", "rb")[:16384]
+    path = output_dir + shared_dictionary.dictionary_name
+    with open(path, "wb") as f:
+        f.write(content)
+    return output_dir
+
+def test_reads_and_compresses_only_pathway_svgs(data_dir):
+    svgs = shared_dictionary.read_svgs(data_dir)
+    names = [os.path.basename(path) for path in svgs]
+    assert names == [pwid + ".svg" for pwid in sorted(fixture_pwids)]
+
+    dictionary = shared_dictionary.load_dictionary(
+        data_dir + shared_dictionary.dictionary_name
+    )
+    shared_dictionary.compress_svgs(data_dir, dictionary)
+    for pwid in fixture_pwids:
+        svg = shared_dictionary.decompress_svg(
+            data_dir + pwid + ".svg.dcz", dictionary
+        )
+        assert svg == read_fixture(pwid + ".svg")
+    for name in ["WP106.lod200.svg", "sprite.svg"]:
+        assert not os.path.exists(data_dir + name + ".dcz")
+
+def test_decompress_needs_the_same_dictionary(data_dir):
+    dictionary = shared_dictionary.load_dictionary(
+        data_dir + shared_dictionary.dictionary_name
+    )
+    dcz = dictionary.compress(read_fixture("WP4925.svg", "rb"))
+    other = shared_dictionary.SharedDictionary(b"<svg>" * 100)
+    assert not other.is_dictionary_for(dcz)
+    with pytest.raises(ValueError):
+        other.decompress(dcz)
+    with pytest.raises(ValueError):
+        dictionary.decompress(dcz[len(shared_dictionary.dcz_magic):])
+
+def test_serves_dictionary_for_dcz(data_dir, serve_data):
+    dictionary = shared_dictionary.load_dictionary(
+        data_dir + shared_dictionary.dictionary_name
+    )
+    shared_dictionary.compress_svgs(data_dir, dictionary)
+    get = serve_data(data_dir)
+
+    response, body = get("/WP4925.svg")
+    assert response.getheader("Link") == (
+        '</svgs.dict>; rel="compression-dictionary"'
+    )
+
+    response, body = get("/svgs.dict")
+    assert response.status == 200
+    assert body == dictionary.content
+    assert response.getheader("Use-As-Dictionary") == 'match="/WP*.svg"'
+
+    hash = base64.b64encode(dictionary.sha256).decode("ascii")
+    response, body = get("/WP4925.svg", {
+        "Accept-Encoding": "dcz, br",
+        "Available-Dictionary": f":{hash}:"
+    })
+    assert response.getheader("Content-Encoding") == "dcz"
+    assert dictionary.decompress(body) == read_fixture("WP4925.svg", "rb")
@@ -0,0 +1,42 @@
+import wikipathways
+
+ellipse = (
+    '<symbol viewBox="0 0 10 10" id="Ellipse">' +
+    '<ellipse cx="5" cy="5" rx="5" ry="5"/></symbol>'
+)
+empty = '<symbol id="Empty"/>'
+unnamed = '<symbol viewBox="0 0 1 1"><path d="m0 0h1"/></symbol>'
+
+def get_svg(*symbols):
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg"><defs>' + "".join(symbols) +
+        '</defs><use href="#Ellipse"/><use href="#Empty"/></svg>'
+    )
+
+def test_get_symbols_with_any_attribute_order_and_self_closing():
+    svg = get_svg(empty, unnamed, ellipse)
+    assert wikipathways.get_symbols(svg) == {
+        "Empty": empty, "Ellipse": ellipse
+    }
+
+def test_hoist_symbols_keeps_symbols_after_self_closing_ones():
+    sprite_symbols = {}
+    hoisted_svg = wikipathways.hoist_symbols(
+        get_svg(empty, ellipse), sprite_symbols
+    )
+    assert sprite_symbols == {"Empty": empty, "Ellipse": ellipse}
+    assert hoisted_svg == (
+        '<svg xmlns="http://www.w3.org/2000/svg"><defs></defs>' +
+        '<use href="sprite.svg#Ellipse"/><use href="sprite.svg#Empty"/></svg>'
+    )
+
+    sprite_svg = wikipathways.get_sprite_svg(sprite_symbols)
+    assert wikipathways.get_symbols(sprite_svg) == sprite_symbols
+
+def test_hoist_symbols_keeps_differing_symbols_inline():
+    sprite_symbols = {"Ellipse": ellipse.replace("rx=", "data-rx=")}
+    hoisted_svg = wikipathways.hoist_symbols(
+        get_svg(ellipse), sprite_symbols
+    )
+    assert ellipse in hoisted_svg
+    assert 'href="#Ellipse"' in hoisted_svg
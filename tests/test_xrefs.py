@@ -0,0 +1,56 @@
+import json
+import os
+
+import pytest
+
+from conftest import fixture_pwids, fixtures_dir, read_fixture
+import wikipathways
+
+def read_sidecar(output_dir, pwid):
+    with open(output_dir + pwid + wikipathways.xrefs_suffix) as f:
+        return json.load(f)
+
+@pytest.mark.parametrize("pwid", fixture_pwids)
+def test_sidecars_match_across_pipelines(tmp_path, pwid):
+    output_dirs = {}
+    for mode in ["default", "stream"]:
+        output_dir = str(tmp_path / mode) + "/"
+        os.makedirs(output_dir)
+        if mode == "stream":
+            wikipathways.stream_optimize_svg(
+                fixtures_dir + pwid + ".svg", pwid, output_dir, xrefs=True
+            )
+        else:
+            wikipathways.optimize_svg(
+                read_fixture(pwid + ".svg"), pwid, output_dir, xrefs=True
+            )
+        output_dirs[mode] = output_dir
+
+    sidecar = read_sidecar(output_dirs["default"], pwid)
+    assert sidecar["ids"] == sorted(sidecar["ids"])
+    assert any(sidecar["class"])
+    for output_dir in output_dirs.values():
+        assert read_sidecar(output_dir, pwid) == sidecar
+
+def test_removed_data_is_unescaped_and_sorted():
+    link = "https://example.org/?a=1&b=2"
+    svg = (
+        '<g id="b" about="urn:x&amp;y" class="Entrez_Gene_7157 x&amp;y">' +
+        '<a xlink:href="https://example.org/?a=1&amp;b=2"/></g>' +
+        '<g id="a&amp;1" typeof="Gene&#38;Product"/>'
+    )
+    # As low-memory mode might write the same elements, in another order
+    other_svg = (
+        '<g id="a&#38;1" typeof="Gene&amp;Product"/>' +
+        '<g id="b" about="urn:x&#38;y" class="Entrez_Gene_7157 x&#38;y">' +
+        '<a xlink:href="https://example.org/?a=1&#38;b=2"/></g>'
+    )
+    columns = wikipathways.get_removed_data(svg)
+    assert columns == {
+        "ids": ["a&1", "b"],
+        "about": [None, "urn:x&y"],
+        "typeof": ["Gene&Product", None],
+        "class": [None, "Entrez_Gene_7157"],
+        "href": [None, link],
+    }
+    assert wikipathways.get_removed_data(other_svg) == columns